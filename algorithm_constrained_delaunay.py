@@ -1,121 +1,228 @@
 # -*- coding: utf-8 -*-
 
-from qgis.core import *
+import time
 
 import algorithm_voronoi as voronoi
+from algorithm_predicates import orient2d, incircle, localOrigin
+from rasterbenderstats import timeStage
 
-def computeConstrainedDelaunayTriangulation(points, constraints):
+def computeConstrainedDelaunayTriangulation(points, constraints, stats=None, backend=None):
     """
     This will return a constrained Delaunay triangulation.
 
+    Each constraint segment is inserted by removing the triangles it crosses and retriangulating the two
+    pseudo-polygons on its sides (Anglada, "An improved incremental algorithm for constructing restricted Delaunay
+    triangulations", 1997), so that its cost is proportional to the number of crossed triangles. The result is the
+    constrained Delaunay triangulation, which doesn't depend on the order of the constraints. Constraints that cross
+    an earlier one can't both be respected without adding points : the crossing segments are skipped.
+
     Input
-    points: array of QgsPoint
+    points: (N,2) array of coordinates
     constraints: array of linestrings that form the constrains
+    stats: optional RunStats in which the 'triangulation' and 'constraints' stages are timed, and the skipped
+    segments counted as 'constraintsSkipped'
+    backend: name of the algorithm_voronoi.DELAUNAY_BACKENDS computing the unconstrained triangulation (by default the first one)
 
-    Returns a list of 3 uples being the indices of the points forming the triangles
+    Returns a list of 3 uples being the indices of the points forming the triangles (counterclockwise)
     """
 
-    # We get the normal delaunay triangulation
-    triangles = voronoi.computeDelaunayTriangulation( [voronoi.Site(p.x(), p.y()) for p in points] )
-
+    # The points are translated close to the origin, so that the predicates are precise with projected coordinates
+    coords = [(float(x), float(y)) for x, y in points]
+    originX, originY = localOrigin(coords)
+    coords = [(x - originX, y - originY) for x, y in coords]
 
-    # QgsMessageLog.logMessage("\n\n\nAll the triangles : %s" % str(triangles))
+    # We get the normal delaunay triangulation
+    with timeStage(stats, 'triangulation'):
+        delaunay = voronoi.computeDelaunayTriangulation( [voronoi.Site(x, y) for x, y in coords], backend )
+    constraintsStart = time.time()
 
-    # Now we have to constrain the delaunay triangulation.
-    # For each needed segment, we'll delete the intersecting triangles to make room for the constrain, and retriangulate it.
-    
 
     # Utils functions
-    def intersects(seg1, seg2):
-        seg1Geom = QgsGeometry.fromPolyline( [points[pID] for pID in seg1] )
-        seg2Geom = QgsGeometry.fromPolyline( [points[pID] for pID in seg2] )
-        return seg1Geom.crosses(seg2Geom)
-
-    def isPointLeftOfRay(point, segmentPointA, segmentPointB):
-        x = point.x()
-        y = point.y()
-        raySx = segmentPointA.x()
-        raySy = segmentPointA.y()
-        rayEx = segmentPointB.x()
-        rayEy = segmentPointB.y()
-        return ((y-raySy)*(rayEx-raySx)) > ((x-raySx)*(rayEy-raySy))
-
-
-    # Each linestring is a constraint
+    def orientation(pA, pB, pC):
+        """
+        Positive if pC is left of the ray pA->pB, negative if right, 0 if collinear (the sign is exact)
+        """
+        ax, ay = coords[pA]
+        bx, by = coords[pB]
+        cx, cy = coords[pC]
+        return orient2d(ax, ay, bx, by, cx, cy)
+
+    def inCircle(pA, pB, pC, pD):
+        """
+        Positive if pD is inside the circle through the counterclockwise pA, pB, pC (the sign is exact)
+        """
+        ax, ay = coords[pA]
+        bx, by = coords[pB]
+        cx, cy = coords[pC]
+        dx, dy = coords[pD]
+        return incircle(ax, ay, bx, by, cx, cy, dx, dy)
+
+
+    # The mesh is stored as its directed edges : each counterclockwise triangle (a,b,c) is stored as the edges
+    # a->b, b->c and c->a, each one giving the third point. The triangle on the other side of a->b is thus found
+    # with the edge b->a.
+    edges = {} # (pointID, pointID) : pointID
+    vertexEdges = {} # pointID : pointID such that pointID->pointID is an edge of the mesh
+    constrained = set() # (pointID, pointID) with the smallest ID first
+
+    def edgeKey(pA, pB):
+        return (pA, pB) if pA < pB else (pB, pA)
+
+    def addTriangle(pA, pB, pC):
+        # the points must be counterclockwise
+        edges[(pA,pB)] = pC
+        edges[(pB,pC)] = pA
+        edges[(pC,pA)] = pB
+        vertexEdges[pA] = pB
+        vertexEdges[pB] = pC
+        vertexEdges[pC] = pA
+
+    def removeTriangle(pA, pB, pC):
+        del edges[(pA,pB)]
+        del edges[(pB,pC)]
+        del edges[(pC,pA)]
+
+    for tri in delaunay:
+        side = orientation(*tri)
+        if side > 0:
+            addTriangle(tri[0], tri[1], tri[2])
+        elif side < 0:
+            addTriangle(tri[0], tri[2], tri[1])
+        # flat triangles are dropped
+
+
+    def trianglesAround(pID):
+        """
+        Returns the (pointID, pointID) such that (pID, pointID, pointID) are the counterclockwise triangles around pID
+        """
+        around = []
+        first = vertexEdges[pID]
+        # We turn counterclockwise from the first edge until we come back to it or reach the hull
+        current = first
+        while True:
+            third = edges.get( (pID,current) )
+            if third is None:
+                break
+            around.append( (current, third) )
+            current = third
+            if current == first:
+                return around
+        # And clockwise from it to get the triangles before it
+        current = first
+        while True:
+            third = edges.get( (current,pID) )
+            if third is None:
+                return around
+            around.append( (third, current) )
+            current = third
+
+    def triangulatePseudoPolygon(pA, pB, chain):
+        """
+        Triangulates the polygon on the left of the ray pA->pB that is closed by the chain of points going from pA to pB.
+        The point of the chain forming a triangle with pA and pB is the one whose circumcircle contains no other point of
+        the chain, and the two parts of the chain on its sides are triangulated the same way.
+        """
+        stack = [(pA, pB, chain)]
+        while stack:
+            pA, pB, chain = stack.pop()
+            if len(chain) == 0:
+                continue
+            best = 0
+            for i in range(1, len(chain)):
+                if inCircle(pA, pB, chain[best], chain[i]) > 0:
+                    best = i
+            pC = chain[best]
+            addTriangle(pA, pB, pC)
+            stack.append( (pA, pC, chain[:best]) )
+            stack.append( (pC, pB, chain[best+1:]) )
+
+    def insertSegment(start, end):
+        """
+        Inserts the part of the segment start->end that goes up to the first point lying on it.
+        Returns that point, or None if the segment crosses a constrained edge (nothing is changed then)
+        """
+        around = trianglesAround(start)
+        sx, sy = coords[start]
+        ex, ey = coords[end]
+
+        for left, right in around:
+            for pID in (left, right):
+                if pID == end:
+                    # The segment already is an edge
+                    constrained.add( edgeKey(start, end) )
+                    return end
+                if orientation(start, end, pID) == 0:
+                    px, py = coords[pID]
+                    if (px-sx)*(ex-sx) + (py-sy)*(ey-sy) > 0:
+                        # The segment passes through a neighbouring point
+                        constrained.add( edgeKey(start, pID) )
+                        return pID
+
+        # We find the triangle around start through which the segment leaves, its opposite edge is crossed
+        for right, left in around:
+            if orientation(start, end, right) < 0 and orientation(start, end, left) > 0:
+                break
+        else:
+            return None
+
+        # We walk through the crossed triangles, the points on the left and on the right of the segment form the
+        # two pseudo-polygons to retriangulate
+        crossed = [(start, right, left)]
+        chainLeft = [left]
+        chainRight = [right]
+        while True:
+            if edgeKey(right, left) in constrained:
+                return None
+            third = edges.get( (left,right) )
+            if third is None:
+                return None
+            crossed.append( (left, right, third) )
+            if third == end:
+                break
+            side = orientation(start, end, third)
+            if side > 0:
+                chainLeft.append(third)
+                left = third
+            elif side < 0:
+                chainRight.append(third)
+                right = third
+            else:
+                # The segment passes through this point
+                end = third
+                break
+
+        for tri in crossed:
+            removeTriangle(*tri)
+        triangulatePseudoPolygon( start, end, chainLeft )
+        triangulatePseudoPolygon( end, start, chainRight[::-1] )
+        constrained.add( edgeKey(start, end) )
+        return end
+
+
+    # Each linestring is a constraint
     for constraint in constraints:
 
-        # For each segment, we must delete and retriangulate the triangles that it crosses
+        # Each segment is inserted (the linestring is closed by the segment from its last point to its first one)
         for i,point in enumerate(constraint):
 
             segment = [constraint[i-1],constraint[i]]
-
-
-            # QgsMessageLog.logMessage("Segment is %s" % str(segment))
-
-            trianglesToRemove = [] # This will store the triangles that must be deleted
-
-            # We check for intersection 
-            for triangle in triangles:
-                for edge in [ [triangle[0],triangle[1]], [triangle[1],triangle[2]], [triangle[2],triangle[0]] ]:
-                    if intersects(segment, edge):
-                        # QgsMessageLog.logMessage("We must remove %s" % str(triangle) )
-                        trianglesToRemove.append(triangle) # If there is an intersection between the segment and an edge of the triangle, we have to remove it
-                        break
-
-
-            # Now we're going to remove all the triangles, and retriangulate the left and the right part of the segment
-            if len(trianglesToRemove)>0:
-
-                pointsLeft = set() # This will hold the list of points IDs consituing the part to be retriangulated on the left side of the segment
-                pointsRight = set() # This will hold the list of points IDs consituing the part to be retriangulated on the right side of the segment
-
-                pointsLeft.add(segment[0])
-                pointsLeft.add(segment[1])
-                pointsRight.add(segment[0])
-                pointsRight.add(segment[1])
-
-                # QgsMessageLog.logMessage("%s was added to the left as part of the segment" % str(pointsLeft))
-                # QgsMessageLog.logMessage("%s was added to the right as part of the segment" % str(pointsRight))
-
-                for triToRemove in trianglesToRemove:
-
-                    # QgsMessageLog.logMessage("We remove %s" % str(triToRemove))
-                    triangles.remove( triToRemove ) # We remove the triangles
-
-                    for pID in triToRemove: # And for each poiont
-                        if isPointLeftOfRay( points[pID], points[segment[0]], points[segment[1]]):
-                            pointsLeft.add(pID)
-                            # QgsMessageLog.logMessage("%i was added to the left" % pID)
-                        else:
-                            pointsRight.add(pID)
-                            # QgsMessageLog.logMessage("%i was added to the right" % pID)
-
-                    
-                # QgsMessageLog.logMessage("Pointsleft is %s" % str(pointsLeft) )
-                # QgsMessageLog.logMessage("Pointsright is %s" % str(pointsRight) )
-
-                # We compute the delaunay triangulation for the left side
-                arrayLeft = list(pointsLeft)
-                trianglesLeft = voronoi.computeDelaunayTriangulation( [voronoi.Site(points[pID].x(), points[pID].y()) for pID in pointsLeft] )
-                # QgsMessageLog.logMessage("%i triangles computed for the left (%s)" % (len(trianglesLeft),trianglesLeft))  
-                for tri in trianglesLeft:
-                    # And map the triangles point indices to the actual point indices
-                    mappedTri = [ arrayLeft[tri[0]],arrayLeft[tri[1]],arrayLeft[tri[2]] ]
-                    # And add the triangles to the list
-                    # QgsMessageLog.logMessage("%s triangles added for the left" % str(mappedTri) )  
-                    triangles.append( mappedTri )
-
-
-                # We compute the delaunay triangulation for the right side
-                arrayRight = list(pointsRight)
-                trianglesRight = voronoi.computeDelaunayTriangulation( [voronoi.Site(points[pID].x(), points[pID].y()) for pID in arrayRight] )
-                # QgsMessageLog.logMessage("%i triangles computed for the right (%s)" % (len(trianglesRight),trianglesRight))  
-                for tri in trianglesRight:
-                    # And map the triangles point indices to the actual point indices
-                    mappedTri = [ arrayRight[tri[0]],arrayRight[tri[1]],arrayRight[tri[2]] ]
-                    # And add the triangles to the list
-                    # QgsMessageLog.logMessage("%s triangles added for the right" % str(mappedTri) ) 
-                    triangles.append( mappedTri )
-
-
-    return triangles
+            if segment[0] is None or segment[1] is None or segment[0] == segment[1]:
+                continue
+            if segment[0] not in vertexEdges or segment[1] not in vertexEdges:
+                continue
+
+            # The segment is inserted up to each point lying on it
+            current = segment[0]
+            while current != segment[1]:
+                current = insertSegment(current, segment[1])
+                if current is None:
+                    if stats is not None:
+                        stats.count( 'constraintsSkipped' )
+                    break
+
+
+    if stats is not None:
+        stats.addTime( 'constraints', time.time() - constraintsStart )
+
+    # Sorted, so that the same input always gives the same mesh (and cache files), whatever the order of the dict
+    return sorted( key + (third,) for key, third in edges.items() if key[0] < key[1] and key[0] < third )
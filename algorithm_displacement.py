@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+Displacement fields : the destination to source mapping of a mesh, stored as a raster.
+
+The field has two float32 bands (dx and dy) giving, for each destination pixel, the offset in source pixels
+of the location it is resampled from : srcX = x + dx, srcY = y + dy (x and y being the coordinates of the pixel
+center). Pixels outside of the mesh are NaN (the no data value of the bands) : they are left untouched, as the
+triangle engine does. Fields written before the no data value was used have 0 there instead.
+
+The field can have a lower resolution than the raster (each field pixel covering step x step raster pixels),
+in which case it is upsampled bilinearly when applied, except along the border of the mesh where the nearest field
+pixel is used, so that displacements inside of the mesh are never mixed with pixels outside of it.
+
+This module only depends on numpy and GDAL, so that it can be used outside of QGIS (and in worker processes).
+"""
+
+import numpy
+import osgeo.gdal, osgeo.gdal_array
+
+import algorithm_resampling as resampling
+import algorithm_warp as algWarp
+
+
+# Metadata items of the field rasters
+STEP_ITEM = 'RASTERBENDER_STEP'
+SIZE_ITEM = 'RASTERBENDER_RASTER_SIZE'
+# No data value of the field bands, for the pixels outside of the mesh
+NO_DISPLACEMENT = float('nan')
+
+
+def fieldSize(xSize, ySize, step):
+    """
+    Returns the size of the field of a raster
+    """
+    return ( (xSize + step - 1) // step, (ySize + step - 1) // step )
+
+
+def computeFieldWindow(pixelsB, triangles, affines, step, xoff, yoff, width, height, subset=None):
+    """
+    Computes a window of the displacement field of a mesh.
+
+    Input
+    pixelsB: (N,2) array of the destination points in pixel coordinates
+    triangles: (M,3) array of point indices
+    affines: (M,2,3) array as returned by algorithm_warp.computeInverseAffines
+    step: size of the field pixels, in raster pixels
+    xoff, yoff, width, height: the window of the field
+    subset: optional indices of the triangles overlapping the window (see algorithm_warp.trianglesInWindow on bounds divided by step)
+
+    Returns (dx, dy) as (height,width) float32 arrays, NaN outside of the mesh
+    """
+    ids = algWarp.rasterizeTriangles(pixelsB / float(step), triangles, xoff, yoff, width, height, subset)
+    rows, cols = numpy.nonzero(ids >= 0)
+    m = affines[ids[rows, cols]]
+
+    # The centers of the field pixels, in raster pixel coordinates
+    x = (cols + (xoff + 0.5)) * step
+    y = (rows + (yoff + 0.5)) * step
+
+    dx = numpy.empty((height,width), dtype=numpy.float32)
+    dy = numpy.empty((height,width), dtype=numpy.float32)
+    dx.fill(NO_DISPLACEMENT)
+    dy.fill(NO_DISPLACEMENT)
+    dx[rows, cols] = m[:,0,0]*x + m[:,0,1]*y + m[:,0,2] - x
+    dy[rows, cols] = m[:,1,0]*x + m[:,1,1]*y + m[:,1,2] - y
+    return dx, dy
+
+
+def sampleField(readField, step, fieldXSize, fieldYSize, xoff, yoff, width, height):
+    """
+    Upsamples the displacement field to a window of the raster.
+
+    Input
+    readField: function(xoff, yoff, xsize, ysize) returning the (dx, dy) arrays of a window of the field
+    step: size of the field pixels, in raster pixels
+    fieldXSize, fieldYSize: size of the field
+    xoff, yoff, width, height: the window of the raster
+
+    Returns (dx, dy) as (height,width) float64 arrays, NaN outside of the mesh
+    """
+    if step == 1:
+        dx, dy = readField(xoff, yoff, width, height)
+        return dx.astype(numpy.float64), dy.astype(numpy.float64)
+
+    # The raster pixel centers as indices of the field pixels centers
+    u = (numpy.arange(xoff, xoff+width) + 0.5) / step - 0.5
+    v = (numpy.arange(yoff, yoff+height) + 0.5) / step - 0.5
+
+    fieldX = max(int(numpy.floor(u[0])), 0)
+    fieldY = max(int(numpy.floor(v[0])), 0)
+    fieldWidth = min(int(numpy.floor(u[-1])) + 2, fieldXSize) - fieldX
+    fieldHeight = min(int(numpy.floor(v[-1])) + 2, fieldYSize) - fieldY
+    dx, dy = readField(fieldX, fieldY, fieldWidth, fieldHeight)
+
+    uu, vv = numpy.meshgrid(u - fieldX, v - fieldY)
+    uu, vv = uu.ravel(), vv.ravel()
+    outside = numpy.isnan(dx) | numpy.isnan(dy)
+    kernel, radius = resampling.KERNELS['bilinear']
+    sampledX, valid = resampling.resampleKernel(numpy.where(outside, 0, dx), uu, vv, kernel, radius)
+    sampledY, valid = resampling.resampleKernel(numpy.where(outside, 0, dy), uu, vv, kernel, radius)
+
+    # Where some of the 4 field pixels around a raster pixel are outside of the mesh, the nearest one is used instead
+    # (the raster pixel is outside of the mesh if it is)
+    i0 = numpy.clip(numpy.floor(uu).astype(numpy.intp), 0, fieldWidth-1)
+    i1 = numpy.clip(i0 + 1, 0, fieldWidth-1)
+    j0 = numpy.clip(numpy.floor(vv).astype(numpy.intp), 0, fieldHeight-1)
+    j1 = numpy.clip(j0 + 1, 0, fieldHeight-1)
+    border = outside[j0, i0] | outside[j0, i1] | outside[j1, i0] | outside[j1, i1]
+    nearestI = numpy.clip(numpy.floor(uu[border] + 0.5).astype(numpy.intp), 0, fieldWidth-1)
+    nearestJ = numpy.clip(numpy.floor(vv[border] + 0.5).astype(numpy.intp), 0, fieldHeight-1)
+    sampledX = sampledX.astype(numpy.float64)
+    sampledY = sampledY.astype(numpy.float64)
+    sampledX[border] = dx[nearestJ, nearestI]
+    sampledY[border] = dy[nearestJ, nearestI]
+    return sampledX.reshape(height, width), sampledY.reshape(height, width)
+
+
+def fieldScales(srcX, srcY):
+    """
+    Returns the size of each destination pixel of a window, measured in source pixels (used by the average and mode
+    resampling methods), from the (height,width) arrays of their source coordinates (NaN outside of the mesh)
+    """
+    if min(srcX.shape) < 2:
+        return numpy.ones(srcX.shape), numpy.ones(srcX.shape)
+    dXdRow, dXdCol = numpy.gradient(srcX)
+    dYdRow, dYdCol = numpy.gradient(srcY)
+    scaleX, scaleY = numpy.hypot(dXdCol, dYdCol), numpy.hypot(dXdRow, dYdRow)
+    # The pixels next to the outside of the mesh have no neighbour to measure their size with : it is one pixel
+    scaleX[~numpy.isfinite(scaleX)] = 1
+    scaleY[~numpy.isfinite(scaleY)] = 1
+    return scaleX, scaleY
+
+
+def readFieldWindow(dsField, counter=None):
+    """
+    Returns a function reading the (dx, dy) arrays of a window of a field dataset, NaN outside of the mesh.
+    If counter is a list, the number of bytes read is added to its first item.
+    """
+    bandX = dsField.GetRasterBand(1)
+    bandY = dsField.GetRasterBand(2)
+    # Fields written before the no data value was used have no displacement outside of the mesh
+    legacy = bandX.GetNoDataValue() is None
+    def readField(xoff, yoff, width, height):
+        dx, dy = bandX.ReadAsArray(xoff, yoff, width, height), bandY.ReadAsArray(xoff, yoff, width, height)
+        if counter is not None:
+            counter[0] += dx.nbytes + dy.nbytes
+        if legacy:
+            outside = (dx == 0) & (dy == 0)
+            dx = dx.astype(numpy.float32)
+            dy = dy.astype(numpy.float32)
+            dx[outside] = NO_DISPLACEMENT
+            dy[outside] = NO_DISPLACEMENT
+        return dx, dy
+    return readField
+
+
+def applyTile(dsSource, dsField, step, tile, method):
+    """
+    Warps all the bands of a destination tile with a displacement field.
+
+    Input
+    dsSource: the source GDAL dataset
+    dsField: the field GDAL dataset
+    step: size of the field pixels, in raster pixels
+    tile: the destination window (xoff, yoff, xsize, ysize)
+    method: one of the resampling.METHODS
+
+    Returns (tile, moved, bands, bytesRead) where moved is a (ysize,xsize) boolean array of the pixels inside of the mesh,
+    bands a list of (ysize,xsize) arrays whose values are only meaningful where moved is True and bytesRead the
+    number of bytes read from the source and the field
+    """
+    xoff, yoff, width, height = tile
+    bytesRead = [0]
+    dx, dy = sampleField(readFieldWindow(dsField, bytesRead), step, dsField.RasterXSize, dsField.RasterYSize, xoff, yoff, width, height)
+    moved = ~(numpy.isnan(dx) | numpy.isnan(dy))
+    bands = []
+    if not moved.any():
+        return tile, moved, bands, bytesRead[0]
+
+    # The source coordinates of all the pixels of the tile
+    srcX = (numpy.arange(xoff, xoff+width) + 0.5)[numpy.newaxis,:] + dx
+    srcY = (numpy.arange(yoff, yoff+height) + 0.5)[:,numpy.newaxis] + dy
+
+    rows, cols = numpy.nonzero(moved)
+    scaleX, scaleY = None, None
+    if method in ('average', 'mode'):
+        scaleX, scaleY = fieldScales(srcX, srcY)
+        scaleX, scaleY = scaleX[rows, cols], scaleY[rows, cols]
+
+    bands = [None] * dsSource.RasterCount
+    for bandNumbers, dtype, noData in algWarp.bandGroups(dsSource):
+        data = numpy.zeros((len(bandNumbers),height,width), dtype=dtype)
+        algWarp.resampleBands(algWarp.readBands(dsSource, bandNumbers, dtype, bytesRead), rows, cols, srcX[rows, cols], srcY[rows, cols], scaleX, scaleY,
+                              dsSource.RasterXSize, dsSource.RasterYSize, method, data, noData)
+        for b, bandData in zip(bandNumbers, data):
+            bands[b-1] = bandData
+    return tile, moved, bands, bytesRead[0]
+
+
+def applyTileTask(args):
+    """
+    Entry point of the worker processes : applyTile for a (sourcePath, fieldPath, step, tile, method) tuple.
+    """
+    sourcePath, fieldPath, step, tile, method = args
+    return applyTile(algWarp.openDataset(sourcePath), algWarp.openDataset(fieldPath), step, tile, method)
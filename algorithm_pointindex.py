@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Uniform grid index to find the nearest of a set of points.
+"""
+
+import math
+
+
+class PointIndex(object):
+    """
+    Buckets the points in square cells holding about one point each, so that nearest neighbour queries only
+    look at the cells around the query point.
+    """
+
+    def __init__(self, coords):
+        """
+        coords: list of (x,y) tuples
+        """
+        self.coords = coords
+        self.cells = {} # (column, row) : list of point indices
+
+        if len(coords) == 0:
+            return
+
+        xs = [c[0] for c in coords]
+        ys = [c[1] for c in coords]
+        self.xMin = min(xs)
+        self.yMin = min(ys)
+        width = max(xs) - self.xMin
+        height = max(ys) - self.yMin
+
+        # About one point per cell
+        if width > 0 and height > 0:
+            self.cellSize = math.sqrt(width * height / len(coords))
+        else:
+            self.cellSize = max(width, height) / len(coords)
+        if self.cellSize <= 0:
+            self.cellSize = 1.0
+
+        self.columns = int(width / self.cellSize) + 1
+        self.rows = int(height / self.cellSize) + 1
+
+        for i, (x, y) in enumerate(coords):
+            self.cells.setdefault( self.cell(x, y), [] ).append(i)
+
+    def cell(self, x, y):
+        return ( int(math.floor((x - self.xMin) / self.cellSize)), int(math.floor((y - self.yMin) / self.cellSize)) )
+
+    def nearest(self, x, y):
+        """
+        Returns (index, distance) of the nearest point (the lowest index if several are at the same distance),
+        or (None, None) if the index is empty.
+        """
+        if len(self.cells) == 0:
+            return None, None
+
+        column, row = self.cell(x, y)
+
+        # Rings closer than the grid are empty, and we can stop once the rings are further than the whole grid
+        firstRing = max( 0, -column, -row, column - (self.columns-1), row - (self.rows-1) )
+        lastRing = max( column, row, (self.columns-1) - column, (self.rows-1) - row )
+
+        nearestIndex = None
+        nearestDist = None
+        for ring in range(firstRing, lastRing + 1):
+            # Points of this ring and the next ones are at least (ring-1)*cellSize away
+            if nearestDist is not None and nearestDist < (ring - 1) * self.cellSize:
+                break
+            for i in self.ringIndices(column, row, ring):
+                px, py = self.coords[i]
+                dist = math.sqrt( (px-x)*(px-x) + (py-y)*(py-y) )
+                if nearestIndex is None or dist < nearestDist or (dist == nearestDist and i < nearestIndex):
+                    nearestIndex = i
+                    nearestDist = dist
+
+        return nearestIndex, nearestDist
+
+    def ringIndices(self, column, row, ring):
+        """
+        Yields the indices of the points in the cells at a given (chebyshev) distance of a cell
+        """
+        if ring == 0:
+            for i in self.cells.get( (column, row), () ):
+                yield i
+            return
+
+        # We only look at the cells of the ring that are in the grid
+        cMin = max(column - ring, 0)
+        cMax = min(column + ring, self.columns - 1)
+        rMin = max(row - ring + 1, 0)
+        rMax = min(row + ring - 1, self.rows - 1)
+        for r in (row - ring, row + ring):
+            if 0 <= r < self.rows:
+                for c in range(cMin, cMax + 1):
+                    for i in self.cells.get( (c, r), () ):
+                        yield i
+        for c in (column - ring, column + ring):
+            if 0 <= c < self.columns:
+                for r in range(rMin, rMax + 1):
+                    for i in self.cells.get( (c, r), () ):
+                        yield i
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""
+Robust geometric predicates.
+
+orient2d and incircle are first evaluated in floating point. When the result is too close to 0 for its sign to be
+trusted (according to the error bounds of J. R. Shewchuk, "Adaptive Precision Floating-Point Arithmetic and Fast
+Robust Geometric Predicates", 1997), they are evaluated again with exact rational arithmetic. Their sign is thus
+always right, so that near-collinear or near-cocircular points never make the triangulation inconsistent.
+
+The error bounds are relative to the magnitude of the coordinates : with projected coordinates in the millions of
+metres, translating the points close to the origin first (see localOrigin) makes the exact evaluation much rarer.
+The predicates are exact for the translated coordinates, so all the tests of a triangulation must use the same ones.
+
+This module only depends on the standard library, so that it can be used by the worker processes.
+"""
+
+from fractions import Fraction
+
+
+EPSILON = 2.0 ** -53
+# Error bounds of the floating point evaluations, relative to the magnitude of their terms
+ORIENT_BOUND = (3.0 + 16.0 * EPSILON) * EPSILON
+INCIRCLE_BOUND = (10.0 + 96.0 * EPSILON) * EPSILON
+# Smallest positive float, returned when the exact result is too small to be represented
+TINY = 5e-324
+
+
+def localOrigin(points):
+    """
+    Returns the (x, y) center of the bounding box of a list of (x, y) points, to translate them close to the origin
+    """
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    if len(xs) == 0:
+        return 0.0, 0.0
+    return (min(xs) + max(xs)) * 0.5, (min(ys) + max(ys)) * 0.5
+
+
+def toFloat(value):
+    """
+    Converts an exact result to a float, keeping its sign
+    """
+    result = float(value)
+    if result == 0.0 and value != 0:
+        return TINY if value > 0 else -TINY
+    return result
+
+
+def orient2d(ax, ay, bx, by, cx, cy):
+    """
+    Returns a positive value if c is left of the ray a->b (that is a, b, c are counterclockwise), a negative
+    value if it is right and 0 if the points are collinear. The sign is exact, the value is approximately twice
+    the signed area of the triangle.
+    """
+    detLeft = (ax - cx) * (by - cy)
+    detRight = (ay - cy) * (bx - cx)
+    det = detLeft - detRight
+
+    if detLeft > 0.0:
+        if detRight <= 0.0:
+            return det
+        detSum = detLeft + detRight
+    elif detLeft < 0.0:
+        if detRight >= 0.0:
+            return det
+        detSum = -detLeft - detRight
+    else:
+        return det
+
+    bound = ORIENT_BOUND * detSum
+    if det >= bound or -det >= bound:
+        return det
+    return orient2dExact(ax, ay, bx, by, cx, cy)
+
+
+def orient2dExact(ax, ay, bx, by, cx, cy):
+    """
+    orient2d evaluated with rational arithmetic
+    """
+    ax, ay, bx, by, cx, cy = [Fraction(v) for v in (ax, ay, bx, by, cx, cy)]
+    return toFloat( (ax - cx) * (by - cy) - (ay - cy) * (bx - cx) )
+
+
+def incircle(ax, ay, bx, by, cx, cy, dx, dy):
+    """
+    Returns a positive value if d is inside the circle through a, b and c (which must be counterclockwise), a
+    negative value if it is outside and 0 if the four points are cocircular. The sign is exact.
+    """
+    adx = ax - dx
+    bdx = bx - dx
+    cdx = cx - dx
+    ady = ay - dy
+    bdy = by - dy
+    cdy = cy - dy
+
+    bdxcdy = bdx * cdy
+    cdxbdy = cdx * bdy
+    cdxady = cdx * ady
+    adxcdy = adx * cdy
+    adxbdy = adx * bdy
+    bdxady = bdx * ady
+
+    alift = adx * adx + ady * ady
+    blift = bdx * bdx + bdy * bdy
+    clift = cdx * cdx + cdy * cdy
+
+    det = alift * (bdxcdy - cdxbdy) + blift * (cdxady - adxcdy) + clift * (adxbdy - bdxady)
+    permanent = ( (abs(bdxcdy) + abs(cdxbdy)) * alift +
+                  (abs(cdxady) + abs(adxcdy)) * blift +
+                  (abs(adxbdy) + abs(bdxady)) * clift )
+
+    bound = INCIRCLE_BOUND * permanent
+    if det > bound or -det > bound:
+        return det
+    return incircleExact(ax, ay, bx, by, cx, cy, dx, dy)
+
+
+def incircleExact(ax, ay, bx, by, cx, cy, dx, dy):
+    """
+    incircle evaluated with rational arithmetic
+    """
+    ax, ay, bx, by, cx, cy, dx, dy = [Fraction(v) for v in (ax, ay, bx, by, cx, cy, dx, dy)]
+    adx, ady = ax - dx, ay - dy
+    bdx, bdy = bx - dx, by - dy
+    cdx, cdy = cx - dx, cy - dy
+    alift = adx * adx + ady * ady
+    blift = bdx * bdx + bdy * bdy
+    clift = cdx * cdx + cdy * cdy
+    return toFloat( alift * (bdx * cdy - cdx * bdy) + blift * (cdx * ady - adx * cdy) + clift * (adx * bdy - bdx * ady) )
+
+
+def compareArcs(tx, ty, bx, by, px, py):
+    """
+    Compares two arcs of the beach line of Fortune's sweep (the sweep line moving towards increasing y).
+
+    Returns a positive value if, with the sweep line at py, the parabola of the site t is closer to the sweep line
+    than the one of the site b at abscissa px (that is the arc of t is the one on the beach line), a negative value
+    if it is farther and 0 if they cross there. Both sites must have been swept (ty <= py and by <= py), and the
+    sign is exact.
+    """
+    # The parabola of a site s is at y = (py+sy)/2 - (px-sx)^2 / (2*(py-sy)) : multiplied by the two (positive)
+    # denominators, the difference of the parabolas of t and b is
+    # (ty-by)*dt*db + (px-bx)^2*dt - (px-tx)^2*db
+    dt = py - ty
+    db = py - by
+    ex = px - bx
+    tx2 = px - tx
+    t1 = (ty - by) * dt * db
+    t2 = ex * ex * dt
+    t3 = tx2 * tx2 * db
+    det = t1 + t2 - t3
+    # Each term is the product of rounded differences : 1e-12 is far above their accumulated relative error
+    bound = 1e-12 * (abs(t1) + abs(t2) + abs(t3))
+    if det > bound or -det > bound:
+        return det
+    tx, ty, bx, by, px, py = [Fraction(v) for v in (tx, ty, bx, by, px, py)]
+    dt = py - ty
+    db = py - by
+    return toFloat( (ty - by) * dt * db + (px - bx) ** 2 * dt - (px - tx) ** 2 * db )
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+Coarse raster preview of the bending.
+
+The source is read once at about the resolution of the screen (GDAL reads from the overviews of the source when it
+has some, and the coarse copy is kept in memory otherwise) and converted to colors. Each time the preview changes,
+these colors are warped through the interpolated mesh with the nearest neighbour, which only takes a few
+milliseconds for a canvas sized image. The pixels that are not covered by the mesh are transparent.
+
+This module only depends on numpy and GDAL, the preview is drawn by the dialog.
+"""
+
+import numpy
+import osgeo.gdal
+
+import algorithm_warp as algWarp
+from algorithm_rasterize import rasterizeTriangles
+
+
+# Maximum number of pixels of the preview image (the preview is drawn at a lower resolution than the canvas beyond)
+MAX_PIXELS = 250000
+# Maximum width and height of the coarse copy of the source
+MAX_SOURCE_SIZE = 4096
+
+
+def previewSize(width, height, maxPixels=MAX_PIXELS):
+    """
+    Returns the (width, height) of the preview image of a canvas of width x height pixels
+    """
+    factor = max(1.0, numpy.sqrt(float(width) * float(height) / maxPixels))
+    return max(1, int(width / factor)), max(1, int(height / factor))
+
+
+def readSource(dsSource, geotransform, extent, resolution):
+    """
+    Reads a part of the source at a lower resolution.
+
+    Input
+    dsSource: the source GDAL dataset
+    geotransform: its geotransform
+    extent: (xMin, yMin, xMax, yMax) the map extent to read
+    resolution: the size of the read pixels in map units (the source is never read above its own resolution)
+
+    Returns (data, geotransform) where data is a (bands,rows,cols) array and geotransform the one of data,
+    or (None, None) if the extent doesn't overlap the source
+    """
+    xMin, yMin, xMax, yMax = extent
+    corners = algWarp.mapToPixel( [[xMin, yMin], [xMax, yMax]], geotransform )
+    x0 = max(int(numpy.floor(corners[:,0].min())), 0)
+    y0 = max(int(numpy.floor(corners[:,1].min())), 0)
+    x1 = min(int(numpy.ceil(corners[:,0].max())), dsSource.RasterXSize)
+    y1 = min(int(numpy.ceil(corners[:,1].max())), dsSource.RasterYSize)
+    if x1 <= x0 or y1 <= y0:
+        return None, None
+    width, height = x1-x0, y1-y0
+
+    scale = max(1.0, float(resolution) / abs(geotransform[1]), float(max(width, height)) / MAX_SOURCE_SIZE)
+    bufWidth = max(1, int(round(width / scale)))
+    bufHeight = max(1, int(round(height / scale)))
+
+    # When the buffer is smaller than the window, GDAL reads from the closest overview
+    data = numpy.array( [dsSource.GetRasterBand(b).ReadAsArray( x0, y0, width, height, buf_xsize=bufWidth, buf_ysize=bufHeight )
+                         for b in range(1, dsSource.RasterCount+1)] )
+
+    dataGeotransform = ( geotransform[0] + x0*geotransform[1], geotransform[1]*width/float(bufWidth), 0.0,
+                         geotransform[3] + y0*geotransform[5], 0.0, geotransform[5]*height/float(bufHeight) )
+    return data, dataGeotransform
+
+
+def stretch(values, valid):
+    """
+    Converts the values of a band to uint8, stretching the 2% - 98% range of the valid values (uint8 bands are kept as they are)
+    """
+    if values.dtype == numpy.uint8:
+        return values
+    if not valid.any():
+        return numpy.zeros(values.shape, dtype=numpy.uint8)
+    low, high = numpy.percentile( values[valid], [2, 98] )
+    if high <= low:
+        high = low + 1
+    return numpy.clip( (values - low) * (255.0 / (high - low)), 0, 255 ).astype(numpy.uint8)
+
+
+def colors(dsSource, data):
+    """
+    Converts the data returned by readSource to a (rows,cols) uint32 array of 0xAARRGGBB colors (as QImage.Format_ARGB32 expects them)
+    """
+    band = dsSource.GetRasterBand(1)
+    noData = band.GetNoDataValue()
+    if noData is None:
+        valid = numpy.ones(data[0].shape, dtype=bool)
+    elif numpy.isnan(noData):
+        valid = ~numpy.isnan(data[0])
+    else:
+        valid = data[0] != noData
+    if data.dtype.kind == 'f':
+        valid &= numpy.isfinite(data[0])
+
+    colorTable = band.GetColorTable()
+    if len(data) < 3 and colorTable is not None:
+        # Paletted raster
+        palette = numpy.array( [colorTable.GetColorEntry(i) for i in range(colorTable.GetCount())], dtype=numpy.uint32 ).reshape(-1,4)
+        entries = palette[ numpy.clip(data[0], 0, len(palette)-1).astype(numpy.intp) ]
+        red, green, blue, alpha = entries[...,0], entries[...,1], entries[...,2], entries[...,3]
+    else:
+        # RGB(A) or grey raster
+        channels = [0, 1, 2] if len(data) >= 3 else [0, 0, 0]
+        red, green, blue = [stretch(data[c], valid).astype(numpy.uint32) for c in channels]
+        alpha = numpy.uint32(255)
+        if len(data) >= 4 and dsSource.GetRasterBand(4).GetColorInterpretation() == osgeo.gdal.GCI_AlphaBand:
+            alpha = data[3].astype(numpy.uint32)
+
+    argb = (alpha << 24) | (red << 16) | (green << 8) | blue
+    argb[~valid] = 0
+    return argb.astype(numpy.uint32)
+
+
+def warpPreview(argb, sourceGeotransform, pointsA, points, triangles, extent, width, height):
+    """
+    Warps the colors of the source through the mesh.
+
+    Input
+    argb: (rows,cols) uint32 colors of the source, as returned by colors
+    sourceGeotransform: the geotransform of argb
+    pointsA: (N,2) array of the source positions of the points
+    points: (N,2) array of the positions of the points to preview (for instance interpolated between pointsA and pointsB)
+    triangles: (M,3) array of point indices
+    extent: (xMin, yMin, xMax, yMax) the map extent of the preview image
+    width, height: the size of the preview image
+
+    Returns a (height,width) uint32 array of colors, transparent outside of the mesh
+    """
+    image = numpy.zeros((height,width), dtype=numpy.uint32)
+    if len(triangles) == 0:
+        return image
+
+    xMin, yMin, xMax, yMax = extent
+    geotransform = ( xMin, (xMax-xMin) / float(width), 0.0, yMax, 0.0, -(yMax-yMin) / float(height) )
+    pixelsA = algWarp.mapToPixel( pointsA, sourceGeotransform )
+    pixels = algWarp.mapToPixel( points, geotransform )
+
+    # Only the triangles in the extent are drawn
+    subset = algWarp.trianglesInWindow( algWarp.triangleBounds( pixels, triangles ), 0, 0, width, height )
+    if len(subset) == 0:
+        return image
+
+    # The affine transformations are only computed for these triangles, the ids are indices in the subset
+    visible = triangles[subset]
+    ids = rasterizeTriangles( pixels, visible, 0, 0, width, height )
+    affines = algWarp.computeInverseAffines( pixelsA, pixels, visible )
+    rows, cols, srcX, srcY = algWarp.inverseMap( ids, affines, 0, 0 )
+
+    i = numpy.floor(srcX).astype(numpy.intp)
+    j = numpy.floor(srcY).astype(numpy.intp)
+    inside = (i >= 0) & (j >= 0) & (i < argb.shape[1]) & (j < argb.shape[0])
+    image[rows[inside], cols[inside]] = argb[j[inside], i[inside]]
+    return image
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scanline rasterization of triangle meshes.
+
+A pixel belongs to a triangle if its center lies inside it. The triangles are filled row by row : each edge is
+intersected with the rows of pixel centers it spans, which gives for each (triangle, row) the two ends of the
+covered span. All the triangles are processed at once with numpy, so that the cost is linear in the number of
+filled pixels plus the number of triangle edges.
+
+Rows are half-open (a pixel center lying exactly on the lowest vertex is not filled, so that triangles sharing a
+horizontal edge don't both claim it), spans are closed (a pixel center lying on a shared edge goes to the triangle
+drawn last, that is the one with the highest index).
+
+This module only depends on numpy, so that it can be used by the worker processes, the preview and diagnostics.
+"""
+
+import numpy
+
+
+def triangleSpans(pixels, triangles, xoff, yoff, width, height, subset=None):
+    """
+    Computes the horizontal spans of pixels covered by the triangles in a window.
+
+    Input
+    pixels: (N,2) array of points in pixel coordinates
+    triangles: (M,3) array of point indices
+    xoff, yoff, width, height: the window of the raster
+    subset: optional indices of the triangles to draw (as returned by algorithm_warp.trianglesInWindow), defaults to all triangles
+
+    Returns (ids, rows, starts, ends) : 1D arrays giving for each span its triangle index, its row and its columns
+    [start, end[ in the window, ordered by triangle
+    """
+    triangles = numpy.asarray(triangles, dtype=numpy.intp).reshape(-1,3)
+    if subset is None:
+        subset = numpy.arange(len(triangles))
+    subset = numpy.asarray(subset, dtype=numpy.intp)
+
+    empty = numpy.zeros(0, dtype=numpy.intp)
+    if len(subset) == 0:
+        return empty, empty, empty, empty
+
+    p = pixels[triangles[subset]] - numpy.array([xoff, yoff], dtype=numpy.float64)
+
+    # Flat triangles don't own any pixel
+    flat = (p[:,1,0]-p[:,0,0])*(p[:,2,1]-p[:,0,1]) == (p[:,1,1]-p[:,0,1])*(p[:,2,0]-p[:,0,0])
+    subset = subset[~flat]
+    p = p[~flat]
+
+    # The three edges of each triangle
+    a = p.reshape(-1,2)
+    b = numpy.roll(p, -1, axis=1).reshape(-1,2)
+    edgeTriangles = numpy.repeat(numpy.arange(len(p)), 3)
+
+    # The rows whose center is in [top, bottom[ of the edge (horizontal edges span no row)
+    top = numpy.minimum(a[:,1], b[:,1])
+    bottom = numpy.maximum(a[:,1], b[:,1])
+    firstRows = numpy.maximum(numpy.ceil(top - 0.5), 0).astype(numpy.intp)
+    lastRows = numpy.minimum(numpy.ceil(bottom - 0.5), height).astype(numpy.intp) # excluded
+    counts = numpy.maximum(lastRows - firstRows, 0)
+
+    # One intersection per edge and row
+    edges = numpy.repeat(numpy.arange(len(a)), counts)
+    rows = firstRows[edges] + (numpy.arange(len(edges)) - numpy.repeat(numpy.cumsum(counts) - counts, counts))
+    y = rows + 0.5
+    ea = a[edges]
+    eb = b[edges]
+    x = ea[:,0] + (y - ea[:,1]) * (eb[:,0] - ea[:,0]) / (eb[:,1] - ea[:,1])
+    tris = edgeTriangles[edges]
+
+    # Each row of a triangle crosses exactly two of its edges : sorting gives the left and right ends of its span
+    order = numpy.lexsort((x, rows, tris))
+    left = x[order[0::2]]
+    right = x[order[1::2]]
+    rows = rows[order[0::2]]
+    tris = tris[order[0::2]]
+
+    # The pixels whose center is in [left, right]
+    starts = numpy.maximum(numpy.ceil(left - 0.5), 0).astype(numpy.intp)
+    ends = numpy.minimum(numpy.floor(right - 0.5) + 1, width).astype(numpy.intp)
+    keep = ends > starts
+
+    return subset[tris[keep]], rows[keep], starts[keep], ends[keep]
+
+
+def rasterizeTriangles(pixels, triangles, xoff, yoff, width, height, subset=None):
+    """
+    Finds which triangle owns each pixel of a window (a pixel is owned by a triangle if its center lies inside it).
+
+    Input
+    pixels: (N,2) array of points in pixel coordinates
+    triangles: (M,3) array of point indices
+    xoff, yoff, width, height: the window of the raster
+    subset: optional indices of the triangles to draw (as returned by algorithm_warp.trianglesInWindow), defaults to all triangles
+
+    Returns a (height,width) int32 array of triangle indices, -1 for pixels not covered by any triangle
+    """
+    ids = numpy.empty((height,width), dtype=numpy.int32)
+    ids.fill(-1)
+
+    spanIds, rows, starts, ends = triangleSpans(pixels, triangles, xoff, yoff, width, height, subset)
+    if len(spanIds) == 0:
+        return ids
+
+    # The flat indices of all the pixels of the spans (when spans overlap, the last one is kept)
+    lengths = ends - starts
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    flat = numpy.repeat(rows * width + starts, lengths) + offsets
+    ids.ravel()[flat] = numpy.repeat(spanIds, lengths)
+
+    return ids
+
+
+def pixelCounts(ids, count):
+    """
+    Returns the number of pixels owned by each of the count triangles in an array returned by rasterizeTriangles
+    """
+    return numpy.bincount(ids[ids >= 0], minlength=count)[:count]
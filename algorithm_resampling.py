@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized resampling kernels matching GDAL's resampling methods.
+
+The sample locations are given as array indices (u is the column, v is the row), where integer values fall on pixel centers.
+"""
+
+import numpy
+
+
+METHODS = ('near','bilinear','cubic','cubicspline','lanczos','average','mode',)
+
+
+def kernelBilinear(x):
+    x = numpy.abs(x)
+    return numpy.where(x < 1.0, 1.0 - x, 0.0)
+
+def kernelCubic(x):
+    # Keys' cubic convolution with a=-0.5 (as GDAL's cubic)
+    a = -0.5
+    x = numpy.abs(x)
+    x2 = x*x
+    x3 = x2*x
+    return numpy.where(x <= 1.0, (a+2.0)*x3 - (a+3.0)*x2 + 1.0,
+           numpy.where(x < 2.0, a*x3 - 5.0*a*x2 + 8.0*a*x - 4.0*a, 0.0))
+
+def kernelCubicSpline(x):
+    # Cubic B-spline (as GDAL's cubicspline)
+    x = numpy.abs(x)
+    return numpy.where(x < 1.0, (4.0 - 6.0*x*x + 3.0*x*x*x) / 6.0,
+           numpy.where(x < 2.0, (2.0-x)**3 / 6.0, 0.0))
+
+def kernelLanczos(x):
+    # Lanczos windowed sinc with a=3 (as GDAL's lanczos)
+    return numpy.where(numpy.abs(x) < 3.0, numpy.sinc(x) * numpy.sinc(x/3.0), 0.0)
+
+# method name : (kernel function, radius in pixels)
+KERNELS = {
+    'bilinear': (kernelBilinear, 1),
+    'cubic': (kernelCubic, 2),
+    'cubicspline': (kernelCubicSpline, 2),
+    'lanczos': (kernelLanczos, 3),
+}
+
+
+def margin(method):
+    """
+    Returns the number of pixels around the sample locations that must be read for the given method
+    """
+    if method in KERNELS:
+        return KERNELS[method][1] + 1
+    return 1
+
+
+def castTo(values, dtype):
+    """
+    Converts resampled values to the given dtype, rounding and clipping them for integer types
+    """
+    dtype = numpy.dtype(dtype)
+    if values.dtype == dtype:
+        return values
+    if dtype.kind in 'iub':
+        info = numpy.iinfo(dtype) if dtype.kind != 'b' else numpy.iinfo(numpy.uint8)
+        values = numpy.clip(numpy.round(values), info.min, info.max)
+    return values.astype(dtype)
+
+
+def workType(dtype):
+    """
+    Returns the floating point type used to interpolate values of the given type : float32 is exact enough for 8 and 16
+    bits data (and avoids float64 copies of big images), float64 is used for the others
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype == numpy.float32 or (dtype.kind in 'iub' and dtype.itemsize <= 2):
+        return numpy.float32
+    return numpy.float64
+
+
+def noDataMask(data, noData):
+    """
+    Returns a boolean array telling which pixels of a (bands, rows, cols) array are no data, or None if there are none.
+
+    noData is None, a value for all bands, or a sequence with a value (or None) per band
+    """
+    if noData is None:
+        return None
+    if numpy.isscalar(noData):
+        noData = [noData] * len(data)
+    if all(value is None for value in noData):
+        return None
+    mask = numpy.zeros(data.shape, dtype=bool)
+    for b, value in enumerate(noData):
+        if value is None:
+            continue
+        if numpy.isnan(value):
+            mask[b] = numpy.isnan(data[b])
+        else:
+            mask[b] = data[b] == value
+    return mask if mask.any() else None
+
+
+def resample(data, u, v, method, scaleX=None, scaleY=None, noData=None):
+    """
+    Samples an array at the given locations.
+
+    Input
+    data: (rows, cols) array, or (bands, rows, cols) array to sample all the bands at once
+    u, v: 1D arrays of the columns and rows of the sample locations
+    method: one of METHODS
+    scaleX, scaleY: size of the destination pixels in source pixels (only needed for average and mode)
+    noData: no data value (or sequence of values per band) : such pixels are ignored by the interpolation
+
+    Returns (values, valid), values having the dtype of data and the shape (N,) or (bands, N), and valid a boolean
+    array of the same shape that is False where only no data pixels were found
+    """
+    flat = data.ndim == 2
+    if flat:
+        data = data[numpy.newaxis]
+
+    mask = noDataMask(data, noData)
+    if method == 'near':
+        values, valid = resampleNearest(data, u, v, mask)
+    elif method in KERNELS:
+        kernel, radius = KERNELS[method]
+        values, valid = resampleKernel(data, u, v, kernel, radius, mask)
+    elif method == 'average':
+        values, valid = resampleAverage(data, u, v, scaleX, scaleY, mask)
+    elif method == 'mode':
+        values, valid = resampleMode(data, u, v, scaleX, scaleY, mask)
+    else:
+        raise ValueError("Unknown resampling method : %s" % method)
+
+    values = castTo(values, data.dtype)
+    if flat:
+        return values[0], valid[0]
+    return values, valid
+
+
+def resampleNearest(data, u, v, mask=None):
+    # The values are gathered in the source dtype, without any conversion
+    bands, h, w = data.shape
+    i = numpy.clip(numpy.floor(u + 0.5).astype(numpy.intp), 0, w-1)
+    j = numpy.clip(numpy.floor(v + 0.5).astype(numpy.intp), 0, h-1)
+    values = data[:, j, i]
+    if mask is None:
+        return values, numpy.ones(values.shape, dtype=bool)
+    return values, ~mask[:, j, i]
+
+
+def resampleKernel(data, u, v, kernel, radius, mask=None):
+    """
+    Interpolates a (bands, rows, cols) array with a separable kernel.
+
+    Returns (values, valid), values being float32 for 8 and 16 bits data (see workType) and float64 otherwise
+    """
+    if data.ndim == 2:
+        values, valid = resampleKernel(data[numpy.newaxis], u, v, kernel, radius, mask)
+        return values[0], valid[0]
+
+    bands, h, w = data.shape
+    work = workType(data.dtype)
+    baseU = numpy.floor(u).astype(numpy.intp)
+    baseV = numpy.floor(v).astype(numpy.intp)
+    fracU = (u - baseU).astype(work)
+    fracV = (v - baseV).astype(work)
+
+    offsets = range(-radius+1, radius+1)
+
+    # Separable weights for each tap, normalized so that they sum up to 1
+    weightsU = [kernel(fracU - k).astype(work) for k in offsets]
+    weightsV = [kernel(fracV - k).astype(work) for k in offsets]
+    # Indices are clamped to the array, which replicates the edge pixels
+    indicesU = [numpy.clip(baseU + k, 0, w-1) for k in offsets]
+    indicesV = [numpy.clip(baseV + k, 0, h-1) for k in offsets]
+
+    values = numpy.zeros((bands, len(u)), dtype=work)
+    if mask is None:
+        for wv, iv in zip(weightsV, indicesV):
+            for wu, iu in zip(weightsU, indicesU):
+                values += (wv * wu) * data[:, iv, iu]
+        values /= sum(weightsU) * sum(weightsV)
+        return values, numpy.ones(values.shape, dtype=bool)
+
+    # No data pixels are left out, and the weights of the other ones are normalized again (as GDAL does)
+    total = numpy.zeros((bands, len(u)), dtype=work)
+    for wv, iv in zip(weightsV, indicesV):
+        for wu, iu in zip(weightsU, indicesU):
+            weights = (wv * wu) * ~mask[:, iv, iu]
+            values += weights * numpy.where(mask[:, iv, iu], 0, data[:, iv, iu])
+            total += weights
+    valid = numpy.abs(total) > 1e-6
+    values[valid] /= total[valid]
+    return values, valid
+
+
+def footprint(data, u, v, scaleX, scaleY, mask=None):
+    """
+    Yields for each source pixel offset the (bands, N) values and a boolean array telling whether the source pixel
+    is inside the footprint of the destination pixels and is not no data (of shape (N,) if there is no mask).
+    """
+    bands, h, w = data.shape
+    halfX = numpy.maximum(scaleX, 1.0) * 0.5
+    halfY = numpy.maximum(scaleY, 1.0) * 0.5
+    radius = int(numpy.ceil(max(halfX.max(), halfY.max())))
+    centerU = numpy.floor(u + 0.5).astype(numpy.intp)
+    centerV = numpy.floor(v + 0.5).astype(numpy.intp)
+    for dv in range(-radius, radius+1):
+        iv = centerV + dv
+        insideV = (numpy.abs(iv - v) <= halfY) & (iv >= 0) & (iv < h)
+        iv = numpy.clip(iv, 0, h-1)
+        for du in range(-radius, radius+1):
+            iu = centerU + du
+            inside = insideV & (numpy.abs(iu - u) <= halfX) & (iu >= 0) & (iu < w)
+            iu = numpy.clip(iu, 0, w-1)
+            if mask is None:
+                yield data[:, iv, iu], inside
+            else:
+                yield data[:, iv, iu], inside & ~mask[:, iv, iu]
+
+
+def resampleAverage(data, u, v, scaleX, scaleY, mask=None):
+    bands = len(data)
+    total = numpy.zeros((bands, len(u)), dtype=numpy.float64)
+    count = numpy.zeros((bands, len(u)), dtype=numpy.int64)
+    for values, inside in footprint(data, u, v, scaleX, scaleY, mask):
+        total += numpy.where(inside, values, 0)
+        count += inside
+
+    # Where no source pixel center falls in the footprint, we use the nearest one
+    nearest, valid = resampleNearest(data, u, v, mask)
+    covered = count > 0
+    values = nearest.astype(numpy.float64)
+    values[covered] = total[covered] / count[covered]
+    return values, valid | covered
+
+
+def resampleMode(data, u, v, scaleX, scaleY, mask=None):
+    bands, n = len(data), len(u)
+    work = workType(data.dtype)
+    candidates = []
+    for values, inside in footprint(data, u, v, scaleX, scaleY, mask):
+        candidates.append(numpy.where(inside, values.astype(work), numpy.nan))
+    # One row of candidates per band and sample
+    candidates = numpy.sort(numpy.dstack(candidates).reshape(bands*n, -1), axis=1) # NaNs are sorted last
+    k = candidates.shape[1]
+
+    # We find the longest run of equal values in each (sorted) row
+    flat = candidates.ravel()
+    starts = numpy.ones(flat.shape, dtype=bool)
+    starts[1:] = flat[1:] != flat[:-1]
+    starts[::k] = True
+    runStarts = numpy.nonzero(starts)[0]
+    runLengths = numpy.diff(numpy.append(runStarts, len(flat)))
+    runLengths[numpy.isnan(flat[runStarts])] = 0
+    runRows = runStarts // k
+
+    # For each row, the first run (smallest value) among the longest ones
+    order = numpy.lexsort((runStarts, -runLengths, runRows))
+    rowIds, first = numpy.unique(runRows[order], return_index=True)
+    best = runStarts[order[first]]
+
+    nearest, valid = resampleNearest(data, u, v, mask)
+    values = nearest.ravel().copy()
+    covered = runLengths[order[first]] > 0
+    values[rowIds[covered]] = flat[best[covered]]
+    coveredRows = numpy.zeros(bands*n, dtype=bool)
+    coveredRows[rowIds[covered]] = True
+    return values.reshape(bands, n), valid | coveredRows.reshape(bands, n)
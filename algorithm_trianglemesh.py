@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Triangle mesh with neighbour links, to find which triangle contains a point.
+
+The point is located by walking from triangle to triangle towards it. A walk starts from the triangle found by the
+previous query, so that queries in scanline order (pixels, vertices of a line) only take a few steps each. The first
+query jumps to the closest of a sample of triangles first (Mücke, Saias and Zhu, "Fast randomized point location
+without preprocessing in two- and three-dimensional Delaunay triangulations", 1996).
+
+This module only depends on numpy, so that it can be used by the worker processes.
+"""
+
+import random
+
+import numpy
+
+from algorithm_predicates import orient2d, localOrigin
+
+
+class TriangleMesh(object):
+    """
+    Triangles with, for each of them, the triangles across its three edges.
+
+    The triangles must cover a convex region, as the triangulations returned by
+    computeConstrainedDelaunayTriangulation do, so that a walk leaving the mesh means the point is outside of it.
+    """
+
+    def __init__(self, points, triangles):
+        """
+        points: (N,2) array of coordinates
+        triangles: list or (M,3) array of point indices (for instance the output of computeConstrainedDelaunayTriangulation)
+        """
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1,2)
+        triangles = numpy.array(triangles, dtype=numpy.int64).reshape(-1,3)
+
+        # The points are translated close to the origin, so that the predicates are precise with projected coordinates
+        self.origin = localOrigin(points) if len(points) else (0.0, 0.0)
+        coords = points - numpy.array(self.origin)
+
+        # The triangles are made counterclockwise
+        p = coords[triangles]
+        clockwise = (p[:,1,0]-p[:,0,0])*(p[:,2,1]-p[:,0,1]) - (p[:,1,1]-p[:,0,1])*(p[:,2,0]-p[:,0,0]) < 0
+        triangles[clockwise] = triangles[clockwise][:,[0,2,1]]
+
+        # The edge opposite to the vertex i of a triangle goes from its vertex i+1 to its vertex i+2, the neighbour
+        # across it is the triangle having the reversed edge
+        count = numpy.int64(len(points))
+        starts = numpy.roll(triangles, -1, axis=1).ravel()
+        ends = numpy.roll(triangles, -2, axis=1).ravel()
+        keys = starts * count + ends
+        order = numpy.argsort(keys)
+        reversedKeys = ends * count + starts
+        found = numpy.clip(numpy.searchsorted(keys[order], reversedKeys), 0, max(len(keys)-1, 0))
+        neighbours = numpy.where( keys[order][found] == reversedKeys, order[found] // 3, -1 ) if len(keys) else keys
+
+        self.triangles = triangles
+        self.neighbours = neighbours.reshape(-1,3)
+
+        # The walks use python lists, which are much faster than numpy arrays element by element
+        self.xs = coords[:,0].tolist()
+        self.ys = coords[:,1].tolist()
+        self.vertices = [tuple(tri) for tri in triangles.tolist()]
+        self.links = [tuple(tri) for tri in self.neighbours.tolist()]
+
+        # The sample of triangles to jump from : about the cube root of their number
+        self.sample = numpy.linspace(0, len(triangles)-1, max(1, int(round(len(triangles) ** (1.0/3))))).astype(numpy.intp) if len(triangles) else numpy.zeros(0, dtype=numpy.intp)
+        self.sampleCenters = coords[triangles[self.sample]].mean(axis=1) if len(triangles) else numpy.zeros((0,2))
+
+        self.last = None # the triangle where the last walk stopped
+        self.random = random.Random(0) # the order in which the edges are tested, so that walks never cycle
+        self.steps = 0 # the number of triangles visited by the walks
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def jump(self, x, y):
+        """
+        Returns the triangle of the sample whose center is the closest to (x,y) (in translated coordinates)
+        """
+        distances = ((self.sampleCenters - (x, y)) ** 2).sum(axis=1)
+        return int(self.sample[numpy.argmin(distances)])
+
+    def locate(self, x, y, start=None):
+        """
+        Returns the index of the triangle containing (x,y), or -1 if it is outside of the mesh. A point on an edge
+        is in either of the two triangles.
+
+        The walk starts from the start triangle if given, else from the triangle found by the last query.
+        """
+        if len(self.vertices) == 0:
+            return -1
+        x -= self.origin[0]
+        y -= self.origin[1]
+        if start is None:
+            start = self.last
+        if start is None or start < 0:
+            start = self.jump(x, y)
+
+        xs, ys = self.xs, self.ys
+        vertices, links = self.vertices, self.links
+        current = start
+        previous = -1
+        steps = 0
+        while True:
+            steps += 1
+            tri = vertices[current]
+            # The edges are tested from a random one : a walk always visiting them in the same order can cycle in
+            # meshes that are not Delaunay
+            first = int(self.random.random() * 3)
+            for k in (first, first+1, first+2):
+                i = k % 3
+                neighbour = links[current][i]
+                if neighbour == previous and neighbour >= 0:
+                    # we come from there
+                    continue
+                pA = tri[(i+1) % 3]
+                pB = tri[(i+2) % 3]
+                if orient2d(xs[pA], ys[pA], xs[pB], ys[pB], x, y) < 0:
+                    # the point is beyond this edge
+                    break
+            else:
+                self.steps += steps
+                self.last = current
+                return current
+            if neighbour < 0:
+                # the next query starts from the border of the mesh
+                self.steps += steps
+                self.last = current
+                return -1
+            previous = current
+            current = neighbour
+
+    def locatePoints(self, points):
+        """
+        Locates each of the (N,2) points, in their order (see locate).
+
+        Returns a (N,) int32 array of triangle indices, -1 for the points outside of the mesh
+        """
+        return numpy.array( [self.locate(x, y) for x, y in numpy.asarray(points, dtype=numpy.float64).reshape(-1,2).tolist()], dtype=numpy.int32 )
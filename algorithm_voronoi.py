@@ -32,8 +32,10 @@
 #
 #############################################################################
 
+from __future__ import print_function
+
 def usage():
-    print """
+    print("""
 voronoi - compute Voronoi diagram or Delaunay triangulation
 
 voronoi [-t -p -d]  [filename]
@@ -70,7 +72,7 @@ On unsorted data uniformly distributed in the unit square, voronoi uses about
 AUTHOR
 Steve J. Fortune (1987) A Sweepline Algorithm for Voronoi Diagrams,
 Algorithmica 2, 153-174.
-"""
+""")
 
 #############################################################################
 #
@@ -90,16 +92,29 @@ Algorithmica 2, 153-174.
 #               the indices of the vetices at the end of the edge.  If
 #               v1 or v2 is -1, the line extends to infinity.
 #
-#   computeDelaunayTriangulation(points):
+#   computeDelaunayTriangulation(points, backend=None):
 #
 #        Takes a list of point objects (which must have x and y fields).
 #        Returns a list of 3-tuples: the indices of the points that form a
 #        Delaunay triangle.
+#        The triangulation is computed by one of the DELAUNAY_BACKENDS
+#        (by default the fastest available one).
 #
 #############################################################################
 import math
 import sys
+import heapq
 import getopt
+import operator
+from collections import OrderedDict
+
+from algorithm_predicates import orient2d, compareArcs, localOrigin
+
+try:
+    import numpy
+    import scipy.spatial
+except ImportError:
+    scipy = None
 TOLERANCE = 1e-9
 BIG_FLOAT = 1e38
 
@@ -127,39 +142,39 @@ class Context(object):
 
     def outSite(self,s):
         if(self.debug):
-            print "site (%d) at %f %f" % (s.sitenum, s.x, s.y)
+            print("site (%d) at %f %f" % (s.sitenum, s.x, s.y))
         elif(self.triangulate):
             pass
         elif(self.plot):
             self.circle (s.x, s.y, cradius)
         elif(self.doPrint):
-            print "s %f %f" % (s.x, s.y)
+            print("s %f %f" % (s.x, s.y))
 
     def outVertex(self,s):
         self.vertices.append((s.x,s.y))
         if(self.debug):
-            print  "vertex(%d) at %f %f" % (s.sitenum, s.x, s.y)
+            print("vertex(%d) at %f %f" % (s.sitenum, s.x, s.y))
         elif(self.triangulate):
             pass
         elif(self.doPrint and not self.plot):
-            print "v %f %f" % (s.x,s.y)
+            print("v %f %f" % (s.x,s.y))
 
     def outTriple(self,s1,s2,s3):
         self.triangles.append((s1.sitenum, s2.sitenum, s3.sitenum))
         if(self.debug):
-            print "circle through left=%d right=%d bottom=%d" % (s1.sitenum, s2.sitenum, s3.sitenum)
+            print("circle through left=%d right=%d bottom=%d" % (s1.sitenum, s2.sitenum, s3.sitenum))
         elif(self.triangulate and self.doPrint and not self.plot):
-            print "%d %d %d" % (s1.sitenum, s2.sitenum, s3.sitenum)
+            print("%d %d %d" % (s1.sitenum, s2.sitenum, s3.sitenum))
 
     def outBisector(self,edge):
         self.lines.append((edge.a, edge.b, edge.c))
         if(self.debug):
-            print "line(%d) %gx+%gy=%g, bisecting %d %d" % (edge.edgenum, edge.a, edge.b, edge.c, edge.reg[0].sitenum, edge.reg[1].sitenum)
+            print("line(%d) %gx+%gy=%g, bisecting %d %d" % (edge.edgenum, edge.a, edge.b, edge.c, edge.reg[0].sitenum, edge.reg[1].sitenum))
         elif(self.triangulate):
             if(self.plot):
                 self.line(edge.reg[0].x, edge.reg[0].y, edge.reg[1].x, edge.reg[1].y)
         elif(self.doPrint and not self.plot):
-            print "l %f %f %f" % (edge.a, edge.b, edge.c)
+            print("l %f %f %f" % (edge.a, edge.b, edge.c))
 
     def outEdge(self,edge):
         sitenumL = -1
@@ -179,26 +194,25 @@ class Context(object):
             if self.plot:
                 self.clip_line(edge)
             elif(self.doPrint):
-                print "e %d" % edge.edgenum,
-                print " %d " % sitenumL,
-                print "%d" % sitenumR
+                print("e %d %d %d" % (edge.edgenum, sitenumL, sitenumR))
 
 #------------------------------------------------------------------
-def voronoi(siteList,context):
+def voronoi(siteList,context,queue='heap'):
+    # queue is the name of one of the EVENT_QUEUES
     try:
       edgeList  = EdgeList(siteList.xmin,siteList.xmax,len(siteList))
-      priorityQ = PriorityQueue(siteList.ymin,siteList.ymax,len(siteList))
+      priorityQ = EVENT_QUEUES[queue](siteList.ymin,siteList.ymax,len(siteList))
       siteIter = siteList.iterator()
 
-      bottomsite = siteIter.next()
+      bottomsite = next(siteIter, None)
       context.outSite(bottomsite)
-      newsite = siteIter.next()
+      newsite = next(siteIter, None)
       minpt = Site(-BIG_FLOAT,-BIG_FLOAT)
       while True:
           if not priorityQ.isEmpty():
               minpt = priorityQ.getMinPt()
 
-          if (newsite and (priorityQ.isEmpty() or cmp(newsite,minpt) < 0)):
+          if (newsite is not None and (priorityQ.isEmpty() or newsite.y < minpt.y or (newsite.y == minpt.y and newsite.x < minpt.x))):
               # newsite is smallest -  this is a site event
               context.outSite(newsite)
 
@@ -237,7 +251,7 @@ def voronoi(siteList,context):
                   # push the Halfedge into the ordered linked list of vertices
                   priorityQ.insert(bisector,p,newsite.distance(p))
 
-              newsite = siteIter.next()
+              newsite = next(siteIter, None)
 
           elif not priorityQ.isEmpty():
               # intersection is smallest - this is a vector (circle) event
@@ -321,10 +335,9 @@ def voronoi(siteList,context):
       while he is not edgeList.rightend:
           context.outEdge(he.edge)
           he = he.right
+    finally:
+      # a failure is raised rather than returning a partial diagram
       Edge.EDGE_NUM = 0
-    except Exception, err:
-      print "######################################################"
-      print str(err)
 
 #------------------------------------------------------------------
 def isEqual(a,b,relativeError=TOLERANCE):
@@ -334,25 +347,20 @@ def isEqual(a,b,relativeError=TOLERANCE):
 
 #------------------------------------------------------------------
 class Site(object):
+    # Sites are created by the thousands, __slots__ saves their memory and speeds up the attribute lookups
+    __slots__ = ('x', 'y', 'sitenum')
+
     def __init__(self,x=0.0,y=0.0,sitenum=0):
         self.x = x
         self.y = y
         self.sitenum = sitenum
 
     def dump(self):
-        print "Site #%d (%g, %g)" % (self.sitenum,self.x,self.y)
-
-    def __cmp__(self,other):
-        if self.y < other.y:
-            return -1
-        elif self.y > other.y:
-            return 1
-        elif self.x < other.x:
-            return -1
-        elif self.x > other.x:
-            return 1
-        else:
-            return 0
+        print("Site #%d (%g, %g)" % (self.sitenum,self.x,self.y))
+
+    # sites are swept by increasing y, then x
+    def __lt__(self,other):
+        return self.y < other.y or (self.y == other.y and self.x < other.x)
 
     def distance(self,other):
         dx = self.x - other.x
@@ -361,10 +369,12 @@ class Site(object):
 
 #------------------------------------------------------------------
 class Edge(object):
+    __slots__ = ('a', 'b', 'c', 'ep', 'reg', 'edgenum')
+
     LE = 0
     RE = 1
     EDGE_NUM = 0
-    DELETED = {}   # marker value
+    DELETED = {}   # marker value (false, like None, for leftreg and rightreg)
 
     def __init__(self):
         self.a = 0.0
@@ -375,9 +385,9 @@ class Edge(object):
         self.edgenum = 0
 
     def dump(self):
-        print "(#%d a=%g, b=%g, c=%g)" % (self.edgenum,self.a,self.b,self.c)
-        print "ep",self.ep
-        print "reg",self.reg
+        print("(#%d a=%g, b=%g, c=%g)" % (self.edgenum,self.a,self.b,self.c))
+        print("ep",self.ep)
+        print("reg",self.reg)
 
     def setEndpoint(self, lrFlag, site):
         self.ep[lrFlag] = site
@@ -420,6 +430,8 @@ class Edge(object):
 
 #------------------------------------------------------------------
 class Halfedge(object):
+    __slots__ = ('left', 'right', 'qnext', 'edge', 'pm', 'vertex', 'ystar')
+
     def __init__(self,edge=None,pm=Edge.LE):
         self.left  = None   # left Halfedge in the edge list
         self.right = None   # right Halfedge in the edge list
@@ -430,28 +442,19 @@ class Halfedge(object):
         self.ystar  = BIG_FLOAT
 
     def dump(self):
-        print "Halfedge--------------------------"
-        print "left: ",    self.left
-        print "right: ",   self.right
-        print "edge: ",    self.edge
-        print "pm: ",      self.pm
-        print "vertex: ",
+        print("Halfedge--------------------------")
+        print("left: ",    self.left)
+        print("right: ",   self.right)
+        print("edge: ",    self.edge)
+        print("pm: ",      self.pm)
+        print("vertex: ", end="")
         if self.vertex: self.vertex.dump()
-        else: print "None"
-        print "ystar: ",   self.ystar
-
-
-    def __cmp__(self,other):
-        if self.ystar > other.ystar:
-            return 1
-        elif self.ystar < other.ystar:
-            return -1
-        elif self.vertex.x > other.vertex.x:
-            return 1
-        elif self.vertex.x < other.vertex.x:
-            return -1
-        else:
-            return 0
+        else: print("None")
+        print("ystar: ",   self.ystar)
+
+    # halfedges are queued by increasing ystar, then x of their vertex
+    def __lt__(self,other):
+        return self.ystar < other.ystar or (self.ystar == other.ystar and self.vertex.x < other.vertex.x)
 
     def leftreg(self,default):
         if not self.edge:
@@ -482,6 +485,17 @@ class Halfedge(object):
         if(not right_of_site and self.pm == Edge.RE):
             return False
 
+        # The arc of the top site lies between the two halfedges of the edge : p is right of the left one (or left
+        # of the right one) if the arc of the top site is the one above p. This is decided exactly, except when both
+        # sites are on the sweep line (the edge is then vertical)
+        botsite = e.reg[0]
+        if botsite.y < pt.y:
+            above = compareArcs(topsite.x, topsite.y, botsite.x, botsite.y, pt.x, pt.y) > 0.0
+            if(self.pm==Edge.LE):
+                return above
+            else:
+                return not above
+
         if(e.a == 1.0):
             dyp = pt.y - topsite.y
             dxp = pt.x - topsite.x
@@ -524,13 +538,18 @@ class Halfedge(object):
         if e1.reg[1] is e2.reg[1]:
             return None
 
+        # the bisectors of three collinear sites are parallel : this is tested exactly when the edges share a site
+        sites = [e1.reg[0], e1.reg[1]] + [s for s in e2.reg if s is not e1.reg[0] and s is not e1.reg[1]]
+        if len(sites) == 3:
+            if orient2d(sites[0].x, sites[0].y, sites[1].x, sites[1].y, sites[2].x, sites[2].y) == 0.0:
+                return None
         d = e1.a * e2.b - e1.b * e2.a
-        if isEqual(d,0.0):
+        if d == 0.0 or (len(sites) != 3 and isEqual(d,0.0)):
             return None
 
         xint = (e1.c*e2.b - e2.c*e1.b) / d
         yint = (e2.c*e1.a - e1.c*e2.a) / d
-        if(cmp(e1.reg[1],e2.reg[1]) < 0):
+        if(e1.reg[1] < e2.reg[1]):
             he = self
             e = e1
         else:
@@ -589,38 +608,41 @@ class EdgeList(object):
         return None
 
     def leftbnd(self,pt):
+        hashsize = self.hashsize
+        leftend = self.leftend
+        rightend = self.rightend
+
         # Use hash table to get close to desired halfedge
-        bucket = int(((pt.x - self.xmin)/self.deltax * self.hashsize))
+        bucket = int(((pt.x - self.xmin)/self.deltax * hashsize))
 
         if(bucket < 0):
-            bucket =0;
-
-        if(bucket >=self.hashsize):
-            bucket = self.hashsize-1
+            bucket = 0
+        elif(bucket >= hashsize):
+            bucket = hashsize-1
 
         he = self.gethash(bucket)
         if(he is None):
             i = 1
             while True:
                 he = self.gethash(bucket-i)
-                if (he is not None): break;
+                if (he is not None): break
                 he = self.gethash(bucket+i)
-                if (he is not None): break;
+                if (he is not None): break
                 i += 1
 
         # Now search linear list of halfedges for the corect one
-        if (he is self.leftend) or (he is not self.rightend and he.isPointRightOf(pt)):
+        if (he is leftend) or (he is not rightend and he.isPointRightOf(pt)):
             he = he.right
-            while he is not self.rightend and he.isPointRightOf(pt):
+            while he is not rightend and he.isPointRightOf(pt):
                 he = he.right
-            he = he.left;
+            he = he.left
         else:
             he = he.left
-            while (he is not self.leftend and not he.isPointRightOf(pt)):
+            while (he is not leftend and not he.isPointRightOf(pt)):
                 he = he.left
 
         # Update hash table and reference counts
-        if(bucket > 0 and bucket < self.hashsize-1):
+        if(0 < bucket < hashsize-1):
             self.hash[bucket] = he
         return he
 
@@ -633,9 +655,7 @@ class PriorityQueue(object):
         self.hashsize = int(4 * math.sqrt(nsites))
         self.count = 0
         self.minidx = 0
-        self.hash = []
-        for i in range(self.hashsize):
-            self.hash.append(Halfedge())
+        self.hash = [Halfedge() for i in range(self.hashsize)]
 
     def __len__(self):
         return self.count
@@ -645,13 +665,15 @@ class PriorityQueue(object):
 
     def insert(self,he,site,offset):
         he.vertex = site
-        he.ystar  = site.y + offset
+        he.ystar  = ystar = site.y + offset
+        x = site.x
         last = self.hash[self.getBucket(he)]
-        next = last.qnext
-        while((next is not None) and cmp(he,next) > 0):
-            last = next
-            next = last.qnext
-        he.qnext = last.qnext
+        following = last.qnext
+        # the bucket is ordered by ystar, then by x
+        while((following is not None) and (ystar > following.ystar or (ystar == following.ystar and x > following.vertex.x))):
+            last = following
+            following = last.qnext
+        he.qnext = following
         last.qnext = he
         self.count += 1
 
@@ -686,42 +708,93 @@ class PriorityQueue(object):
         return curr
 
 
+#------------------------------------------------------------------
+class HeapPriorityQueue(object):
+    # The same queue as PriorityQueue, kept in a binary heap instead of
+    # buckets of linked lists, so that all the operations stay O(log n)
+    # when the vertices are concentrated in a few buckets (clustered or
+    # gridded sites).
+    #
+    # Deleted halfedges are left in the heap and skipped when they reach
+    # its top (lazy deletion). The qnext field of a queued halfedge holds
+    # the serial number of its current heap entry, so that the entries left
+    # by a deletion followed by a new insertion are skipped too.
+    def __init__(self,ymin,ymax,nsites):
+        self.heap = []     # (ystar, x, -serial, halfedge) : the last inserted first among equal vertices, like PriorityQueue
+        self.count = 0
+        self.serial = 0
+
+    def __len__(self):
+        return self.count
+
+    def isEmpty(self):
+        return self.count == 0
+
+    def insert(self,he,site,offset):
+        he.vertex = site
+        he.ystar  = site.y + offset
+        self.serial += 1
+        he.qnext = self.serial
+        heapq.heappush(self.heap, (he.ystar, site.x, -self.serial, he))
+        self.count += 1
+
+    def delete(self,he):
+        if (he.vertex is not None and he.qnext is not None):
+            self.count -= 1
+            he.vertex = None
+            he.qnext = None
+
+    def prune(self):
+        # drop the deleted entries from the top of the heap
+        heap = self.heap
+        while heap:
+            ystar, x, serial, he = heap[0]
+            if he.qnext == -serial and he.vertex is not None:
+                return
+            heapq.heappop(heap)
+
+    def getMinPt(self):
+        self.prune()
+        ystar, x, serial, he = self.heap[0]
+        return Site(x,ystar)
+
+    def popMinHalfedge(self):
+        self.prune()
+        curr = heapq.heappop(self.heap)[3]
+        curr.qnext = None
+        self.count -= 1
+        return curr
+
+
+# The event queues that can be used by voronoi()
+EVENT_QUEUES = OrderedDict([('heap', HeapPriorityQueue), ('bucket', PriorityQueue)])
+
+
 #------------------------------------------------------------------
 class SiteList(object):
-    def __init__(self,pointList):
-        self.__sites = []
+    # origin is subtracted from the coordinates of the points
+    def __init__(self,pointList,origin=(0.0,0.0)):
+        self.__sites = [Site(pt.x-origin[0],pt.y-origin[1],i) for i,pt in enumerate(pointList)]
         self.__sitenum = 0
 
-        self.__xmin = pointList[0].x
-        self.__ymin = pointList[0].y
-        self.__xmax = pointList[0].x
-        self.__ymax = pointList[0].y
-        for i,pt in enumerate(pointList):
-            self.__sites.append(Site(pt.x,pt.y,i))
-            if pt.x < self.__xmin: self.__xmin = pt.x
-            if pt.y < self.__ymin: self.__ymin = pt.y
-            if pt.x > self.__xmax: self.__xmax = pt.x
-            if pt.y > self.__ymax: self.__ymax = pt.y
-        self.__sites.sort()
+        xs = [site.x for site in self.__sites]
+        ys = [site.y for site in self.__sites]
+        self.__xmin = min(xs)
+        self.__ymin = min(ys)
+        self.__xmax = max(xs)
+        self.__ymax = max(ys)
+        self.__sites.sort(key=operator.attrgetter('y', 'x'))
 
     def setSiteNumber(self,site):
         site.sitenum = self.__sitenum
         self.__sitenum += 1
 
-    class Iterator(object):
-        def __init__(this,lst):  this.generator = (s for s in lst)
-        def __iter__(this):      return this
-        def next(this):
-            try:
-                return this.generator.next()
-            except StopIteration:
-                return None
-
+    # the sites by increasing y, then x (next(iterator, None) gives None after the last one)
     def iterator(self):
-        return SiteList.Iterator(self.__sites)
+        return iter(self.__sites)
 
     def __iter__(self):
-        return SiteList.Iterator(self.__sites)
+        return iter(self.__sites)
 
     def __len__(self):
         return len(self.__sites)
@@ -756,17 +829,60 @@ def computeVoronoiDiagram(points):
     return (context.vertices,context.lines,context.edges)
 
 #------------------------------------------------------------------
-def computeDelaunayTriangulation(points):
-    """ Takes a list of point objects (which must have x and y fields).
-        Returns a list of 3-tuples: the indices of the points that form a
-        Delaunay triangle.
+# Delaunay triangulation backends
+#
+# A backend is a function that takes a list of point objects (which must
+# have x and y fields) and returns a list of 3-tuples of indices in this
+# list. Backends are registered by order of preference.
+
+DELAUNAY_BACKENDS = OrderedDict()
+
+def registerDelaunayBackend(name, function):
+    DELAUNAY_BACKENDS[name] = function
+
+def delaunayFortune(points, queue='heap'):
+    """ Fortune's sweep, in pure Python (always available).
+        queue is the name of one of the EVENT_QUEUES.
+        The sites are translated close to the origin, so that the bisectors
+        are precise with projected coordinates.
     """
-    siteList = SiteList(points)
+    siteList = SiteList(points, localOrigin([(p.x, p.y) for p in points]))
     context  = Context()
     context.triangulate = True
-    voronoi(siteList,context)
+    voronoi(siteList,context,queue)
     return context.triangles
 
+def delaunayScipy(points):
+    """ Qhull's triangulation through scipy.spatial.Delaunay.
+        Falls back to Fortune's sweep for degenerate inputs (e.g. collinear points) that Qhull rejects.
+    """
+    if len(points) < 3:
+        return []
+    coords = numpy.array([(p.x, p.y) for p in points], dtype=numpy.float64)
+    coords -= localOrigin(coords)
+    try:
+        simplices = scipy.spatial.Delaunay(coords).simplices
+    except (RuntimeError, ValueError):
+        return delaunayFortune(points)
+    return [(int(a), int(b), int(c)) for a, b, c in simplices]
+
+if scipy is not None:
+    registerDelaunayBackend('scipy', delaunayScipy)
+registerDelaunayBackend('fortune', delaunayFortune)
+
+#------------------------------------------------------------------
+def computeDelaunayTriangulation(points, backend=None):
+    """ Takes a list of point objects (which must have x and y fields).
+        Returns a list of 3-tuples: the indices of the points that form a
+        Delaunay triangle.
+
+        backend is the name of one of the DELAUNAY_BACKENDS, by default the
+        first registered one.
+    """
+    if backend is None:
+        backend = next(iter(DELAUNAY_BACKENDS))
+    return DELAUNAY_BACKENDS[backend](points)
+
 #-----------------------------------------------------------------------------
 if __name__=="__main__":
     try:
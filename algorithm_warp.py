@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process triangle mesh warping.
+
+Every destination pixel is assigned to the mesh triangle (in pointsB) that contains its center. The barycentric
+mapping of this triangle (an affine transformation) gives back the location of the pixel in the source raster
+(in pointsA), where it is resampled.
+
+This module only depends on numpy and GDAL, so that it can be used outside of QGIS (and in worker processes).
+"""
+
+import numpy
+import osgeo.gdal, osgeo.gdal_array
+
+import algorithm_resampling as resampling
+from algorithm_rasterize import rasterizeTriangles
+
+
+def mapToPixel(points, geotransform):
+    """
+    Converts map coordinates to continuous pixel coordinates.
+
+    Input
+    points: (N,2) array of map coordinates
+    geotransform: GDAL geotransform (rotation terms are ignored)
+
+    Returns a (N,2) float64 array where (0,0) is the top-left corner of the top-left pixel
+    """
+    points = numpy.asarray(points, dtype=numpy.float64)
+    pixels = numpy.empty(points.shape, dtype=numpy.float64)
+    pixels[:,0] = (points[:,0] - geotransform[0]) / geotransform[1]
+    pixels[:,1] = (points[:,1] - geotransform[3]) / geotransform[5]
+    return pixels
+
+
+def computeInverseAffines(pixelsA, pixelsB, triangles):
+    """
+    Computes for each triangle the affine transformation mapping destination pixels to source pixels.
+
+    Input
+    pixelsA: (N,2) array of the source points in pixel coordinates
+    pixelsB: (N,2) array of the destination points in pixel coordinates
+    triangles: (M,3) array of point indices
+
+    Returns a (M,2,3) float64 array, such that source = affines[t].dot( [x,y,1] ).
+    Degenerate (flat) destination triangles get NaN coefficients.
+    """
+    triangles = numpy.asarray(triangles, dtype=numpy.intp).reshape(-1,3)
+    a = pixelsA[triangles] # (M,3,2)
+    b = pixelsB[triangles] # (M,3,2)
+
+    # We express the transformation relative to the first vertex, so that we only have to invert a 2x2 matrix
+    db1 = b[:,1] - b[:,0]
+    db2 = b[:,2] - b[:,0]
+    da1 = a[:,1] - a[:,0]
+    da2 = a[:,2] - a[:,0]
+
+    det = db1[:,0]*db2[:,1] - db1[:,1]*db2[:,0]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        invDet = numpy.where(det != 0.0, 1.0 / det, numpy.nan)
+
+    # Inverse of the destination basis [db1 db2]
+    i00 =  db2[:,1] * invDet
+    i01 = -db2[:,0] * invDet
+    i10 = -db1[:,1] * invDet
+    i11 =  db1[:,0] * invDet
+
+    affines = numpy.empty((len(triangles),2,3), dtype=numpy.float64)
+    for k in range(2):
+        affines[:,k,0] = da1[:,k]*i00 + da2[:,k]*i10
+        affines[:,k,1] = da1[:,k]*i01 + da2[:,k]*i11
+        affines[:,k,2] = a[:,0,k] - affines[:,k,0]*b[:,0,0] - affines[:,k,1]*b[:,0,1]
+    return affines
+
+
+def destinationWindow(pixelsB, triangles, xSize, ySize):
+    """
+    Returns the pixel window (xoff, yoff, xsize, ysize) of the raster that is covered by the triangles,
+    or None if the triangles don't cover any pixel of the raster.
+    """
+    triangles = numpy.asarray(triangles, dtype=numpy.intp).reshape(-1,3)
+    if len(triangles) == 0:
+        return None
+    used = pixelsB[numpy.unique(triangles)]
+    xMin = max(int(numpy.floor(used[:,0].min())), 0)
+    yMin = max(int(numpy.floor(used[:,1].min())), 0)
+    xMax = min(int(numpy.ceil(used[:,0].max())), xSize)
+    yMax = min(int(numpy.ceil(used[:,1].max())), ySize)
+    if xMax <= xMin or yMax <= yMin:
+        return None
+    return (xMin, yMin, xMax-xMin, yMax-yMin)
+
+
+def windowsUnion(windows):
+    """
+    Returns the smallest window containing all the given windows (None values are ignored), or None
+    """
+    windows = [w for w in windows if w is not None]
+    if len(windows) == 0:
+        return None
+    xMin = min(w[0] for w in windows)
+    yMin = min(w[1] for w in windows)
+    xMax = max(w[0]+w[2] for w in windows)
+    yMax = max(w[1]+w[3] for w in windows)
+    return (xMin, yMin, xMax-xMin, yMax-yMin)
+
+
+def tileWindows(window, tileWidth, tileHeight):
+    """
+    Splits a window (xoff, yoff, xsize, ysize) into tiles aligned on a grid of tileWidth x tileHeight pixels
+    (starting at the top-left corner of the raster), so that tiles match the blocks of the raster.
+
+    Returns a list of windows, row by row
+    """
+    xoff, yoff, width, height = window
+    tiles = []
+    for tileY in range( (yoff//tileHeight)*tileHeight, yoff+height, tileHeight ):
+        y0 = max(tileY, yoff)
+        y1 = min(tileY+tileHeight, yoff+height)
+        for tileX in range( (xoff//tileWidth)*tileWidth, xoff+width, tileWidth ):
+            x0 = max(tileX, xoff)
+            x1 = min(tileX+tileWidth, xoff+width)
+            tiles.append( (x0, y0, x1-x0, y1-y0) )
+    return tiles
+
+
+def diffMeshes(oldPointsA, oldPointsB, oldTriangles, pointsA, pointsB, triangles):
+    """
+    Compares two meshes triangle by triangle, using the coordinates of their vertices.
+
+    Input
+    oldPointsA, oldPointsB, oldTriangles: the previous mesh
+    pointsA, pointsB, triangles: the new mesh
+
+    Returns (dirty, removed) : the indices of the triangles of the new mesh that must be warped again (the
+    ones that are not in the previous mesh and their neighbours) and the indices of the triangles of the
+    previous mesh that are not in the new mesh anymore
+    """
+    def triangleKeys(pA, pB, tris):
+        coords = [tuple(c) for c in numpy.hstack( (pA, pB) ).tolist()]
+        return [tuple(sorted(coords[i] for i in tri)) for tri in numpy.asarray(tris).reshape(-1,3).tolist()]
+
+    oldKeys = triangleKeys(oldPointsA, oldPointsB, oldTriangles)
+    newKeys = triangleKeys(pointsA, pointsB, triangles)
+    oldSet = set(oldKeys)
+    newSet = set(newKeys)
+
+    changed = [key not in oldSet for key in newKeys]
+    removed = [i for i, key in enumerate(oldKeys) if key not in newSet]
+
+    # The destination vertices of the changed triangles, so that we can find their neighbours
+    touched = set()
+    for key in [k for k, c in zip(newKeys, changed) if c] + [oldKeys[i] for i in removed]:
+        for vertex in key:
+            touched.add(vertex[2:])
+
+    dirty = [i for i, key in enumerate(newKeys) if changed[i] or any(vertex[2:] in touched for vertex in key)]
+
+    return numpy.array(dirty, dtype=numpy.intp), numpy.array(removed, dtype=numpy.intp)
+
+
+def triangleBounds(pixelsB, triangles):
+    """
+    Returns a (M,4) array with the xMin, yMin, xMax, yMax of each triangle in pixel coordinates
+    """
+    triangles = numpy.asarray(triangles, dtype=numpy.intp).reshape(-1,3)
+    p = pixelsB[triangles]
+    return numpy.column_stack( (p[:,:,0].min(axis=1), p[:,:,1].min(axis=1), p[:,:,0].max(axis=1), p[:,:,1].max(axis=1)) )
+
+
+def trianglesInWindow(bounds, xoff, yoff, width, height):
+    """
+    Returns the indices of the triangles whose bounds (as returned by triangleBounds) overlap a window
+    """
+    overlap = ( (bounds[:,0] < xoff+width) & (bounds[:,2] > xoff) &
+                (bounds[:,1] < yoff+height) & (bounds[:,3] > yoff) )
+    return numpy.nonzero(overlap)[0]
+
+
+def inverseMap(ids, affines, xoff, yoff):
+    """
+    Maps the pixels of a window to the source raster.
+
+    Input
+    ids: (height,width) array of triangle indices as returned by rasterizeTriangles
+    affines: (M,2,3) array as returned by computeInverseAffines
+    xoff, yoff: offset of the window
+
+    Returns (rows, cols, srcX, srcY) where rows and cols are the indices of the mapped pixels in the window
+    and srcX, srcY their continuous pixel coordinates in the source raster
+    """
+    rows, cols = numpy.nonzero(ids >= 0)
+    tris = ids[rows, cols]
+    x = cols + (xoff + 0.5)
+    y = rows + (yoff + 0.5)
+    m = affines[tris]
+    srcX = m[:,0,0]*x + m[:,0,1]*y + m[:,0,2]
+    srcY = m[:,1,0]*x + m[:,1,1]*y + m[:,1,2]
+    return rows, cols, srcX, srcY
+
+
+def sourceWindow(srcX, srcY, margin, xSize, ySize):
+    """
+    Returns the window (xoff, yoff, xsize, ysize) of the source raster needed to resample the given
+    source coordinates with a kernel of the given margin (in pixels), or None if it's outside of the raster.
+    """
+    if len(srcX) == 0:
+        return None
+    xMin = max(int(numpy.floor(numpy.nanmin(srcX))) - margin, 0)
+    yMin = max(int(numpy.floor(numpy.nanmin(srcY))) - margin, 0)
+    xMax = min(int(numpy.ceil(numpy.nanmax(srcX))) + margin, xSize)
+    yMax = min(int(numpy.ceil(numpy.nanmax(srcY))) + margin, ySize)
+    if xMax <= xMin or yMax <= yMin:
+        return None
+    return (xMin, yMin, xMax-xMin, yMax-yMin)
+
+
+def sourceScales(ids, affines, rows, cols):
+    """
+    Returns the size of each mapped destination pixel, measured in source pixels (used by the average and mode
+    resampling methods)
+    """
+    m = affines[ids[rows, cols]]
+    scaleX = numpy.hypot(m[:,0,0], m[:,1,0])
+    scaleY = numpy.hypot(m[:,0,1], m[:,1,1])
+    return scaleX, scaleY
+
+
+def warpBands(readWindow, ids, affines, xoff, yoff, width, height, xSize, ySize, method, destination, noData=None):
+    """
+    Warps the bands of a destination window in place.
+
+    Input
+    readWindow: function(xoff, yoff, xsize, ysize) returning the source data for a window as a (bands,rows,cols) array (or a 2D array for a single band)
+    ids: (height,width) array of triangle indices as returned by rasterizeTriangles
+    affines: (M,2,3) array as returned by computeInverseAffines
+    xoff, yoff, width, height: the destination window
+    xSize, ySize: size of the source raster
+    method: one of the resampling.METHODS
+    destination: (bands,height,width) (or (height,width)) array that receives the warped pixels (pixels that are not in the mesh are left untouched)
+    noData: no data value (or sequence of values per band), used for pixels that map outside of the source raster
+    """
+    rows, cols, srcX, srcY = inverseMap(ids, affines, xoff, yoff)
+    if len(rows) == 0:
+        return
+
+    scaleX, scaleY = None, None
+    if method in ('average', 'mode'):
+        scaleX, scaleY = sourceScales(ids, affines, rows, cols)
+
+    resampleBands(readWindow, rows, cols, srcX, srcY, scaleX, scaleY, xSize, ySize, method, destination, noData)
+
+
+def resampleBands(readWindow, rows, cols, srcX, srcY, scaleX, scaleY, xSize, ySize, method, destination, noData=None):
+    """
+    Resamples the bands of the source raster at the given locations.
+
+    Input
+    readWindow: function(xoff, yoff, xsize, ysize) returning the source data for a window as a (bands,rows,cols) array (or a 2D array for a single band)
+    rows, cols: indices of the pixels to compute in the destination array
+    srcX, srcY: their continuous pixel coordinates in the source raster
+    scaleX, scaleY: size of the destination pixels in source pixels (only needed for average and mode)
+    xSize, ySize: size of the source raster
+    method: one of the resampling.METHODS
+    destination: (bands,rows,cols) (or 2D) array that receives the resampled pixels, in the dtype of the source
+    noData: no data value (or sequence of values per band), used for pixels that map outside of the source raster
+    """
+    flat = destination.ndim == 2
+    if flat:
+        destination = destination[numpy.newaxis]
+    bands = len(destination)
+
+    if noData is None or numpy.isscalar(noData):
+        noData = [noData] * bands
+    fill = numpy.array([value if value is not None else 0 for value in noData]).astype(destination.dtype)[:,numpy.newaxis]
+
+    window = sourceWindow(srcX, srcY, resampling.margin(method), xSize, ySize)
+    if window is None:
+        destination[:, rows, cols] = fill
+        return
+
+    data = readWindow(*window).reshape((bands, window[3], window[2]))
+
+    # Continuous pixel coordinates to array indices (relative to pixel centers in the read window)
+    u = srcX - (window[0] + 0.5)
+    v = srcY - (window[1] + 0.5)
+
+    values, valid = resampling.resample(data, u, v, method, scaleX, scaleY, noData)
+
+    # Pixels whose center falls outside of the source raster get no data
+    inside = (srcX >= 0) & (srcY >= 0) & (srcX <= xSize) & (srcY <= ySize)
+    valid &= inside
+
+    destination[:, rows, cols] = numpy.where(valid, values, fill)
+
+
+def bandGroups(dataset):
+    """
+    Returns the bands of a dataset grouped by data type, as a list of (band numbers, numpy dtype, no data values), so
+    that the bands of a group can be resampled at once
+    """
+    groups = []
+    for b in range(1, dataset.RasterCount+1):
+        band = dataset.GetRasterBand(b)
+        dtype = numpy.dtype(osgeo.gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+        if len(groups) == 0 or groups[-1][1] != dtype:
+            groups.append(([], dtype, []))
+        groups[-1][0].append(b)
+        groups[-1][2].append(band.GetNoDataValue())
+    return groups
+
+
+def readBands(dataset, bandNumbers, dtype, counter=None):
+    """
+    Returns a function reading a window of some bands of a dataset as a (bands,rows,cols) array.
+    If counter is a list, the number of bytes read is added to its first item.
+    """
+    bands = [dataset.GetRasterBand(b) for b in bandNumbers]
+    def readWindow(xoff, yoff, width, height):
+        data = numpy.empty((len(bands), height, width), dtype=dtype)
+        for i, band in enumerate(bands):
+            data[i] = band.ReadAsArray(xoff, yoff, width, height)
+        if counter is not None:
+            counter[0] += data.nbytes
+        return data
+    return readWindow
+
+
+def tileMesh(pixelsB, triangles, affines, subset):
+    """
+    Extracts the triangles of a tile as a standalone mesh, so that it can be sent to another process.
+
+    Returns (pixelsB, triangles, affines) where each triangle has its own three points
+    """
+    triangles = numpy.asarray(triangles, dtype=numpy.intp).reshape(-1,3)
+    tilePixels = pixelsB[triangles[subset]].reshape(-1,2)
+    tileTriangles = numpy.arange(len(tilePixels), dtype=numpy.int32).reshape(-1,3)
+    return tilePixels, tileTriangles, affines[subset]
+
+
+def warpTile(dsSource, tile, pixelsB, triangles, affines, method):
+    """
+    Warps all the bands of a destination tile.
+
+    Input
+    dsSource: the source GDAL dataset
+    tile: the destination window (xoff, yoff, xsize, ysize)
+    pixelsB, triangles, affines: the mesh (or the part of the mesh overlapping the tile, see tileMesh)
+    method: one of the resampling.METHODS
+
+    Returns (tile, owned, bands, bytesRead) where owned is a (ysize,xsize) boolean array of the pixels covered by the mesh,
+    bands a list of (ysize,xsize) arrays whose values are only meaningful where owned is True and bytesRead the
+    number of bytes read from the source
+    """
+    xoff, yoff, width, height = tile
+    ids = rasterizeTriangles(pixelsB, triangles, xoff, yoff, width, height)
+    owned = ids >= 0
+    bands = []
+    bytesRead = [0]
+    if owned.any():
+        bands = [None] * dsSource.RasterCount
+        for bandNumbers, dtype, noData in bandGroups(dsSource):
+            data = numpy.zeros((len(bandNumbers),height,width), dtype=dtype)
+            warpBands(readBands(dsSource, bandNumbers, dtype, bytesRead), ids, affines, xoff, yoff, width, height,
+                      dsSource.RasterXSize, dsSource.RasterYSize, method, data, noData)
+            for b, bandData in zip(bandNumbers, data):
+                bands[b-1] = bandData
+    return tile, owned, bands, bytesRead[0]
+
+
+# Datasets opened by the tasks, kept open by the worker process while it works on them
+_datasets = {}
+# Maximum number of datasets kept open (when a pool is shared by many rasters, see RasterBenderBatch)
+MAX_OPEN_DATASETS = 4
+
+def openDataset(path):
+    """
+    Returns a read-only dataset, opened once per worker process
+    """
+    if path not in _datasets:
+        if len(_datasets) >= MAX_OPEN_DATASETS:
+            _datasets.clear()
+        osgeo.gdal.UseExceptions()
+        _datasets[path] = osgeo.gdal.Open(path, osgeo.gdal.GA_ReadOnly)
+    return _datasets[path]
+
+def warpTileTask(args):
+    """
+    Entry point of the worker processes : warpTile for a (sourcePath, tile, pixelsB, triangles, affines, method) tuple.
+    """
+    sourcePath, tile, pixelsB, triangles, affines, method = args
+    return warpTile(openDataset(sourcePath), tile, pixelsB, triangles, affines, method)
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ RasterBender
+                                 A QGIS plugin
+ Deforms vector to adapt them despite heavy and irregular deformations
+                              -------------------
+        begin                : 2014-05-21
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Benchmarks of the triangulation, the constraints and the warping on synthetic data, without QGIS.
+
+    python benchmark.py                                    (all the stages with the default sizes)
+    python benchmark.py --stages delaunay constraints --sizes 1000 100000 --output before.json
+    python benchmark.py --stages delaunay --backends fortune --sizes 10000 100000 --output fortune.json
+    python benchmark.py --stages delaunay --backends fortune --queues heap bucket   (the event queues of the sweep)
+    python benchmark.py --stages locate --distributions random road   (point location walks in scanline order)
+    python benchmark.py --stages warp --rasters 2048x2048:uint8:3 8192x8192:float32:1 --modes memory tiled
+    python benchmark.py --compare before.json after.json
+
+Each case runs in its own process, so that its peak memory can be measured. The results are written as JSON
+(one record per case with its duration, throughput and peak memory) so that versions can be compared.
+"""
+
+import os.path
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+
+import numpy
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+
+STAGES = ('delaunay', 'constraints', 'locate', 'rasterize', 'warp')
+DISTRIBUTIONS = ('random', 'grid', 'clustered', 'road')
+SIZES = (100, 1000, 10000, 100000)
+RASTERS = ('1024x1024:uint8:3', '4096x4096:uint8:3', '2048x2048:int16:1', '2048x2048:float32:1')
+MODES = ('memory', 'tiled')
+
+# Largest number of points triangulated with each Delaunay backend (the pure python sweep is too slow beyond)
+BACKEND_LIMITS = {'fortune': 100000}
+
+
+#------------------------------------------------------------------
+# Synthetic data
+
+def syntheticPoints(distribution, count, width=1000.0, height=1000.0, seed=0):
+    """
+    Returns a (count,2) array of points in [0,width]x[0,height]
+
+    distribution is 'random' (uniform), 'grid' (jittered grid), 'clustered' (gaussian clusters) or 'road'
+    (thin bands, like pairs digitized along roads or rivers)
+    """
+    rng = numpy.random.RandomState(seed)
+    if distribution == 'random':
+        points = rng.uniform(0.0, 1.0, (count,2))
+    elif distribution == 'grid':
+        side = int(numpy.ceil(numpy.sqrt(count)))
+        cols, rows = numpy.meshgrid(numpy.arange(side), numpy.arange(side))
+        points = numpy.column_stack( (cols.ravel(), rows.ravel()) )[:count] + 0.5
+        points = (points + rng.uniform(-0.3, 0.3, points.shape)) / side
+    elif distribution == 'clustered':
+        clusters = max(1, count // 200)
+        centers = rng.uniform(0.1, 0.9, (clusters,2))
+        spread = rng.uniform(0.01, 0.08, clusters)
+        members = rng.randint(0, clusters, count)
+        points = numpy.clip( centers[members] + rng.normal(0.0, 1.0, (count,2)) * spread[members,numpy.newaxis], 0.0, 1.0 )
+    elif distribution == 'road':
+        roads = max(1, count // 5000)
+        members = rng.randint(0, roads, count)
+        x = rng.uniform(0.0, 1.0, count)
+        y = rng.uniform(0.1, 0.9, roads)[members] + 0.02 * numpy.sin(20.0 * x + members) + rng.normal(0.0, 0.001, count)
+        points = numpy.column_stack( (x, numpy.clip(y, 0.0, 1.0)) )
+    else:
+        raise ValueError("Unknown distribution : %s" % distribution)
+    points = numpy.round(points * [width, height], 6)
+    # Duplicate points are not valid pairs
+    order = numpy.lexsort( (points[:,1], points[:,0]) )
+    duplicate = numpy.zeros(len(points), dtype=bool)
+    duplicate[order[1:]] = (points[order[1:]] == points[order[:-1]]).all(axis=1)
+    return points[~duplicate]
+
+
+def syntheticDisplacement(pointsA, width=1000.0, height=1000.0, amplitude=0.01):
+    """
+    Returns the pointsB of the pairs : pointsA moved by a smooth field of about amplitude * size
+    """
+    x = pointsA[:,0] / width
+    y = pointsA[:,1] / height
+    dx = numpy.sin(2.0*numpy.pi*y) * numpy.cos(numpy.pi*x) * amplitude * width
+    dy = numpy.sin(2.0*numpy.pi*x) * numpy.cos(numpy.pi*y) * amplitude * height
+    return pointsA + numpy.column_stack( (dx, dy) )
+
+
+def syntheticConstraints(points, count=None, vertices=8, seed=0):
+    """
+    Returns constraints as lists of point indices. Each constraint is a ring of points of its own horizontal band,
+    ordered by angle around their center so that the ring (closed by its last to first segment, as
+    computeConstrainedDelaunayTriangulation does) doesn't cross itself, and constraints never cross each other.
+    """
+    rng = numpy.random.RandomState(seed)
+    if count is None:
+        count = max(1, int(numpy.sqrt(len(points))) // 2)
+    yMin, yMax = points[:,1].min(), points[:,1].max()
+    edges = numpy.linspace(yMin, yMax, 2*count+1)
+    constraints = []
+    for i in range(count):
+        # Every other band, so that chains are not adjacent
+        inBand = numpy.nonzero( (points[:,1] >= edges[2*i]) & (points[:,1] < edges[2*i+1]) )[0]
+        if len(inBand) < 2:
+            continue
+        chosen = rng.choice(inBand, min(vertices, len(inBand)), replace=False)
+        center = points[chosen].mean(axis=0)
+        chosen = chosen[ numpy.argsort(numpy.arctan2(points[chosen,1]-center[1], points[chosen,0]-center[0])) ]
+        constraints.append( [int(p) for p in chosen] )
+    return constraints
+
+
+def parseRaster(spec):
+    """
+    Returns (width, height, dtype name, bands) from a WIDTHxHEIGHT:DTYPE:BANDS string
+    """
+    size, dtype, bands = spec.split(':')
+    width, height = size.lower().split('x')
+    return int(width), int(height), dtype, int(bands)
+
+
+def syntheticRaster(path, width, height, dtype, bands, seed=0):
+    """
+    Writes a tiled GeoTIFF with a smooth pattern and some noise, where 1 pixel = 1 map unit
+    """
+    import osgeo.gdal, osgeo.gdal_array
+    osgeo.gdal.UseExceptions()
+    gdalType = osgeo.gdal_array.NumericTypeCodeToGDALTypeCode(numpy.dtype(dtype).type)
+    ds = osgeo.gdal.GetDriverByName('GTiff').Create( path, width, height, bands, gdalType, ['TILED=YES'] )
+    ds.SetGeoTransform( (0.0, 1.0, 0.0, float(height), 0.0, -1.0) )
+    rng = numpy.random.RandomState(seed)
+    x = numpy.arange(width)
+    for b in range(1, bands+1):
+        band = ds.GetRasterBand(b)
+        # Written by strips, so that big rasters don't need to fit in memory
+        for yoff in range(0, height, 512):
+            y = numpy.arange(yoff, min(yoff+512, height))[:,numpy.newaxis]
+            values = 100.0 + 60.0*numpy.sin(x/(37.0+b)) * numpy.cos(y/53.0) + rng.normal(0.0, 10.0, (len(y), width))
+            band.WriteArray( values.astype(dtype), 0, yoff )
+    ds = None
+
+
+#------------------------------------------------------------------
+# Cases, each one runs in its own process
+
+def peakMemory():
+    """
+    Returns the peak resident memory of this process in bytes, or None if it can't be measured
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024 # bytes on macOS, kilobytes on Linux
+
+
+def timed(function, repeat):
+    """
+    Returns (best duration in seconds, result of the last call)
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+def runDelaunay(case):
+    import algorithm_voronoi as voronoi
+    points = syntheticPoints(case['distribution'], case['points'])
+    sites = [voronoi.Site(x, y) for x, y in points]
+    if 'queue' in case:
+        duration, triangles = timed( lambda: voronoi.delaunayFortune(sites, case['queue']), case['repeat'] )
+    else:
+        duration, triangles = timed( lambda: voronoi.computeDelaunayTriangulation(sites, case['backend']), case['repeat'] )
+    return {'seconds': duration, 'triangles': len(triangles), 'throughput': len(points) / duration, 'unit': 'points/s'}
+
+
+def runConstraints(case):
+    import algorithm_constrained_delaunay as algDelaunay
+    from rasterbenderstats import RunStats
+    points = syntheticPoints(case['distribution'], case['points'])
+    constraints = syntheticConstraints(points)
+    # Each linestring is closed by a segment from its last point to its first one
+    segments = sum(len(c) for c in constraints)
+    total = enforcement = None
+    for i in range(case['repeat']):
+        # The constrained triangulation starts with an unconstrained one : the insertion of the constraints is timed on its own
+        stats = RunStats()
+        start = time.time()
+        triangles = algDelaunay.computeConstrainedDelaunayTriangulation(points, constraints, stats, case['backend'])
+        duration = time.time() - start
+        total = duration if total is None else min(total, duration)
+        seconds = stats.stages.get('constraints', 0.0)
+        enforcement = seconds if enforcement is None else min(enforcement, seconds)
+    skipped = stats.counters.get('constraintsSkipped', 0)
+    inserted = segments - skipped
+    return {'seconds': total, 'enforcementSeconds': enforcement, 'constraints': len(constraints), 'segments': segments,
+            'segmentsSkipped': skipped, 'triangles': len(triangles),
+            'throughput': inserted / enforcement if enforcement > 0 else 0.0, 'unit': 'constraint segments/s'}
+
+
+def runLocate(case):
+    import algorithm_voronoi as voronoi
+    from algorithm_trianglemesh import TriangleMesh
+    points = syntheticPoints(case['distribution'], case['points'])
+    triangles = voronoi.computeDelaunayTriangulation([voronoi.Site(x, y) for x, y in points])
+    build, mesh = timed( lambda: TriangleMesh(points, triangles), case['repeat'] )
+    # The queries are the centers of a grid of 256x256 pixels over the mesh, in scanline order
+    (xMin, yMin), (xMax, yMax) = points.min(axis=0), points.max(axis=0)
+    xs, ys = numpy.meshgrid( numpy.linspace(xMin, xMax, 256), numpy.linspace(yMax, yMin, 256) )
+    queries = numpy.column_stack( (xs.ravel(), ys.ravel()) )
+    mesh.steps = 0
+    duration, ids = timed( lambda: mesh.locatePoints(queries), case['repeat'] )
+    return {'seconds': duration, 'buildSeconds': build, 'triangles': len(mesh), 'stepsPerQuery': mesh.steps / float(len(queries) * case['repeat']),
+            'throughput': len(queries) / duration, 'unit': 'queries/s'}
+
+
+def meshForRaster(width, height, points, distribution='grid'):
+    """
+    Returns (triangles, pointsA, pointsB) covering a raster where 1 pixel = 1 map unit
+    """
+    import algorithm_voronoi as voronoi
+    pointsA = syntheticPoints(distribution, points, width, height)
+    pointsB = syntheticDisplacement(pointsA, width, height)
+    triangles = numpy.array( voronoi.computeDelaunayTriangulation([voronoi.Site(x, y) for x, y in pointsA]), dtype=numpy.int32 ).reshape(-1,3)
+    return triangles, pointsA, pointsB
+
+
+def runRasterize(case):
+    from algorithm_rasterize import rasterizeTriangles
+    width, height, dtype, bands = parseRaster(case['raster'])
+    triangles, pointsA, pointsB = meshForRaster(width, height, case['points'], case['distribution'])
+    pixels = numpy.column_stack( (pointsB[:,0], height - pointsB[:,1]) )
+    duration, ids = timed( lambda: rasterizeTriangles(pixels, triangles, 0, 0, width, height), case['repeat'] )
+    return {'seconds': duration, 'triangles': len(triangles), 'throughput': width * height / duration / 1e6, 'unit': 'Mpixels/s'}
+
+
+def runWarp(case):
+    from rasterbenderengine import RasterBenderEngine
+    width, height, dtype, bands = parseRaster(case['raster'])
+    triangles, pointsA, pointsB = meshForRaster(width, height, case['points'], case['distribution'])
+
+    directory = tempfile.mkdtemp(prefix='rasterbender-benchmark-')
+    try:
+        sourcePath = os.path.join(directory, 'source.tif')
+        syntheticRaster(sourcePath, width, height, dtype, bands)
+        def run():
+            targetPath = os.path.join(directory, 'target.tif')
+            if os.path.exists(targetPath):
+                os.remove(targetPath)
+            engine = RasterBenderEngine( sourcePath, targetPath, case['method'], tiled=case['mode'] == 'tiled', workers=case['workers'] )
+            return engine.run(triangles, pointsA, pointsB)
+        duration, result = timed( run, case['repeat'] )
+        written = os.path.getsize( os.path.join(directory, 'target.tif') )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    pixels = width * height
+    return {'seconds': duration, 'triangles': len(triangles), 'bytesWritten': written,
+            'throughput': pixels / duration / 1e6, 'unit': 'Mpixels/s'}
+
+
+RUNNERS = {
+    'delaunay': runDelaunay,
+    'constraints': runConstraints,
+    'locate': runLocate,
+    'rasterize': runRasterize,
+    'warp': runWarp,
+}
+
+
+def runCase(case):
+    """
+    Runs a case in this process and returns its record
+    """
+    record = dict(case)
+    baseline = peakMemory()
+    record.update( RUNNERS[case['stage']](case) )
+    record['peakMemory'] = peakMemory()
+    record['baselineMemory'] = baseline # after the imports, before the case
+    return record
+
+
+def runCaseInProcess(case):
+    """
+    Runs a case in a new python process (so that its peak memory is its own) and returns its record
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)]
+    process = subprocess.Popen( command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)) )
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        record = dict(case)
+        record['error'] = errors.decode('utf-8', 'replace').strip().splitlines()[-1:] if errors else 'exit code %i' % process.returncode
+        return record
+    return json.loads( output.decode('utf-8').strip().splitlines()[-1] )
+
+
+#------------------------------------------------------------------
+# Suite
+
+def cases(args):
+    """
+    Yields the cases to run for the command line arguments
+    """
+    import algorithm_voronoi as voronoi
+    for stage in args.stages:
+        if stage == 'delaunay':
+            for backend in (args.backends or list(voronoi.DELAUNAY_BACKENDS)):
+                # The event queue is only a setting of Fortune's sweep
+                queues = (args.queues or list(voronoi.EVENT_QUEUES)[:1]) if backend == 'fortune' else [None]
+                for queue in queues:
+                    for distribution in args.distributions:
+                        for size in args.sizes:
+                            case = {'stage': stage, 'backend': backend, 'distribution': distribution, 'points': size, 'repeat': args.repeat}
+                            if queue is not None:
+                                case['queue'] = queue
+                            yield case
+        elif stage == 'constraints':
+            for backend in (args.backends or list(voronoi.DELAUNAY_BACKENDS)):
+                for distribution in args.distributions:
+                    for size in args.sizes:
+                        yield {'stage': stage, 'backend': backend, 'distribution': distribution, 'points': size, 'repeat': args.repeat}
+        elif stage == 'locate':
+            for distribution in args.distributions:
+                for size in args.sizes:
+                    yield {'stage': stage, 'backend': next(iter(voronoi.DELAUNAY_BACKENDS)), 'distribution': distribution, 'points': size, 'repeat': args.repeat}
+        elif stage == 'rasterize':
+            for raster in args.rasters:
+                yield {'stage': stage, 'raster': raster, 'distribution': 'grid', 'points': args.mesh_points, 'repeat': args.repeat}
+        elif stage == 'warp':
+            for raster in args.rasters:
+                for mode in args.modes:
+                    for method in args.methods:
+                        yield {'stage': stage, 'raster': raster, 'mode': mode, 'method': method, 'workers': args.workers,
+                               'distribution': 'grid', 'points': args.mesh_points, 'repeat': args.repeat}
+
+
+def environment():
+    """
+    Returns the versions of the things that influence the results
+    """
+    info = {'python': platform.python_version(), 'numpy': numpy.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        import osgeo.gdal
+        info['gdal'] = osgeo.gdal.VersionInfo('RELEASE_NAME')
+    except ImportError:
+        info['gdal'] = None
+    try:
+        import scipy
+        info['scipy'] = scipy.__version__
+    except ImportError:
+        info['scipy'] = None
+    # The plugin version
+    metadata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metadata.txt')
+    if os.path.exists(metadata):
+        for line in open(metadata):
+            if line.startswith('version='):
+                info['version'] = line.split('=', 1)[1].strip()
+    return info
+
+
+def describe(record):
+    keys = ('stage', 'backend', 'queue', 'distribution', 'points', 'raster', 'mode', 'method')
+    return ' '.join( '%s=%s' % (key, record[key]) for key in keys if key in record )
+
+
+def caseKey(record):
+    keys = ('stage', 'backend', 'queue', 'distribution', 'points', 'raster', 'mode', 'method', 'workers')
+    return tuple( record.get(key) for key in keys )
+
+
+def compare(beforePath, afterPath):
+    """
+    Prints the speedup and memory ratio of each case found in two result files
+    """
+    before = dict( (caseKey(r), r) for r in json.load(open(beforePath))['results'] if 'seconds' in r )
+    after = dict( (caseKey(r), r) for r in json.load(open(afterPath))['results'] if 'seconds' in r )
+    for key in sorted(set(before) & set(after), key=str):
+        b, a = before[key], after[key]
+        memory = ''
+        if b.get('peakMemory') and a.get('peakMemory'):
+            memory = '  memory x%.2f' % (float(a['peakMemory']) / b['peakMemory'])
+        sys.stdout.write( '%-80s %8.3fs -> %8.3fs  speedup x%.2f%s\n' % (describe(a), b['seconds'], a['seconds'], b['seconds'] / a['seconds'], memory) )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( description="Benchmarks RasterBender's stages on synthetic data." )
+    parser.add_argument( '--stages', nargs='+', choices=STAGES, default=list(STAGES) )
+    parser.add_argument( '--sizes', nargs='+', type=int, default=list(SIZES), help="numbers of points of the meshes" )
+    parser.add_argument( '--distributions', nargs='+', choices=DISTRIBUTIONS, default=list(DISTRIBUTIONS) )
+    parser.add_argument( '--backends', nargs='+', help="Delaunay backends (default : all the available ones)" )
+    parser.add_argument( '--queues', nargs='+', help="event queues of the fortune backend (default : the default one)" )
+    parser.add_argument( '--rasters', nargs='+', default=list(RASTERS), help="rasters as WIDTHxHEIGHT:DTYPE:BANDS" )
+    parser.add_argument( '--modes', nargs='+', choices=MODES, default=list(MODES) )
+    parser.add_argument( '--methods', nargs='+', default=['bilinear'], help="resampling methods" )
+    parser.add_argument( '--workers', type=int, default=1 )
+    parser.add_argument( '--mesh-points', type=int, default=1000, help="number of points of the meshes used to warp" )
+    parser.add_argument( '--repeat', type=int, default=1, help="number of runs of each case (the fastest one is kept)" )
+    parser.add_argument( '--output', help="JSON file to write the results to" )
+    parser.add_argument( '--in-process', action='store_true', help="run all the cases in this process (the peak memory is then cumulative)" )
+    parser.add_argument( '--compare', nargs=2, metavar=('BEFORE','AFTER'), help="compare two result files" )
+    parser.add_argument( '--case', help=argparse.SUPPRESS ) # used by the child processes
+    args = parser.parse_args( argv )
+
+    if args.case is not None:
+        sys.stdout.write( json.dumps(runCase(json.loads(args.case))) + '\n' )
+        return 0
+
+    if args.compare is not None:
+        compare( *args.compare )
+        return 0
+
+    results = []
+    for case in cases(args):
+        limit = BACKEND_LIMITS.get(case.get('backend'))
+        if case['stage'] in ('delaunay', 'constraints') and limit is not None and case['points'] > limit:
+            continue
+        record = runCase(case) if args.in_process else runCaseInProcess(case)
+        results.append( record )
+        if 'error' in record:
+            sys.stderr.write( '%-80s error : %s\n' % (describe(record), record['error']) )
+        else:
+            memory = ' %7.1f MB' % (record['peakMemory'] / 1048576.0) if record.get('peakMemory') else ''
+            sys.stderr.write( '%-80s %8.3fs %12.1f %s%s\n' % (describe(record), record['seconds'], record['throughput'], record['unit'], memory) )
+
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump( report, f, indent=2, sort_keys=True )
+    else:
+        sys.stdout.write( json.dumps(report, indent=2, sort_keys=True) + '\n' )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
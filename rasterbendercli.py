@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ RasterBender
+                                 A QGIS plugin
+ Deforms vector to adapt them despite heavy and irregular deformations
+                              -------------------
+        begin                : 2014-05-21
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Headless entry point : bends rasters without QGIS' interface, from python or from the command line.
+
+    python rasterbendercli.py pairs.geojson source.tif target.tif --constraints constraints.gpkg --buffer 100
+    python rasterbendercli.py pairs.geojson --job scan.tif scan_bent.tif --job mask.tif mask_bent.tif --workers 4
+    python rasterbendercli.py pairs.geojson source.tif target.tif --export-field field.tif --field-step 4
+    python rasterbendercli.py apply-field field.tif other.tif other_bent.tif
+    python rasterbendercli.py pairs.geojson big.tif big_bent.vrt   (only writes the area that moves, in big_bent_overlay.tif)
+    python rasterbendercli.py pairs.geojson source.tif target.tif --profile   (writes target.tif.rasterbender.prof)
+
+The time spent in each stage is written next to each target, in target.tif.rasterbender.json.
+
+The pairs and constraints can be any vector file OGR can read (GeoJSON, GPKG, shapefile, CSV with a WKT column...).
+QGIS' python libraries must be importable (set QGIS_PREFIX_PATH if QGIS is not installed in /usr).
+"""
+
+import os.path
+import sys
+import argparse
+
+from qgis.core import *
+
+# Other classes
+import triangulate
+from rasterbenderengine import RasterBenderEngine, RasterBenderBatch
+from rasterbenderstats import RunStats, profiled
+from algorithm_resampling import METHODS
+
+
+# The QgsApplication created by initQgis (if we are not running inside QGIS)
+application = None
+
+def initQgis():
+    """
+    Initializes QGIS without a graphical interface, unless it is already running
+    """
+    global application
+    if QgsApplication.instance() is not None:
+        return
+    QgsApplication.setPrefixPath( os.environ.get('QGIS_PREFIX_PATH', '/usr'), True )
+    application = QgsApplication( [], False )
+    application.initQgis()
+
+
+def loadLayer(path, name):
+    """
+    Returns a vector layer read by OGR, raising a ValueError if it can't be read
+    """
+    layer = QgsVectorLayer( path, name, 'ogr' )
+    if not layer.isValid():
+        raise ValueError( "Could not read the %s layer : %s" % (name, path) )
+    return layer
+
+
+def loadMesh(pairsPath, constraintsPath=None, bufferValue=0.0, log=None, stats=None):
+    """
+    Triangulates the pairs (and constraints) stored in vector files.
+
+    Returns (triangles, pointsA, pointsB), see triangulate.triangulate
+    """
+    initQgis()
+
+    pairsLayer = loadLayer( pairsPath, 'pairs' )
+    constraintsLayer = loadLayer( constraintsPath, 'constraints' ) if constraintsPath else None
+
+    triangles, pointsA, pointsB, hull, constraints, snapDistances = triangulate.triangulate( pairsLayer, False, constraintsLayer, False, bufferValue, cache=None, stats=stats )
+
+    for i, distances in enumerate(snapDistances):
+        if len(distances) > 0 and max(distances) > 0:
+            message = 'Constraint {} is not snapped on the pairs (distances : {})'.format(i, distances)
+            if log is not None:
+                log( message, False )
+            else:
+                sys.stderr.write( message + '\n' )
+
+    return (triangles, pointsA, pointsB)
+
+
+def bend(pairsPath, sourcePath, targetPath, constraintsPath=None, bufferValue=0.0, samplingMethod='bilinear', tiled=False, workers=1, incremental=False, debug=False, progress=None, log=None, fieldPath=None, fieldStep=1, profile=False):
+    """
+    Bends a raster according to the pairs (and constraints) stored in vector files.
+
+    Input
+    pairsPath: path of the linestring layer of the pairs
+    sourcePath, targetPath: paths of the raster to bend and of the result
+    constraintsPath: path of the linestring layer of the constraints (optional)
+    bufferValue: size of the buffer around the triangulation, in map units
+    samplingMethod: one of algorithm_resampling.METHODS
+    tiled, workers, incremental: see RasterBenderEngine
+    progress, log: callbacks, see RasterBenderEngine
+    fieldPath, fieldStep: if fieldPath is given, the displacement field is also written there (see applyField)
+    profile: if True, the run is captured with cProfile next to the target (see RasterBenderEngine.profilePath)
+
+    Returns the statistics of the run (see RunStats.report), that are also written next to the target
+
+    Raises a RuntimeError if the raster could not be bent
+    """
+    errors = []
+    stats = RunStats()
+    engine = RasterBenderEngine( sourcePath, targetPath, samplingMethod, tiled, workers, incremental, debug,
+                                 progress=progress, log=log, error=errors.append, fieldPath=fieldPath, fieldStep=fieldStep, stats=stats )
+
+    def doBend():
+        engine.progress( "Loading delaunay mesh...", float(0) )
+        triangles, pointsA, pointsB = loadMesh( pairsPath, constraintsPath, bufferValue, log, stats )
+        return engine.run( triangles, pointsA, pointsB )
+
+    success = profiled( engine.profilePath(), doBend ) if profile else doBend()
+    engine.writeReport()
+    if not success:
+        raise RuntimeError( errors[-1] if errors else "Could not bend the raster" )
+    return stats.report()
+
+
+def bendMany(pairsPath, jobs, constraintsPath=None, bufferValue=0.0, samplingMethod='bilinear', tiled=False, workers=1, incremental=False, debug=False, progress=None, log=None, error=None, jobProgress=None, jobFinished=None):
+    """
+    Bends several rasters with the same pairs (and constraints). The mesh is only computed once.
+
+    Input
+    jobs: list of (sourcePath, targetPath)
+    other arguments : see bend and RasterBenderBatch
+
+    Returns the list of the indices of the jobs that failed
+    """
+    triangles, pointsA, pointsB = loadMesh( pairsPath, constraintsPath, bufferValue, log )
+
+    batch = RasterBenderBatch( jobs, samplingMethod, tiled, workers, incremental, debug,
+                               progress=progress, log=log, error=error, jobProgress=jobProgress, jobFinished=jobFinished )
+    return batch.run( triangles, pointsA, pointsB )
+
+
+def applyField(fieldPath, sourcePath, targetPath, samplingMethod='bilinear', tiled=False, workers=1, debug=False, progress=None, log=None):
+    """
+    Bends a raster with a displacement field written by a previous run (see bend), without the pairs nor the triangulation.
+    The raster must have the same size as the one the field was computed for.
+
+    Returns the statistics of the run (see RunStats.report), that are also written next to the target
+
+    Raises a RuntimeError if the raster could not be bent
+    """
+    errors = []
+    engine = RasterBenderEngine( sourcePath, targetPath, samplingMethod, tiled, workers, False, debug,
+                                 progress=progress, log=log, error=errors.append, fieldPath=fieldPath )
+    success = engine.applyField()
+    engine.writeReport()
+    if not success:
+        raise RuntimeError( errors[-1] if errors else "Could not bend the raster" )
+    return engine.stats.report()
+
+
+def mainApplyField(argv):
+    parser = argparse.ArgumentParser( prog="rasterbendercli.py apply-field", description="Bends a raster with an existing displacement field." )
+    parser.add_argument( 'field', help="displacement field written with --export-field" )
+    parser.add_argument( 'source', help="raster to bend" )
+    parser.add_argument( 'target', help="path of the bent raster" )
+    parser.add_argument( '--sampling', choices=METHODS, default='bilinear', help="resampling method" )
+    parser.add_argument( '--tiled', action='store_true', help="write the target block by block instead of building it in memory" )
+    parser.add_argument( '--workers', type=int, default=1, help="number of processes used to warp the raster" )
+    parser.add_argument( '--debug', action='store_true', help="log debug informations" )
+    parser.add_argument( '--quiet', action='store_true', help="don't print the progress" )
+    args = parser.parse_args( argv )
+
+    def progress(message, percentage):
+        if not args.quiet:
+            sys.stderr.write( "[%3i%%] %s\n" % (int(percentage*100.0), message) )
+
+    try:
+        applyField( args.field, args.source, args.target, args.sampling, args.tiled, args.workers, args.debug, progress=progress )
+    except (IOError, RuntimeError) as e:
+        sys.stderr.write( "Error : %s\n" % e )
+        return 1
+    return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['apply-field']:
+        return mainApplyField( argv[1:] )
+
+    parser = argparse.ArgumentParser( description="Bends a raster according to pairs of points (rubber sheeting)." )
+    parser.add_argument( 'pairs', help="vector file of the pairs (linestrings from the source to the target position)" )
+    parser.add_argument( 'source', nargs='?', help="raster to bend" )
+    parser.add_argument( 'target', nargs='?', help="path of the bent raster" )
+    parser.add_argument( '--job', nargs=2, action='append', default=[], metavar=('SOURCE','TARGET'), help="another raster to bend with the same mesh (can be repeated)" )
+    parser.add_argument( '--constraints', help="vector file of the constraints (linestrings joining pairs)" )
+    parser.add_argument( '--buffer', type=float, default=0.0, help="size of the buffer around the triangulation, in map units" )
+    parser.add_argument( '--sampling', choices=METHODS, default='bilinear', help="resampling method" )
+    parser.add_argument( '--tiled', action='store_true', help="write the target block by block instead of building it in memory" )
+    parser.add_argument( '--workers', type=int, default=1, help="number of processes used to warp the raster" )
+    parser.add_argument( '--incremental', action='store_true', help="only warp again the triangles that changed since the last run" )
+    parser.add_argument( '--export-field', metavar='FIELD', help="also write the displacement field, to bend other rasters with apply-field" )
+    parser.add_argument( '--field-step', type=int, default=1, help="size of the displacement field pixels, in raster pixels" )
+    parser.add_argument( '--profile', action='store_true', help="capture the run with cProfile, in TARGET.rasterbender.prof (single raster only)" )
+    parser.add_argument( '--debug', action='store_true', help="log debug informations" )
+    parser.add_argument( '--quiet', action='store_true', help="don't print the progress" )
+    args = parser.parse_args( argv )
+
+    jobs = [tuple(job) for job in args.job]
+    if args.source is not None:
+        if args.target is None:
+            parser.error( "the target of %s is missing" % args.source )
+        jobs.insert( 0, (args.source, args.target) )
+    if len(jobs) == 0:
+        parser.error( "no raster to bend" )
+    if args.export_field and len(jobs) > 1:
+        parser.error( "--export-field can only be used with a single raster" )
+    if args.profile and len(jobs) > 1:
+        parser.error( "--profile can only be used with a single raster" )
+
+    def progress(message, percentage):
+        if not args.quiet:
+            sys.stderr.write( "[%3i%%] %s\n" % (int(percentage*100.0), message) )
+
+    def error(message):
+        sys.stderr.write( "Error : %s\n" % message )
+
+    try:
+        if len(jobs) == 1:
+            bend( args.pairs, jobs[0][0], jobs[0][1], args.constraints, args.buffer, args.sampling,
+                  args.tiled, args.workers, args.incremental, args.debug, progress=progress, fieldPath=args.export_field, fieldStep=args.field_step, profile=args.profile )
+        else:
+            failed = bendMany( args.pairs, jobs, args.constraints, args.buffer, args.sampling,
+                               args.tiled, args.workers, args.incremental, args.debug, progress=progress, error=error )
+            if len(failed) > 0:
+                error( "%i rasters out of %i could not be bent : %s" % (len(failed), len(jobs), ', '.join(jobs[i][0] for i in failed)) )
+                return 1
+    except (ValueError, RuntimeError) as e:
+        error( e )
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -8,12 +8,42 @@ from qgis.core import *
 from qgis.gui import *
 
 import os.path
+import struct
+import numpy
+import osgeo.gdal
 
 # Other classes
 import triangulate # it seems we can't import fTools' voronoi directly, so we ship a copy of the file
+import algorithm_preview as algPreview
 from rasterbenderworkerthread import RasterBenderWorkerThread
 
 
+# A triangle as a WKB polygon
+TRIANGLE_WKB = numpy.dtype([('byteOrder','u1'), ('type','<u4'), ('rings','<u4'), ('points','<u4'), ('coords','<f8',(8,))])
+
+
+class RasterPreviewItem(QgsMapCanvasItem):
+    """
+    Draws an image over a map extent of the canvas
+    """
+    def __init__(self, canvas):
+        QgsMapCanvasItem.__init__(self, canvas)
+        self.image = None
+
+    def setImage(self, image, extent):
+        self.image = image
+        self.setRect(extent)
+        self.update()
+
+    def clear(self):
+        self.image = None
+        self.update()
+
+    def paint(self, painter, option=None, widget=None):
+        if self.image is not None:
+            painter.drawImage(self.boundingRect(), self.image, QRectF(self.image.rect()))
+
+
 class RasterBenderDialog(QWidget):
     def __init__(self, iface, rb):
         QWidget.__init__(self)
@@ -25,13 +55,36 @@ class RasterBenderDialog(QWidget):
         self.rb = rb
         self.worker = None
         self.workerThread = None
+        self.lastReport = None # the statistics of the last run (see RunStats.report)
+
+        # The meshes are also stored on disk, so that they don't need to be computed again after a restart
+        triangulate.meshCache.directory = os.path.join(QgsApplication.qgisSettingsDirPath(), 'rasterbender', 'meshes')
 
         # Populate GDAL's interpolation methods
         self.samplingComboBox.clear()
         for method in ('near','bilinear','cubic','cubicspline','lanczos','average','mode',):
             self.samplingComboBox.addItem( method, method )
         self.samplingComboBox.setCurrentIndex(1)
-        
+
+        # Populate the engines
+        self.engineComboBox.clear()
+        self.engineComboBox.addItem( "in-process (numpy)", 'numpy' )
+        self.engineComboBox.addItem( "GDAL warper (slow)", 'gdal' )
+        self.engineComboBox.setCurrentIndex(0)
+        self.engineComboBox.currentIndexChanged.connect( self.updateEngineStates )
+
+        # Allow up to one worker per core. Outside of Windows, python 2 can only start the worker processes by forking
+        # QGIS, which can deadlock on the locks held by its other threads : the plugin then uses a single process (the
+        # command line can still use several)
+        if os.name == 'nt':
+            self.workersSpinBox.setMaximum( max(1, QThread.idealThreadCount()) )
+        else:
+            self.workersSpinBox.setMaximum( 1 )
+            self.workersSpinBox.setToolTip( "Several worker processes are only available on Windows and with rasterbendercli.py" )
+
+        # Draws the raster preview (below the rubberbands)
+        self.previewItem = RasterPreviewItem(self.iface.mapCanvas())
+        self.previewSource = None
 
          # Keeps three rubberbands for delaunay's peview
         self.rubberBands = (QgsRubberBand(self.iface.mapCanvas(), QGis.Polygon),
@@ -40,7 +93,13 @@ class RasterBenderDialog(QWidget):
         # Connect the UI buttons
         self.previewSlider.sliderPressed.connect(self.showPreview)
         self.previewSlider.sliderReleased.connect(self.hidePreview)
-        self.previewSlider.sliderMoved.connect(self.updatePreview)
+        self.previewSlider.sliderMoved.connect(self.schedulePreview)
+
+        # The preview is redrawn at most once per frame while the slider moves
+        self.previewTimer = QTimer(self)
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(16)
+        self.previewTimer.timeout.connect(self.updatePreview)
 
         self.createPairsLayerButton.clicked.connect(self.createPairsLayer)
         self.createConstraintsLayerButton.clicked.connect(self.createConstraintsLayer)
@@ -121,11 +180,53 @@ class RasterBenderDialog(QWidget):
         Returns the current sampling method name (to be used as GDAL argument)
         """
         return self.samplingComboBox.itemData(self.samplingComboBox.currentIndex())
+    def engine(self):
+        """
+        Returns the current engine name ('numpy' or 'gdal')
+        """
+        return self.engineComboBox.itemData(self.engineComboBox.currentIndex())
+    def tiled(self):
+        """
+        Returns whether the target must be processed tile by tile
+        """
+        return self.tiledCheckBox.isChecked()
+    def incremental(self):
+        """
+        Returns whether only the triangles that changed since the last run must be processed
+        """
+        return self.incrementalCheckBox.isChecked()
+    def fieldPath(self):
+        """
+        Returns the path of the displacement field to export, or None
+        """
+        if not self.fieldCheckBox.isChecked() or self.engine() != 'numpy':
+            return None
+        return os.path.splitext(self.targetRasterPath())[0] + '_field.tif'
+    def fieldStep(self):
+        """
+        Returns the size of the pixels of the displacement field, in raster pixels
+        """
+        return self.fieldStepSpinBox.value()
+    def workers(self):
+        """
+        Returns the number of processes to use for warping
+        """
+        return self.workersSpinBox.value()
     def debug(self):
         """
         Returns the current sampling method name (to be used as GDAL argument)
         """
         return self.debugCheckBox.isChecked()
+    def profile(self):
+        """
+        Returns whether the run is captured with cProfile
+        """
+        return self.profileCheckBox.isChecked()
+    def rasterPreview(self):
+        """
+        Returns whether the preview also shows the bent raster
+        """
+        return self.rasterPreviewCheckBox.isChecked()
 
 
     # Thread management
@@ -139,11 +240,13 @@ class RasterBenderDialog(QWidget):
             self.runButton.setEnabled(False)
             self.abortButton.setEnabled(True)
 
-            self.workerThread = RasterBenderWorkerThread( self.pairsLayer(), self.pairsLayerRestrictToSelection(), self.constraintsLayer(), self.constraintsLayerRestrictToSelection(), self.bufferValue(), self.samplingMethod(), self.sourceRasterPath(), self.targetRasterPath(), self.debug() )
+            self.workerThread = RasterBenderWorkerThread( self.pairsLayer(), self.pairsLayerRestrictToSelection(), self.constraintsLayer(), self.constraintsLayerRestrictToSelection(), self.bufferValue(), self.samplingMethod(), self.sourceRasterPath(), self.targetRasterPath(), self.debug(), self.engine(), self.tiled(), self.workers(), self.incremental(), self.fieldPath(), self.fieldStep(), self.profile() )
 
             self.workerThread.finished.connect( self.finish )
             self.workerThread.error.connect( self.error )
             self.workerThread.progress.connect( self.progress )
+            self.workerThread.report.connect( self.report )
+            self.lastReport = None
 
             self.workerThread.start()
 
@@ -167,8 +270,13 @@ class RasterBenderDialog(QWidget):
         self.runButton.setEnabled(True)
         self.abortButton.setEnabled(False)
         self.endThread()
+    def report(self, report):
+        self.lastReport = report
     def finish(self):
-        self.displayMsg( "Done !" )
+        if self.lastReport is not None:
+            self.displayMsg( "Done in %.1f seconds !" % self.lastReport['total'] )
+        else:
+            self.displayMsg( "Done !" )
         self.progressBar.setValue( 100 )
         self.runButton.setEnabled(True)
         self.abortButton.setEnabled(False)
@@ -248,6 +356,16 @@ class RasterBenderDialog(QWidget):
                     self.constraintsLayerComboBox.setCurrentIndex( i )
                     break
 
+    def updateEngineStates(self):
+        """
+        Enables the processing options that are supported by the current engine
+        """
+        self.tiledCheckBox.setEnabled( self.engine() == 'numpy' )
+        self.workersSpinBox.setEnabled( self.engine() == 'numpy' and os.name == 'nt' )
+        self.incrementalCheckBox.setEnabled( self.engine() == 'numpy' )
+        self.fieldCheckBox.setEnabled( self.engine() == 'numpy' )
+        self.fieldStepSpinBox.setEnabled( self.engine() == 'numpy' )
+
     def updateEditStates(self):
         """
         Update the edit state button for layers
@@ -402,24 +520,76 @@ class RasterBenderDialog(QWidget):
             msg = "<font color='red'>"+msg+"</font>"
         self.statusLabel.setText( msg )  
     def hidePreview(self):
+        self.previewTimer.stop()
         self.triangles = None
         self.hull = None
         self.pointsA = None
         self.pointsB = None
+        self.previewSource = None
+        self.previewItem.clear()
         if self.rubberBands is not None:
             self.rubberBands[0].reset(QGis.Polygon)
             self.rubberBands[1].reset(QGis.Polygon)
     def showPreview(self):
-        self.triangles, self.pointsA, self.pointsB, self.hull, constraints = triangulate.triangulate( self.pairsLayer(), self.pairsLayerRestrictToSelection(),self.constraintsLayer(), self.constraintsLayerRestrictToSelection(), self.bufferValue() )
+        try:
+            self.triangles, self.pointsA, self.pointsB, self.hull, constraints, snapDistances = triangulate.triangulate( self.pairsLayer(), self.pairsLayerRestrictToSelection(),self.constraintsLayer(), self.constraintsLayerRestrictToSelection(), self.bufferValue() )
+        except Exception as e:
+            # For instance when the pairs are degenerate : the preview is called by a timer, so the error is only reported
+            self.hidePreview()
+            self.displayMsg( "The mesh can't be computed : %s" % e, True )
+            return
+
+        # We warn about the constraints that don't pass exactly through the pairs
+        notSnapped = [d for distances in snapDistances for d in distances if d > 0]
+        if len(notSnapped) > 0:
+            self.displayMsg( "%i constraints vertices are not snapped on a pair (up to %f map units away) !" % (len(notSnapped), max(notSnapped)), True )
+
+        self.previewSource = None
+        if self.rasterPreview() and len(self.triangles) > 0:
+            self.loadPreviewSource()
+
         self.updatePreview()
+
+    def loadPreviewSource(self):
+        """
+        Reads the source at the resolution of the preview, once per slider drag
+        """
+        canvas = self.iface.mapCanvas()
+        extent = canvas.extent()
+        self.previewExtent = (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+        self.previewSize = algPreview.previewSize( canvas.width(), canvas.height() )
+
+        # Inside a triangle, the displacement interpolates the ones of its vertices : the source of the visible pixels is
+        # at most the largest displacement of the mesh away from the canvas, at any position of the slider
+        padding = float( numpy.sqrt( ((self.pointsB - self.pointsA) ** 2).sum(axis=1).max() ) ) if len(self.pointsA) else 0.0
+        readExtent = ( self.previewExtent[0] - padding, self.previewExtent[1] - padding,
+                       self.previewExtent[2] + padding, self.previewExtent[3] + padding )
+        resolution = (self.previewExtent[2] - self.previewExtent[0]) / self.previewSize[0]
+
+        try:
+            dsSource = osgeo.gdal.Open( self.sourceRasterPath(), osgeo.gdal.GA_ReadOnly )
+            geotransform = dsSource.GetGeoTransform(can_return_null=True)
+            if geotransform is None:
+                geotransform = (0.0, 1.0, 0.0, 0.0, 0.0, -1.0) # 1 pixel = 1 map unit, as the engines do
+            data, dataGeotransform = algPreview.readSource( dsSource, geotransform, readExtent, resolution )
+        except Exception as e:
+            self.displayMsg( "The source can't be previewed : %s" % e, True )
+            return
+        if data is not None:
+            self.previewSource = ( algPreview.colors( dsSource, data ), dataGeotransform )
         
+    def schedulePreview(self):
+        if not self.previewTimer.isActive():
+            self.previewTimer.start()
+
     def updatePreview(self):
 
-        if self.rubberBands is not None:
+        if self.rubberBands is None:
+            return
+
+        if self.triangles is None or self.hull is None or len(self.triangles) == 0:
             self.rubberBands[0].reset(QGis.Polygon)
             self.rubberBands[1].reset(QGis.Polygon)
-
-        if self.triangles is None or self.hull is None:
             return
 
         percent = float(self.previewSlider.sliderPosition()-self.previewSlider.minimum()) / float( self.previewSlider.maximum()-self.previewSlider.minimum() )
@@ -432,20 +602,40 @@ class RasterBenderDialog(QWidget):
 
         self.rubberBands[1].setWidth(2)
 
-        def interpolatePoints(pA, pB, ratio):
-            return QgsPoint( (1.0-ratio)*pA.x()+ratio*pB.x(), (1.0-ratio)*pA.y()+ratio*pB.y() )
-        
-        for i,tri in enumerate(self.triangles):
-            #draw the triangles
-            self.rubberBands[1].addPoint( interpolatePoints(self.pointsA[tri[0]],self.pointsB[tri[0]],percent), False, i )
-            self.rubberBands[1].addPoint( interpolatePoints(self.pointsA[tri[1]],self.pointsB[tri[1]],percent), False, i )
-            self.rubberBands[1].addPoint( interpolatePoints(self.pointsA[tri[2]],self.pointsB[tri[2]],percent), True, i ) #TODO : this refreshes the rubber band on each triangle, it should be updated only once after this loop       
-            
-            #draw the background
-            self.rubberBands[0].addPoint( interpolatePoints(self.pointsA[tri[0]],self.pointsB[tri[0]],percent), False, i )
-            self.rubberBands[0].addPoint( interpolatePoints(self.pointsA[tri[1]],self.pointsB[tri[1]],percent), False, i )
-            self.rubberBands[0].addPoint( interpolatePoints(self.pointsA[tri[2]],self.pointsB[tri[2]],percent), True, i ) #TODO : this refreshes the rubber band on each triangle, it should be updated only once after this loop       
-            
+        # Interpolate all the points at once
+        points = (1.0-percent)*self.pointsA + percent*self.pointsB
+
+        # All the triangles are drawn as one multipolygon, so that each rubber band is only repainted once
+        geometry = self.trianglesGeometry( points[self.triangles] )
+        self.rubberBands[1].setToGeometry( geometry, None ) # the triangles
+
+        if self.previewSource is None:
+            self.rubberBands[0].setToGeometry( geometry, None ) # the background
+            return
+
+        # The raster replaces the background
+        self.rubberBands[0].reset(QGis.Polygon)
+        argb, sourceGeotransform = self.previewSource
+        width, height = self.previewSize
+        self.previewImage = algPreview.warpPreview( argb, sourceGeotransform, self.pointsA, points, self.triangles, self.previewExtent, width, height )
+        image = QImage( self.previewImage.data, width, height, QImage.Format_ARGB32 )
+        self.previewItem.setImage( image, QgsRectangle(*self.previewExtent) )
+
+    def trianglesGeometry(self, coords):
+        """
+        Returns a multipolygon QgsGeometry from a (M,3,2) array of triangles coordinates
+        """
+        # The geometry is built as WKB, which can be written at once with numpy (formatting WKT is much slower)
+        rings = numpy.concatenate( (coords, coords[:,:1]), axis=1 ).reshape(-1,8) # closed rings
+        polygons = numpy.empty( len(rings), dtype=TRIANGLE_WKB )
+        polygons['byteOrder'] = 1 # little endian
+        polygons['type'] = 3 # polygon
+        polygons['rings'] = 1
+        polygons['points'] = 4
+        polygons['coords'] = rings
+        geometry = QgsGeometry()
+        geometry.fromWkb( struct.pack('<BII', 1, 6, len(rings)) + polygons.tobytes() ) # multipolygon header
+        return geometry
 
 
 
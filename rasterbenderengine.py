@@ -0,0 +1,895 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ RasterBender
+                                 A QGIS plugin
+ Deforms vector to adapt them despite heavy and irregular deformations
+                              -------------------
+        begin                : 2014-05-21
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+The in-process warping engine. It doesn't depend on Qt nor QGIS, so that it can be used by the plugin's worker thread as well as headless.
+"""
+
+# Basic dependencies
+import osgeo, osgeo.gdal
+import os.path
+import sys
+import time
+import numpy
+import multiprocessing
+from collections import deque
+from xml.sax.saxutils import escape
+
+# Other classes
+import algorithm_warp as algWarp
+import algorithm_displacement as algDisplacement
+from rasterbenderstats import RunStats
+
+
+def bandBytes(dataset, b, width=None, height=None):
+    """
+    Returns the size in bytes of a window of a band (of the whole band by default)
+    """
+    band = dataset.GetRasterBand(b)
+    width = dataset.RasterXSize if width is None else width
+    height = dataset.RasterYSize if height is None else height
+    return width * height * osgeo.gdal.GetDataTypeSize(band.DataType) // 8
+
+
+def createPool(workers):
+    """
+    Returns a multiprocessing pool able to run algorithm_warp.warpTileTask
+    """
+    if os.name == 'nt' and not os.path.basename(sys.executable).lower().startswith('python'):
+        # On Windows, sys.executable is QGIS itself when running in the plugin
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    return multiprocessing.Pool( workers )
+
+
+def boundedImap(pool, task, tasksArgs, window):
+    """
+    Yields the results of the tasks computed in the pool, in the order of the tasks, like pool.imap. At most window
+    tasks are submitted ahead of the results taken, so that when the results are consumed more slowly than they are
+    computed, the finished tiles waiting in memory are bounded by the window instead of the number of tasks.
+    """
+    pending = deque()
+    for args in tasksArgs:
+        pending.append( pool.apply_async( task, (args,) ) )
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class RasterBenderEngine(object):
+    """
+    Warps a raster according to a mesh : each pixel of the target is mapped back to the source through its triangle and resampled.
+
+    The caller is notified through callbacks :
+    progress(message, percentage)
+    log(message, debug_only)
+    error(message)
+
+    The duration of the stages, the number of triangles and tiles and the bytes read and written are collected in stats
+    (see rasterbenderstats.RunStats), that can be written next to the target with stats.write( engine.reportPath() ).
+    """
+
+    # Number of rows processed at once
+    STRIP_HEIGHT = 256
+    # Minimal size of the tiles processed in tiled mode (tiles are made of whole GDAL blocks)
+    TILE_SIZE = 512
+
+    def __init__(self, sourcePath, targetPath, samplingMethod, tiled=False, workers=1, incremental=False, debug=False, progress=None, log=None, error=None, pool=None, mappings=None, fieldPath=None, fieldStep=1, stats=None):
+
+        self.sourcePath = sourcePath
+        self.targetPath = targetPath
+        self.samplingMethod = samplingMethod
+
+        self.tiled = tiled # if True, the target is written block by block instead of being built in memory
+        self.workers = workers # number of processes used to warp the tiles
+        self.incremental = incremental # if True, only the triangles that changed since the previous run are warped again
+        self.debug = debug
+
+        self.progressCallback = progress
+        self.logCallback = log
+        self.errorCallback = error
+
+        self.pool = pool # a pool shared with other engines (see RasterBenderBatch), if None the engine creates its own
+        self.mappings = mappings # (geotransform, xSize, ySize) : pixel mapping of the mesh, shared by the rasters bent with the same mesh (or None)
+
+        self.fieldPath = fieldPath # path of the displacement field written by run and exportField, or read by applyField
+        self.fieldStep = fieldStep # size of the displacement field pixels, in raster pixels
+
+        self.stats = stats if stats is not None else RunStats() # a RunStats shared with the caller (that can time the triangulation in it), or a new one
+        self.stats.info['source'] = sourcePath
+        self.stats.info['target'] = targetPath
+        self.stats.info['samplingMethod'] = samplingMethod
+        self.stats.info['workers'] = workers
+
+        self._abort = False
+
+    def progress(self, message, percentage):
+        if self.progressCallback is not None:
+            self.progressCallback(message, percentage)
+    def log(self, message, debug_only=False):
+        if self.logCallback is not None:
+            self.logCallback(message, debug_only)
+        elif debug_only is False or self.debug is True:
+            sys.stderr.write(message + '\n')
+    def error(self, message):
+        if self.errorCallback is not None:
+            self.errorCallback(message)
+        else:
+            sys.stderr.write(message + '\n')
+
+    def abort(self):
+        self._abort = True
+
+    def reportPath(self):
+        """
+        Returns the path of the JSON report of the run, next to the target
+        """
+        return self.targetPath + '.rasterbender.json'
+
+    def profilePath(self):
+        """
+        Returns the path of the cProfile capture of the run, next to the target
+        """
+        return self.targetPath + '.rasterbender.prof'
+
+    def writeReport(self):
+        """
+        Writes the statistics of the run as JSON next to the target
+        """
+        try:
+            self.stats.write( self.reportPath() )
+        except (IOError, OSError) as e:
+            self.log( "Could not write the report {} ({})".format(self.reportPath(), e), False )
+
+    def meshStatePath(self):
+        """
+        Returns the path of the file storing the mesh of the last incremental run, next to the target
+        """
+        return self.targetPath + '.rasterbender.npz'
+
+    def saveMeshState(self, pointsA, pointsB, triangles, xSize, ySize, geotransform):
+        """
+        Stores the mesh that was used to write the target, so that the next run can be incremental
+        """
+        numpy.savez( self.meshStatePath(),
+            pointsA=pointsA,
+            pointsB=pointsB,
+            triangles=triangles,
+            sourcePath=numpy.array(self.sourcePath),
+            sourceFile=numpy.array(self.sourceFileState()),
+            samplingMethod=numpy.array(self.samplingMethod),
+            rasterSize=numpy.array([xSize, ySize]),
+            geotransform=numpy.array(geotransform),
+            targetTime=numpy.array(os.path.getmtime(self.targetPath)),
+        )
+
+    def sourceFileState(self):
+        """
+        Returns the (modification time, size) of the source file, so that a source edited in place is noticed
+        (or (0, 0) if it isn't a file, for instance a GDAL connection string)
+        """
+        if not os.path.isfile(self.sourcePath):
+            return (0, 0)
+        return (os.path.getmtime(self.sourcePath), os.path.getsize(self.sourcePath))
+
+    def loadMeshState(self, xSize, ySize, geotransform):
+        """
+        Returns the mesh stored by the last run as (pointsA, pointsB, triangles), or None if the target can't be updated incrementally
+        """
+        path = self.meshStatePath()
+        if not os.path.exists(path) or not os.path.exists(self.targetPath):
+            self.log('No previous run was found, we process the whole raster.', True)
+            return None
+
+        try:
+            with numpy.load(path) as state:
+                matches = ( state['sourcePath'].item() == self.sourcePath and
+                            tuple(state['sourceFile']) == self.sourceFileState() and
+                            state['samplingMethod'].item() == self.samplingMethod and
+                            tuple(state['rasterSize']) == (xSize, ySize) and
+                            tuple(state['geotransform']) == tuple(geotransform) and
+                            state['targetTime'].item() == os.path.getmtime(self.targetPath) )
+                mesh = (state['pointsA'], state['pointsB'], state['triangles'])
+        except Exception as e:
+            self.log('The previous run could not be read ({}), we process the whole raster.'.format(e), True)
+            return None
+
+        if not matches:
+            self.log('The previous run used other settings or the source or the target was modified, we process the whole raster.', True)
+            return None
+
+        return mesh
+
+    def openSource(self):
+        """
+        Returns (dsSource, geotransform)
+        """
+        osgeo.gdal.UseExceptions()
+
+        self.log('GDAL version : {}'.format(osgeo.gdal.VersionInfo('RELEASE_NAME')), True)
+
+        dsSource = osgeo.gdal.Open( self.sourcePath, osgeo.gdal.GA_ReadOnly )
+
+        geotransform = dsSource.GetGeoTransform(can_return_null=True)
+        if geotransform is None:
+            # If we have no geotransform, we match 1 pixel = 1 map unit (as the GCPs of the GDAL engine do)
+            geotransform = (0.0, 1.0, 0.0, 0.0, 0.0, -1.0)
+            self.log('Geotransform was not found. We use 1 pixel = 1 map unit.', True)
+        else:
+            self.log('Geotransform was found : {}'.format(geotransform), True)
+
+        return dsSource, geotransform
+
+    def isVrt(self):
+        """
+        Returns True if the target is a VRT, in which case only the area that moves is written (see writeVrt)
+        """
+        return os.path.splitext(self.targetPath)[1].lower() == '.vrt'
+
+    def overlayPath(self):
+        """
+        Returns the path of the raster holding the pixels that move when the target is a VRT
+        """
+        return os.path.splitext(self.targetPath)[0] + '_overlay.tif'
+
+    def createTarget(self, dsSource, geotransform, update=False, window=None):
+        """
+        Creates the target, or opens the result of the previous run if update is True.
+
+        Returns (driver, dsTarget, mode) where mode is
+        'memory' : dsTarget is an in-memory copy of the source, to be saved with saveTarget
+        'update' : dsTarget is the previous result, updated in place
+        'stream' : dsTarget is empty and written block by block, the blocks that don't move being copied from the source (see copyTiles)
+        'overlay' : dsTarget is empty and only covers window (xoff, yoff, xsize, ysize), the target is a VRT drawing it over the source
+        """
+        if self.isVrt():
+            # The overlay is always a GeoTIFF, the source is referenced as it is
+            driver = osgeo.gdal.GetDriverByName('GTiff')
+            xoff, yoff, width, height = window
+            dsTarget = self.createEmpty( driver, self.overlayPath(), dsSource, width, height )
+            dsTarget.SetGeoTransform( ( geotransform[0] + xoff*geotransform[1] + yoff*geotransform[2], geotransform[1], geotransform[2],
+                                        geotransform[3] + xoff*geotransform[4] + yoff*geotransform[5], geotransform[4], geotransform[5] ) )
+            return driver, dsTarget, 'overlay'
+
+        # We use the same format as the source (see targetDriver)
+        driver, inPlace = self.targetDriver( dsSource )
+        self.log('Output format : {}'.format(driver.ShortName), True)
+        writeInPlace = self.tiled or self.incremental
+        if writeInPlace and not inPlace:
+            self.log('The {} format can only be written at once, the target is built in memory.'.format(driver.ShortName), False)
+            writeInPlace = False
+
+        if update:
+            # We update the previous result in place
+            dsTarget = osgeo.gdal.Open( self.targetPath, osgeo.gdal.GA_Update )
+            mode = 'update'
+        elif writeInPlace:
+            # We write the target tile by tile, so that only one tile is in memory at once. The tiles that don't move are
+            # copied from the source as they are, so that each block of the target is written once and nothing is copied twice
+            dsTarget = self.createEmpty( driver, self.targetPath, dsSource, dsSource.RasterXSize, dsSource.RasterYSize )
+            mode = 'stream'
+        else:
+            # We work on an in-memory copy of the source
+            dsTarget = osgeo.gdal.GetDriverByName('MEM').CreateCopy( '', dsSource )
+            mode = 'memory'
+        dsTarget.SetGeoTransform( geotransform )
+
+        return driver, dsTarget, mode
+
+    def targetDriver(self, dsSource):
+        """
+        Returns (driver, inPlace) where driver writes the target in the format of the source, and inPlace is True if it
+        can write it tile by tile and update it (else the target is built in memory and copied at once with CreateCopy),
+        or (None, False) if GDAL can't write this format
+        """
+        driver = dsSource.GetDriver()
+        if driver.ShortName in ('MEM','VRT'):
+            # Not file formats : the target is a GeoTIFF (a VRT target is written by writeVrt)
+            return osgeo.gdal.GetDriverByName('GTiff'), True
+        if driver.GetMetadataItem(osgeo.gdal.DCAP_CREATE) == 'YES':
+            return driver, True
+        if driver.GetMetadataItem(osgeo.gdal.DCAP_CREATECOPY) == 'YES':
+            return driver, False
+        return None, False
+
+    def checkTargetFormat(self, dsSource):
+        """
+        Returns (True, inPlace) if the target can be written in the format of the source (see targetDriver), else
+        reports it and returns (False, False)
+        """
+        driver, inPlace = self.targetDriver( dsSource )
+        if driver is None:
+            self.error( "GDAL can't write the {} format of the source, convert it (to GeoTIFF for instance) before bending it.".format(dsSource.GetDriver().ShortName) )
+            return False, False
+        return True, inPlace
+
+    def createEmpty(self, driver, path, dsSource, xSize, ySize):
+        """
+        Creates an empty raster with the bands, data type, projection, no data values, colors and metadata of the source
+        """
+        bandSource = dsSource.GetRasterBand(1)
+
+        options = []
+        if driver.ShortName == 'GTiff':
+            # We keep the compression of the source, and write tiles (with the blocks of the source if it is tiled)
+            structure = dsSource.GetMetadata('IMAGE_STRUCTURE') or {}
+            compression = structure.get('COMPRESSION')
+            if compression == 'YCbCr JPEG':
+                options.extend(['COMPRESS=JPEG', 'PHOTOMETRIC=YCBCR'])
+            elif compression is not None:
+                options.append('COMPRESS={}'.format(compression))
+            if structure.get('INTERLEAVE') == 'BAND':
+                options.append('INTERLEAVE=BAND')
+            options.extend(['TILED=YES', 'BIGTIFF=IF_SAFER'])
+            blockWidth, blockHeight = bandSource.GetBlockSize()
+            if blockWidth < dsSource.RasterXSize and blockWidth % 16 == 0 and blockHeight % 16 == 0:
+                options.extend(['BLOCKXSIZE={}'.format(blockWidth), 'BLOCKYSIZE={}'.format(blockHeight)])
+
+        dsTarget = driver.Create( path, xSize, ySize, dsSource.RasterCount, bandSource.DataType, options )
+        dsTarget.SetProjection( dsSource.GetProjectionRef() )
+        dsTarget.SetMetadata( dsSource.GetMetadata() )
+        for b in range(1, dsSource.RasterCount+1):
+            bandSource = dsSource.GetRasterBand(b)
+            bandTarget = dsTarget.GetRasterBand(b)
+            noData = bandSource.GetNoDataValue()
+            if noData is not None:
+                bandTarget.SetNoDataValue( noData )
+            colorTable = bandSource.GetColorTable()
+            if colorTable is not None:
+                bandTarget.SetColorTable( colorTable )
+            bandTarget.SetColorInterpretation( bandSource.GetColorInterpretation() )
+            bandTarget.SetDescription( bandSource.GetDescription() )
+        return dsTarget
+
+    def copyTiles(self, dsSource, dsTarget, tiles, originX=0, originY=0):
+        """
+        Copies tiles of the source to the target as raw bytes (no conversion to arrays nor resampling).
+        (originX, originY) is the position of the target in the source.
+        """
+        if len(tiles) == 0:
+            return
+        with self.stats.stage('copyTiles'):
+            for xoff, yoff, width, height in tiles:
+                for b in range(1, dsSource.RasterCount+1):
+                    data = dsSource.GetRasterBand(b).ReadRaster( xoff, yoff, width, height )
+                    dsTarget.GetRasterBand(b).WriteRaster( xoff-originX, yoff-originY, width, height, data )
+                    self.stats.count( 'bytesRead', len(data) )
+                    self.stats.count( 'bytesWritten', len(data) )
+            self.stats.count( 'tilesCopied', len(tiles) )
+
+    def writeVrt(self, dsSource, geotransform, window):
+        """
+        Writes the target as a VRT referencing the source, with the overlay drawn over window (or nothing if window is None)
+        """
+        xSize = dsSource.RasterXSize
+        ySize = dsSource.RasterYSize
+
+        def source(path, relative, band, srcRect, dstRect):
+            return ( '    <SimpleSource>\n'
+                     '      <SourceFilename relativeToVRT="{}">{}</SourceFilename>\n'
+                     '      <SourceBand>{}</SourceBand>\n'
+                     '      <SrcRect xOff="{}" yOff="{}" xSize="{}" ySize="{}"/>\n'
+                     '      <DstRect xOff="{}" yOff="{}" xSize="{}" ySize="{}"/>\n'
+                     '    </SimpleSource>\n' ).format( int(relative), escape(path), band, *(tuple(srcRect) + tuple(dstRect)) )
+
+        lines = [ '<VRTDataset rasterXSize="{}" rasterYSize="{}">\n'.format(xSize, ySize),
+                  '  <SRS>{}</SRS>\n'.format(escape(dsSource.GetProjectionRef())),
+                  '  <GeoTransform>{}</GeoTransform>\n'.format(', '.join(repr(float(v)) for v in geotransform)) ]
+        for b in range(1, dsSource.RasterCount+1):
+            band = dsSource.GetRasterBand(b)
+            lines.append( '  <VRTRasterBand dataType="{}" band="{}">\n'.format(osgeo.gdal.GetDataTypeName(band.DataType), b) )
+            if band.GetNoDataValue() is not None:
+                lines.append( '    <NoDataValue>{}</NoDataValue>\n'.format(repr(band.GetNoDataValue())) )
+            lines.append( '    <ColorInterp>{}</ColorInterp>\n'.format(osgeo.gdal.GetColorInterpretationName(band.GetColorInterpretation())) )
+            colorTable = band.GetColorTable()
+            if colorTable is not None:
+                lines.append( '    <ColorTable>\n' )
+                for i in range(colorTable.GetCount()):
+                    lines.append( '      <Entry c1="{}" c2="{}" c3="{}" c4="{}"/>\n'.format(*colorTable.GetColorEntry(i)) )
+                lines.append( '    </ColorTable>\n' )
+            # The source, then the overlay on top of it
+            lines.append( source( os.path.abspath(self.sourcePath), False, b, (0, 0, xSize, ySize), (0, 0, xSize, ySize) ) )
+            if window is not None:
+                lines.append( source( os.path.basename(self.overlayPath()), True, b, (0, 0, window[2], window[3]), window ) )
+            lines.append( '  </VRTRasterBand>\n' )
+        lines.append( '</VRTDataset>\n' )
+
+        with open( self.targetPath, 'w' ) as f:
+            f.write( ''.join(lines) )
+
+    def tileSize(self, dsTarget, mode):
+        """
+        Returns the (width, height) of the tiles processed at once
+        """
+        if mode != 'memory':
+            # Tiles are made of whole blocks of the target
+            blockWidth, blockHeight = dsTarget.GetRasterBand(1).GetBlockSize()
+            tileWidth = blockWidth * max(1, self.TILE_SIZE // blockWidth)
+            tileHeight = blockHeight * max(1, self.TILE_SIZE // blockHeight)
+            self.log('Block size : {}x{}, tile size : {}x{}'.format(blockWidth, blockHeight, tileWidth, tileHeight), True)
+            return tileWidth, tileHeight
+        return dsTarget.RasterXSize, self.STRIP_HEIGHT
+
+    def processTiles(self, count, tasksArgs, task, localTask, merge):
+        """
+        Computes the tiles in the pool of processes (or in this process if there is no pool), and merges them in the order of the tasks.
+
+        Input
+        count: number of tasks
+        tasksArgs: generator of the arguments of the tasks
+        task: function computing a task in a worker process (called with the arguments)
+        localTask: function computing a task in this process (called with the arguments)
+        merge: function(i, result) writing the result of a task (without the number of bytes read, that is the last item of the results)
+
+        Returns False if it was aborted
+        """
+        pool = self.pool
+        ownPool = pool is None and self.workers > 1
+        try:
+            if ownPool:
+                self.log('Warping with {} processes'.format(self.workers), True)
+                pool = createPool( self.workers )
+            if pool is not None:
+                # The results come in the order of the tasks, so that the target is written deterministically. Two tasks
+                # per process are pending at most, so that the memory is bounded by the tile size and the number of processes
+                results = boundedImap( pool, task, tasksArgs, 2 * max(1, self.workers) )
+            else:
+                results = ( localTask( args ) for args in tasksArgs )
+
+            for i in range(count):
+
+                if self._abort:
+                    self.error( "Aborted on tile %i out of %i..."  % (i+1, count))
+                    return False
+
+                self.progress( "Computing tile %i out of %i..." % (i+1, count), float(i)/float(count) )
+
+                # With a pool, this is the time spent waiting for the workers
+                with self.stats.stage('computeTiles'):
+                    result = next(results)
+                self.stats.count( 'tilesComputed' )
+                self.stats.count( 'bytesRead', result[-1] )
+                with self.stats.stage('mergeTiles'):
+                    merge( i, result[:-1] )
+        finally:
+            if ownPool and pool is not None:
+                pool.terminate()
+                pool.join()
+        return True
+
+    def saveTarget(self, driver, dsTarget, mode):
+        self.progress( "Saving the raster...", float(1) )
+
+        if mode == 'memory':
+            dsOutput = driver.CreateCopy( self.targetPath, dsTarget )
+            dsOutput = None
+            self.stats.count( 'bytesWritten', sum( bandBytes(dsTarget, b) for b in range(1, dsTarget.RasterCount+1) ) )
+
+    def mapping(self, pointsA, pointsB, triangles, geotransform, xSize, ySize):
+        """
+        Returns the mesh in pixel coordinates and the affine transformation of each triangle as (pixelsB, affines, bounds)
+        """
+        key = (tuple(geotransform), xSize, ySize)
+        if self.mappings is not None and key in self.mappings:
+            self.log('The pixel mapping of a previous raster is reused.', True)
+            return self.mappings[key]
+
+        pixelsA = algWarp.mapToPixel( pointsA, geotransform )
+        pixelsB = algWarp.mapToPixel( pointsB, geotransform )
+        affines = algWarp.computeInverseAffines( pixelsA, pixelsB, triangles )
+        bounds = algWarp.triangleBounds( pixelsB, triangles )
+        if self.mappings is not None:
+            self.mappings[key] = (pixelsB, affines, bounds)
+        return (pixelsB, affines, bounds)
+
+    def run(self, triangles, pointsA, pointsB):
+        """
+        Warps the source to the target according to the mesh (see triangulate.triangulate).
+
+        Returns True on success, False if it was aborted
+        """
+
+        ###############################
+        # Step 2. Opening the dataset #
+        ###############################
+
+        self.progress( "Opening the dataset...", float(0) )
+
+        with self.stats.stage('open'):
+            dsSource, geotransform = self.openSource()
+        xSize = dsSource.RasterXSize
+        ySize = dsSource.RasterYSize
+
+        # A VRT target is written again from scratch each time (the overlay is rewritten anyway), and formats that can
+        # only be written at once can't be updated
+        inPlace = True
+        if not self.isVrt():
+            writable, inPlace = self.checkTargetFormat( dsSource )
+            if not writable:
+                return False
+        incremental = self.incremental and not self.isVrt() and inPlace
+
+        # In incremental mode, we compare the mesh with the one of the previous run
+        mappingStart = time.time()
+        previous = self.loadMeshState(xSize, ySize, geotransform) if incremental else None
+        if previous is not None:
+            oldPointsA, oldPointsB, oldTriangles = previous
+            dirty, removed = algWarp.diffMeshes( oldPointsA, oldPointsB, oldTriangles, pointsA, pointsB, triangles )
+            self.log('Incremental run : {} triangles to warp, {} triangles to restore.'.format(len(dirty), len(removed)), True)
+            warpTriangles = triangles[dirty]
+            pixelsA = algWarp.mapToPixel( pointsA, geotransform )
+            pixelsB = algWarp.mapToPixel( pointsB, geotransform )
+            affines = algWarp.computeInverseAffines( pixelsA, pixelsB, warpTriangles )
+            bounds = algWarp.triangleBounds( pixelsB, warpTriangles )
+            # The pixels of the triangles that disappeared are restored from the source (or warped again if a new triangle covers them)
+            oldPixelsB = algWarp.mapToPixel( oldPointsB, geotransform )
+            restoreTriangles = oldTriangles[removed]
+        else:
+            warpTriangles = triangles
+            pixelsB, affines, bounds = self.mapping( pointsA, pointsB, triangles, geotransform, xSize, ySize )
+            oldPixelsB = pixelsB
+            restoreTriangles = numpy.zeros((0,3), dtype=numpy.int32)
+        restoreBounds = algWarp.triangleBounds( oldPixelsB, restoreTriangles )
+        self.stats.addTime( 'mapping', time.time() - mappingStart )
+        self.stats.count( 'triangles', len(warpTriangles) )
+        self.stats.count( 'trianglesRestored', len(restoreTriangles) )
+        self.stats.info['rasterSize'] = [xSize, ySize, dsSource.RasterCount]
+
+
+
+        ###############################
+        # Step 3. Warping the raster  #
+        ###############################
+
+        window = algWarp.windowsUnion( [algWarp.destinationWindow( pixelsB, warpTriangles, xSize, ySize ),
+                                        algWarp.destinationWindow( oldPixelsB, restoreTriangles, xSize, ySize )] )
+        if window is not None:
+            self.log('Window to warp : {}'.format(window), True)
+        elif self.isVrt():
+            # Nothing moves, the target only references the source
+            self.writeVrt( dsSource, geotransform, None )
+            return True
+
+        with self.stats.stage('target'):
+            driver, dsTarget, mode = self.createTarget( dsSource, geotransform, update=previous is not None, window=window )
+        self.stats.info['mode'] = mode
+
+        # In stream and overlay modes, the target is empty : the tiles that don't move are copied from the source, and
+        # the moving pixels are drawn over the source instead of over the target
+        fromSource = mode in ('stream', 'overlay')
+        originX, originY = window[0:2] if mode == 'overlay' else (0, 0)
+
+        if mode == 'stream':
+            tiles = algWarp.tileWindows( (0, 0, xSize, ySize), *self.tileSize( dsTarget, mode ) )
+        elif window is not None:
+            tiles = algWarp.tileWindows( window, *self.tileSize( dsTarget, mode ) )
+        else:
+            tiles = []
+
+        # We only compute the tiles that are overlapped by the mesh, with the triangles overlapping them
+        tasks = []
+        for index, tile in enumerate(tiles):
+            subset = algWarp.trianglesInWindow( bounds, *tile )
+            restoreSubset = algWarp.trianglesInWindow( restoreBounds, *tile )
+            if len(subset) > 0 or len(restoreSubset) > 0:
+                tasks.append( (tile, subset, restoreSubset, index) )
+        self.stats.count( 'tiles', len(tiles) )
+
+        # The index of the first tile that wasn't written yet : the tiles are written in order, so that the blocks are written sequentially
+        written = [0]
+        def copyUntil(index):
+            if fromSource:
+                self.copyTiles( dsSource, dsTarget, tiles[written[0]:index], originX, originY )
+            written[0] = index + 1
+
+        def tasksArgs():
+            for tile, subset, restoreSubset, index in tasks:
+                tilePixels, tileTriangles, tileAffines = algWarp.tileMesh( pixelsB, warpTriangles, affines, subset )
+                yield (self.sourcePath, tile, tilePixels, tileTriangles, tileAffines, self.samplingMethod)
+
+        def merge(i, result):
+            (xoff, yoff, width, height), owned, bands = result
+            copyUntil( tasks[i][3] )
+            self.stats.count( 'pixelsWarped', int(owned.sum()) )
+
+            restoreSubset = tasks[i][2]
+            if len(restoreSubset) > 0:
+                restore = algWarp.rasterizeTriangles( oldPixelsB, restoreTriangles, xoff, yoff, width, height, restoreSubset ) >= 0
+                restore &= ~owned
+            else:
+                restore = numpy.zeros(owned.shape, dtype=bool)
+
+            if not owned.any() and not restore.any():
+                if fromSource:
+                    self.copyTiles( dsSource, dsTarget, [tasks[i][0]], originX, originY )
+                return
+
+            for b in range(1, dsTarget.RasterCount+1):
+                bandTarget = dsTarget.GetRasterBand(b)
+                if fromSource:
+                    data = dsSource.GetRasterBand(b).ReadAsArray( xoff, yoff, width, height )
+                else:
+                    data = bandTarget.ReadAsArray( xoff, yoff, width, height )
+                if owned.any():
+                    data[owned] = bands[b-1][owned]
+                if restore.any():
+                    data[restore] = dsSource.GetRasterBand(b).ReadAsArray( xoff, yoff, width, height )[restore]
+                    self.stats.count( 'bytesRead', data.nbytes )
+                bandTarget.WriteArray( data, xoff-originX, yoff-originY )
+                self.stats.count( 'bytesRead', data.nbytes )
+                self.stats.count( 'bytesWritten', data.nbytes )
+
+        with self.stats.stage('warp'):
+            if not self.processTiles( len(tasks), tasksArgs(), algWarp.warpTileTask, lambda args: algWarp.warpTile( dsSource, *args[1:] ), merge ):
+                return False
+            copyUntil( len(tiles) )
+
+
+        ###############################
+        # Step 4. Saving the result   #
+        ###############################
+
+        with self.stats.stage('save'):
+            self.saveTarget( driver, dsTarget, mode )
+            dsTarget = None
+            if mode == 'overlay':
+                self.writeVrt( dsSource, geotransform, window )
+            dsSource = None
+
+            if incremental:
+                self.saveMeshState( pointsA, pointsB, triangles, xSize, ySize, geotransform )
+
+        if self.fieldPath is not None:
+            # In incremental mode, the affine transformations were only computed for the triangles that changed
+            if previous is not None:
+                pixelsB, affines, bounds = self.mapping( pointsA, pointsB, triangles, geotransform, xSize, ySize )
+            with self.stats.stage('field'):
+                if not self.writeField( pixelsB, triangles, affines, bounds, geotransform, xSize, ySize ):
+                    return False
+
+        return True
+
+    def exportField(self, triangles, pointsA, pointsB):
+        """
+        Only writes the displacement field of the mesh to fieldPath (the source is only used for its size and geotransform)
+
+        Returns True on success, False if it was aborted
+        """
+        self.progress( "Opening the dataset...", float(0) )
+
+        dsSource, geotransform = self.openSource()
+        xSize = dsSource.RasterXSize
+        ySize = dsSource.RasterYSize
+        dsSource = None
+
+        with self.stats.stage('mapping'):
+            pixelsB, affines, bounds = self.mapping( pointsA, pointsB, triangles, geotransform, xSize, ySize )
+        with self.stats.stage('field'):
+            return self.writeField( pixelsB, triangles, affines, bounds, geotransform, xSize, ySize )
+
+    def writeField(self, pixelsB, triangles, affines, bounds, geotransform, xSize, ySize):
+        """
+        Writes the displacement field of the mesh to fieldPath, at a resolution of fieldStep raster pixels
+
+        Returns True on success, False if it was aborted
+        """
+        step = self.fieldStep
+        fieldXSize, fieldYSize = algDisplacement.fieldSize( xSize, ySize, step )
+        self.log('Writing the displacement field ({}x{}) to {}'.format(fieldXSize, fieldYSize, self.fieldPath), True)
+
+        fieldBounds = bounds / float(step)
+
+        dsField = osgeo.gdal.GetDriverByName('GTiff').Create( self.fieldPath, fieldXSize, fieldYSize, 2, osgeo.gdal.GDT_Float32,
+                                                              ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3'] )
+        g = geotransform
+        dsField.SetGeoTransform( (g[0], g[1]*step, g[2]*step, g[3], g[4]*step, g[5]*step) )
+        dsField.SetMetadataItem( algDisplacement.STEP_ITEM, str(step) )
+        dsField.SetMetadataItem( algDisplacement.SIZE_ITEM, '{} {}'.format(xSize, ySize) )
+        dsField.GetRasterBand(1).SetDescription('dx')
+        dsField.GetRasterBand(2).SetDescription('dy')
+        # The pixels outside of the mesh are no data, so that applying the field leaves them untouched
+        for b in (1, 2):
+            dsField.GetRasterBand(b).SetNoDataValue( algDisplacement.NO_DISPLACEMENT )
+            dsField.GetRasterBand(b).Fill( algDisplacement.NO_DISPLACEMENT )
+
+        # The field is no data where there is no triangle, so we only compute the tiles overlapped by the mesh
+        window = algWarp.destinationWindow( pixelsB / float(step), triangles, fieldXSize, fieldYSize )
+        tiles = algWarp.tileWindows( window, self.TILE_SIZE, self.TILE_SIZE ) if window is not None else []
+        count = len(tiles)
+        for i, tile in enumerate(tiles):
+
+            if self._abort:
+                self.error( "Aborted on field tile %i out of %i..."  % (i+1, count))
+                return False
+
+            self.progress( "Computing field tile %i out of %i..." % (i+1, count), float(i)/float(count) )
+
+            subset = algWarp.trianglesInWindow( fieldBounds, *tile )
+            if len(subset) == 0:
+                continue
+            dx, dy = algDisplacement.computeFieldWindow( pixelsB, triangles, affines, step, *tile, subset=subset )
+            dsField.GetRasterBand(1).WriteArray( dx, tile[0], tile[1] )
+            dsField.GetRasterBand(2).WriteArray( dy, tile[0], tile[1] )
+
+        dsField = None
+        return True
+
+    def applyField(self):
+        """
+        Warps the source to the target with the displacement field stored in fieldPath, without any mesh
+
+        Returns True on success, False if it was aborted or if the field doesn't match the source
+        """
+
+        self.progress( "Opening the dataset...", float(0) )
+
+        with self.stats.stage('open'):
+            dsSource, geotransform = self.openSource()
+            dsField = osgeo.gdal.Open( self.fieldPath, osgeo.gdal.GA_ReadOnly )
+        xSize = dsSource.RasterXSize
+        ySize = dsSource.RasterYSize
+        self.stats.info['rasterSize'] = [xSize, ySize, dsSource.RasterCount]
+
+        step = int( dsField.GetMetadataItem( algDisplacement.STEP_ITEM ) or 1 )
+        size = dsField.GetMetadataItem( algDisplacement.SIZE_ITEM )
+        if size is not None and tuple(int(v) for v in size.split()) != (xSize, ySize):
+            self.error( "The displacement field was computed for a raster of {} pixels, but the source is {} {}.".format(size, xSize, ySize) )
+            return False
+        if (dsField.RasterXSize, dsField.RasterYSize) != algDisplacement.fieldSize( xSize, ySize, step ):
+            self.error( "The displacement field doesn't match the size of the source." )
+            return False
+
+        if self.isVrt():
+            self.error( "A displacement field can't be applied to a VRT target, as the moving area is not known beforehand." )
+            return False
+        if not self.checkTargetFormat( dsSource )[0]:
+            return False
+
+        with self.stats.stage('target'):
+            driver, dsTarget, mode = self.createTarget( dsSource, geotransform )
+        self.stats.info['mode'] = mode
+        fromSource = mode == 'stream'
+
+        tiles = algWarp.tileWindows( (0, 0, xSize, ySize), *self.tileSize( dsTarget, mode ) )
+        self.stats.count( 'tiles', len(tiles) )
+
+        def tasksArgs():
+            for tile in tiles:
+                yield (self.sourcePath, self.fieldPath, step, tile, self.samplingMethod)
+
+        def merge(i, result):
+            (xoff, yoff, width, height), moved, bands = result
+            self.stats.count( 'pixelsWarped', int(moved.sum()) )
+            if not moved.any():
+                if fromSource:
+                    self.copyTiles( dsSource, dsTarget, [tiles[i]] )
+                return
+            for b in range(1, dsTarget.RasterCount+1):
+                bandTarget = dsTarget.GetRasterBand(b)
+                if fromSource:
+                    data = dsSource.GetRasterBand(b).ReadAsArray( xoff, yoff, width, height )
+                else:
+                    data = bandTarget.ReadAsArray( xoff, yoff, width, height )
+                data[moved] = bands[b-1][moved]
+                bandTarget.WriteArray( data, xoff, yoff )
+                self.stats.count( 'bytesRead', data.nbytes )
+                self.stats.count( 'bytesWritten', data.nbytes )
+
+        with self.stats.stage('warp'):
+            if not self.processTiles( len(tiles), tasksArgs(), algDisplacement.applyTileTask, lambda args: algDisplacement.applyTile( dsSource, dsField, *args[2:] ), merge ):
+                return False
+
+        with self.stats.stage('save'):
+            self.saveTarget( driver, dsTarget, mode )
+            dsTarget = None
+            dsSource = None
+            dsField = None
+
+        return True
+
+
+class RasterBenderBatch(object):
+    """
+    Bends several rasters with the same mesh (for instance co-registered scans, masks and elevation models).
+
+    The pixel mapping of the mesh is only computed once per raster geometry, and the tiles of all the rasters
+    are warped by the same pool of processes, one raster after the other.
+
+    The caller is notified through the same callbacks as RasterBenderEngine (the percentage is the one of the whole batch), and :
+    jobProgress(jobIndex, message, percentage)
+    jobFinished(jobIndex, success)
+    """
+
+    def __init__(self, jobs, samplingMethod, tiled=False, workers=1, incremental=False, debug=False, progress=None, log=None, error=None, jobProgress=None, jobFinished=None):
+
+        self.jobs = jobs # list of (sourcePath, targetPath)
+        self.samplingMethod = samplingMethod
+        self.tiled = tiled
+        self.workers = workers
+        self.incremental = incremental
+        self.debug = debug
+
+        self.progressCallback = progress
+        self.logCallback = log
+        self.errorCallback = error
+        self.jobProgressCallback = jobProgress
+        self.jobFinishedCallback = jobFinished
+
+        self.engine = None # the engine of the current job
+        self._abort = False
+
+    def abort(self):
+        self._abort = True
+        if self.engine is not None:
+            self.engine.abort()
+
+    def run(self, triangles, pointsA, pointsB):
+        """
+        Bends all the rasters, going on with the next one when one fails.
+
+        Returns the list of the indices of the jobs that failed
+        """
+        count = len(self.jobs)
+        failed = []
+        mappings = {}
+        pool = None
+        try:
+            if self.workers > 1:
+                pool = createPool( self.workers )
+
+            for i, (sourcePath, targetPath) in enumerate(self.jobs):
+
+                if self._abort:
+                    failed.extend( range(i, count) )
+                    break
+
+                def jobProgress(message, percentage, i=i, sourcePath=sourcePath):
+                    if self.jobProgressCallback is not None:
+                        self.jobProgressCallback(i, message, percentage)
+                    if self.progressCallback is not None:
+                        self.progressCallback( "Raster %i out of %i (%s) : %s" % (i+1, count, os.path.basename(sourcePath), message), (i+percentage)/float(count) )
+
+                def jobError(message, i=i, sourcePath=sourcePath):
+                    message = "Raster %i out of %i (%s) : %s" % (i+1, count, os.path.basename(sourcePath), message)
+                    if self.errorCallback is not None:
+                        self.errorCallback(message)
+                    else:
+                        sys.stderr.write(message + '\n')
+
+                self.engine = RasterBenderEngine( sourcePath, targetPath, self.samplingMethod, self.tiled, self.workers, self.incremental, self.debug,
+                                                  progress=jobProgress, log=self.logCallback, error=jobError, pool=pool, mappings=mappings )
+                try:
+                    success = self.engine.run( triangles, pointsA, pointsB )
+                except Exception as e:
+                    jobError( "Could not bend the raster ({})".format(e) )
+                    success = False
+                self.engine.writeReport()
+
+                if not success:
+                    failed.append(i)
+                if self.jobFinishedCallback is not None:
+                    self.jobFinishedCallback(i, success)
+        finally:
+            self.engine = None
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return failed
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ RasterBender
+                                 A QGIS plugin
+ Deforms vector to adapt them despite heavy and irregular deformations
+                              -------------------
+        begin                : 2014-05-21
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Instrumentation of the runs : duration of each stage and counters (triangles, tiles, bytes read and written...),
+reported as JSON next to the target. It doesn't depend on Qt nor QGIS.
+"""
+
+import time
+import json
+import pstats
+import cProfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class RunStats(object):
+    """
+    Collects the wall time of the stages of a run (a stage can be timed several times, its durations are added up)
+    and counters.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = OrderedDict() # name : seconds
+        self.calls = OrderedDict() # name : number of times the stage was timed
+        self.counters = OrderedDict() # name : value
+        self.info = OrderedDict() # name : any JSON value (paths, settings...)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as the given stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addTime( name, time.time() - start )
+
+    def addTime(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """
+        Returns the statistics as a dict that can be written as JSON
+        """
+        rates = OrderedDict()
+        warp = self.stages.get('warp', 0.0)
+        if warp > 0:
+            for counter, rate in (('triangles', 'trianglesPerSecond'), ('pixelsWarped', 'pixelsPerSecond'),
+                                  ('bytesRead', 'bytesReadPerSecond'), ('bytesWritten', 'bytesWrittenPerSecond')):
+                if counter in self.counters:
+                    rates[rate] = self.counters[counter] / warp
+
+        report = OrderedDict()
+        report['info'] = self.info
+        report['total'] = time.time() - self.started
+        report['stages'] = OrderedDict( (name, OrderedDict([('seconds', seconds), ('calls', self.calls[name])])) for name, seconds in self.stages.items() )
+        report['counters'] = self.counters
+        report['rates'] = rates
+        return report
+
+    def summary(self):
+        """
+        Returns a one line description of where the time was spent
+        """
+        report = self.report()
+        stages = ', '.join( '{} {:.2f}s'.format(name, stage['seconds']) for name, stage in report['stages'].items() )
+        return 'Total {:.2f}s ({})'.format(report['total'], stages)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump( self.report(), f, indent=2 )
+
+
+@contextmanager
+def timeStage(stats, name):
+    """
+    Times a block as a stage of stats, or does nothing if stats is None
+    """
+    if stats is None:
+        yield
+    else:
+        with stats.stage(name):
+            yield
+
+
+def profiled(path, function, *args, **kwargs):
+    """
+    Calls function under cProfile, and writes the profile (that can be read with pstats or snakeviz) to path.
+    Only this process is profiled, not the worker processes.
+
+    Returns the result of the function
+    """
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall( function, *args, **kwargs )
+    finally:
+        profile.dump_stats( path )
+
+
+def profileSummary(path, lines=30):
+    """
+    Returns the functions that took the most cumulative time in a profile written by profiled, as text
+    """
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    output = StringIO()
+    pstats.Stats( path, stream=output ).sort_stats('cumulative').print_stats( lines )
+    return output.getvalue()
@@ -27,17 +27,17 @@ from qgis.core import *
 from qgis.gui import *
 
 # Basic dependencies
-import osgeo, osgeo.gdalnumeric
+import osgeo, osgeo.gdal, osgeo.gdalnumeric
 import os.path, shutil
 import sys
 import traceback
 import math
-import numpy
-import subprocess
 import json
 
 # Other classes
 import triangulate
+from rasterbenderengine import RasterBenderEngine, bandBytes
+from rasterbenderstats import RunStats, profiled, profileSummary
 
 
 class RasterBenderWorkerThread(QThread):
@@ -45,8 +45,9 @@ class RasterBenderWorkerThread(QThread):
     finished = pyqtSignal()
     error = pyqtSignal(str)
     progress = pyqtSignal(str, float) #message, progress percentage
+    report = pyqtSignal(object) #the statistics of the run (see RunStats.report), emitted before finished
 
-    def __init__(self, pairsLayer, pairsLimitToSelection, constraintsLayer, constraintsLimitToSelection, bufferValue, samplingMethod, sourcePath, targetPath, debug):
+    def __init__(self, pairsLayer, pairsLimitToSelection, constraintsLayer, constraintsLimitToSelection, bufferValue, samplingMethod, sourcePath, targetPath, debug, engine='numpy', tiled=False, workers=1, incremental=False, fieldPath=None, fieldStep=1, profile=False):
         QThread.__init__(self)
 
         self.pairsLayer = pairsLayer
@@ -60,9 +61,25 @@ class RasterBenderWorkerThread(QThread):
         self.targetPath = targetPath
 
         self.debug = debug
+        self.engine = engine # 'numpy' (in-process) or 'gdal' (GDAL's translate and warp, one triangle at a time)
+        self.tiled = tiled # if True, the numpy engine writes the target block by block instead of building it in memory
+        # number of processes used by the numpy engine to warp the tiles. Outside of Windows, they could only be forked
+        # from QGIS, which can deadlock on the locks held by its other threads (see the dialog)
+        self.workers = workers if os.name == 'nt' else 1
+        self.incremental = incremental # if True, the numpy engine only warps again the triangles that changed since the previous run
+        self.profile = profile # if True, the run is captured with cProfile next to the target
 
         self._abort = False
 
+        # The timings and counters of the run, written as JSON next to the target
+        self.stats = RunStats()
+        self.stats.info['engine'] = engine
+
+        # The in-process engine
+        self.bender = RasterBenderEngine( sourcePath, targetPath, samplingMethod, tiled, self.workers, incremental, debug,
+                                          progress=self.progress.emit, log=self.log, error=self.error.emit,
+                                          fieldPath=fieldPath, fieldStep=fieldStep, stats=self.stats )
+
 
     def log(self,message, debug_only=False):
         if debug_only is False or self.debug is True:
@@ -72,47 +89,58 @@ class RasterBenderWorkerThread(QThread):
             QgsMessageLog.logMessage(message,'RasterBender-gdal')
 
 
-    def runCommand(self, args, operation_name = 'run the command'):
-        str_args = [str(a) for a in args]
+    def runGdal(self, operation_name, function, *args, **kwargs):
+        """
+        Calls a function of GDAL's python API (such as gdal.Translate or gdal.Warp), emitting an error if it fails.
+
+        Returns (success, result)
+        """
         try:
-            self.log_gdal('# COMMAND   : '+operation_name)
-            self.log_gdal(subprocess.list2cmdline(str_args))
-            result = subprocess.check_output(str_args, shell=True, stdin=subprocess.PIPE, stderr=subprocess.STDOUT) 
-            self.log_gdal('# OUTPUT    : '+operation_name)           
-            self.log_gdal(result)
-            return (True,result)
-        except subprocess.CalledProcessError as e: 
-            self.log_gdal('# ERROR     : '+operation_name)           
-            self.log_gdal(e.output)
-            self.error.emit( "Could not %s ! : \"%s\" [%s]"  % (operation_name, e.output, subprocess.list2cmdline(e.cmd)))
-            return (False, e.output)
-        except Exception as e:
-            self.log_gdal('# EXCEPTION : '+operation_name)           
+            self.log_gdal('# CALL      : '+operation_name)
+            self.log_gdal('{}({})'.format(function.__name__, ', '.join(['{}={!r}'.format(k, v) for k, v in sorted(kwargs.items())])))
+            result = function(*args, **kwargs)
+            if result is None:
+                raise RuntimeError(osgeo.gdal.GetLastErrorMsg())
+            return (True, result)
+        except RuntimeError as e:
+            self.log_gdal('# ERROR     : '+operation_name)
             self.log_gdal(str(e))
             self.error.emit( "Could not %s ! : \"%s\""  % (operation_name,str(e),))
             return (False, None)
 
     def abort(self):
         self._abort = True
+        self.bender.abort()
 
     def run(self):
         try:
-            self.doRun()
+            if self.profile:
+                success = profiled( self.bender.profilePath(), self.doRun )
+                self.log( profileSummary( self.bender.profilePath() ), True )
+            else:
+                success = self.doRun()
+            self.writeReport()
+            if success:
+                self.finished.emit()
         except Exception as e:
             self.error.emit('An unexpected exception occured ! See QGIS log for details.')
             self.log(traceback.format_exc())
+
+    def writeReport(self):
+        """
+        Emits the statistics of the run and writes them next to the target
+        """
+        self.log( self.stats.summary() )
+        self.bender.writeReport()
+        self.report.emit( self.stats.report() )
     
     def doRun(self):
+        """
+        Returns True if the run succeeded
+        """
 
         self._abort = False
 
-        if self.debug:
-            args = ['gdalinfo',
-                '--version',
-            ]
-            sucess, result = self.runCommand(args, 'get GDAL version')
-
-
         self.progress.emit("Starting RasterBender", float(0))
 
         #####################################
@@ -122,8 +150,33 @@ class RasterBenderWorkerThread(QThread):
         self.progress.emit( "Loading delaunay mesh...", float(0) )
 
         # Create the delaunay triangulation
-        triangles, pointsA, pointsB, hull, constraints = triangulate.triangulate( self.pairsLayer, self.pairsLimitToSelection, self.constraintsLayer, self.constraintsLimitToSelection, self.bufferValue )
+        triangles, pointsA, pointsB, hull, constraints, snapDistances = triangulate.triangulate( self.pairsLayer, self.pairsLimitToSelection, self.constraintsLayer, self.constraintsLimitToSelection, self.bufferValue, stats=self.stats )
+
+        for i, distances in enumerate(snapDistances):
+            if len(distances) > 0 and max(distances) > 0:
+                self.log('Constraint {} is not snapped on the pairs (distances : {})'.format(i, distances), True)
+
+        if self.engine == 'gdal':
+            return self.doRunGdal(triangles, pointsA, pointsB)
+        return self.bender.run(triangles, pointsA, pointsB)
+
+    def doRunGdal(self, triangles, pointsA, pointsB):
+        """
+        Warps the raster using GDAL's python API : each triangle is extracted with gdal.Translate and patched on the target with gdal.Warp.
+        The extracts are in-memory datasets and the cutlines are written in GDAL's /vsimem/ virtual filesystem, so that nothing but the target is written on disk.
+
+        Returns True if the run succeeded
+        """
+
+        #Open the dataset
+        osgeo.gdal.UseExceptions()
 
+        # gdal.Translate and gdal.Warp appeared in GDAL 2.1
+        if not hasattr(osgeo.gdal, 'Warp'):
+            self.error.emit( "The GDAL engine needs GDAL 2.1 or later (this is GDAL %s), use the in-process engine instead." % osgeo.gdal.VersionInfo('RELEASE_NAME') )
+            return False
+
+        self.log_gdal('# GDAL      : ' + osgeo.gdal.VersionInfo('--version'))
 
         ###############################
         # Step 2. Opening the dataset #
@@ -131,11 +184,8 @@ class RasterBenderWorkerThread(QThread):
 
         self.progress.emit( "Opening the dataset... This shouldn't be too long...", float(0) )
 
-        #Open the dataset
-        osgeo.gdal.UseExceptions()
-
-        # Read the source data into numpy arrays
-        dsSource = osgeo.gdal.Open( self.sourcePath, osgeo.gdal.GA_ReadOnly )
+        with self.stats.stage('open'):
+            dsSource = osgeo.gdal.Open( self.sourcePath, osgeo.gdal.GA_ReadOnly )
 
         # Get the transformation
         pixW = float(dsSource.RasterXSize-1) #width in pixel
@@ -149,144 +199,111 @@ class RasterBenderWorkerThread(QThread):
 
         self.log('pixW:{} pixH:{} rezX:{} rezY:{} mapW:{} mapH:{} offX:{} offY:{}'.format(pixW,pixH,rezX,rezY,mapW,mapH,offX,offY), True )
 
-        dsSource = None # close the source
-
         # We copy the origin to the destination raster
         # Every succequent drawing will happen on this raster, so that areas that don't move are already ok.
 
-        # We get the informations of the source layer to use the same format for output
-        args = ['gdalinfo',
-                # '-json', # -json doesn't exist in GDAL<2.0
-                self.sourcePath,
-            ]
-
-        sucess, result = self.runCommand(args, 'get the file infos')
-        # output_format = json.loads(result)['driverShortName'] # -json doesn't exist in GDAL<2.0, so we use this:
-        if not sucess: return
-        output_format = None
-        geotransform_found = False
-        for line in result.split('\n'):
-            if line[0:8]=='Driver: ':
-                output_format = line[8:].split('/')[0]
-            if line[0:13]=='Pixel Size = ':
-                geotransform_found=True
-
-
-        # And we create a copy
-        args = ['gdal_translate', 
-                self.sourcePath,
-                self.targetPath,
-            ]
-        # If we has an input format, we set it using -of parameter
-        if output_format:
-            self.log('Output format was found : {}'.format(output_format), True)
-            args.extend(['-of',output_format])
-        else:
-            self.log('Output format was not found.', True)
-        if geotransform_found:
+        # We use the same format as the source for the output
+        options = { 'format': dsSource.GetDriver().ShortName }
+        self.log('Output format was found : {}'.format(options['format']), True)
+        if dsSource.GetGeoTransform(can_return_null=True) is not None:
             self.log('Geotransform was found.', True)
         else:
             # If we have no geotransform, we use GCPs to match 1 pixel = 1 map unit.
-            args.extend(['-gcp',0,0,0,0])
-            args.extend(['-gcp',0,1,0,-1])
-            args.extend(['-gcp',1,0,1,0])
+            options['GCPs'] = [ osgeo.gdal.GCP(0,0,0,0,0), osgeo.gdal.GCP(0,-1,0,0,1), osgeo.gdal.GCP(1,0,0,1,0) ]
             rezY = -rezY # hack, see above
             self.log('Geotransform was not found. We created GCPs', True)
 
-        sucess, result = self.runCommand(args, 'copy the file')
-        if not sucess: return
+        with self.stats.stage('copy'):
+            sucess, dsTarget = self.runGdal('copy the file', osgeo.gdal.Translate, self.targetPath, dsSource, **options)
+        if not sucess: return False
+        # The target is kept open : the triangles are patched on it without reopening it
+        dsTarget.FlushCache()
+        self.stats.count( 'bytesWritten', os.path.getsize(self.targetPath) )
 
 
-        def qgsPointToXY(qgspoint):
+        def pointToXY(point):
             """
             Returns a point in pixels coordinates given a point in map coordinates
             """
-            return ( (qgspoint.x() - offX) / rezX + 1.0 , (qgspoint.y() - offY) / rezY + 1.0 )
+            return ( (point[0] - offX) / rezX + 1.0 , (point[1] - offY) / rezY + 1.0 )
+
+        # The cutline of the current triangle, in GDAL's in-memory filesystem
+        cutlinePath = '/vsimem/rasterbender_%i_cutline.csv' % id(self)
 
         # We loop through every triangle to create a GDAL affine transformation
         count = len(triangles)
-        for i,triangle in enumerate(triangles):
-
-            if self._abort:
-                self.error.emit( "Aborted on triangle %i out of %i..."  % (i+1, count))
-                return
-
-            self.progress.emit( "Computing triangle %i out of %i..." % (i+1, count), float(i)/float(count) )
-
-            # aX are the pixels points of the initial triangles
-            a0 = qgsPointToXY(pointsA[triangle[0]])
-            a1 = qgsPointToXY(pointsA[triangle[1]])
-            a2 = qgsPointToXY(pointsA[triangle[2]])
-            # bx are the map points of the destination triangle
-            b0 = pointsB[triangle[0]]
-            b1 = pointsB[triangle[1]]
-            b2 = pointsB[triangle[2]]
-
-            
-
-            # Step 1 : we do an affine transformation by providing 3 -gcp points
-
-            # here we compute the parameters for srcwin, so that we don't compute the transformation on the whole raster
-            # we have a 2 pixels margins, hence the +/- 2 and the enclosing max/min (to avoid overbound)
+        self.stats.count( 'triangles', count )
+        try:
+            for i,triangle in enumerate(triangles):
 
-            xMin = min(a0[0],a1[0],a2[0])
-            yMin = min(a0[1],a1[1],a2[1])
-            xMax = max(a0[0],a1[0],a2[0])
-            yMax = max(a0[1],a1[1],a2[1])
+                if self._abort:
+                    self.error.emit( "Aborted on triangle %i out of %i..."  % (i+1, count))
+                    return False
 
-            xoff = xMin-2
-            yoff = yMin-2
-            xsize = xMax-xMin+4
-            ysize = yMax-yMin+4
+                self.progress.emit( "Computing triangle %i out of %i..." % (i+1, count), float(i)/float(count) )
 
-            tempTranslated = QTemporaryFile()
-            if self.debug: tempTranslated.setAutoRemove(False)
-            tempTranslated.open()
+                # aX are the pixels points of the initial triangles
+                a0 = pointToXY(pointsA[triangle[0]])
+                a1 = pointToXY(pointsA[triangle[1]])
+                a2 = pointToXY(pointsA[triangle[2]])
+                # bx are the map points of the destination triangle
+                b0 = pointsB[triangle[0]]
+                b1 = pointsB[triangle[1]]
+                b2 = pointsB[triangle[2]]
 
-            args = ['gdal_translate',
-                '-gcp', a0[0]-xoff,a0[1]-yoff,b0[0],b0[1],
-                '-gcp', a1[0]-xoff,a1[1]-yoff,b1[0],b1[1],
-                '-gcp', a2[0]-xoff,a2[1]-yoff,b2[0],b2[1], 
-                '-srcwin', xoff, yoff, xsize, ysize, 
-                self.sourcePath,
-                tempTranslated.fileName(),
-            ]
 
-            sucess, result = self.runCommand(args, 'create the temporaray file %i out of %i' % (i+1, count))
-            if not sucess: return
 
+                # Step 1 : we do an affine transformation by providing 3 GCPs
 
+                # here we compute the parameters for srcWin, so that we don't compute the transformation on the whole raster
+                # we have a 2 pixels margins, hence the +/- 2 and the enclosing max/min (to avoid overbound)
 
-            # Step 2 : we draw the transformed layer on the target layer by providing a cutline (corresponding to the destination triangle)
+                xMin = min(a0[0],a1[0],a2[0])
+                yMin = min(a0[1],a1[1],a2[1])
+                xMax = max(a0[0],a1[0],a2[0])
+                yMax = max(a0[1],a1[1],a2[1])
 
-            # We create a vector polygon to feed into GDAL's -cutline argument
-            clip = QgsGeometry.fromPolygon([[b0,b1,b2,b0]]).buffer(.5*abs(rezX)+.5*abs(rezY),2)
+                xoff = xMin-2
+                yoff = yMin-2
+                xsize = xMax-xMin+4
+                ysize = yMax-yMin+4
 
-            # Since it must be a GDAL format, we have to create a .csv file (hah, command line tools...)
-            tempWKT = QTemporaryFile( os.path.join(QDir.tempPath(),'XXXXXX.csv') )
-            if self.debug: tempWKT.setAutoRemove(False)
-            tempWKT.open()
-            content = 'WKT\tID\n"%s"\t1' % (clip.exportToWkt())
-            tempWKT.write(content)
-            tempWKT.close()
-            
+                # The extract is an in-memory dataset
+                with self.stats.stage('translate'):
+                    sucess, dsTranslated = self.runGdal('create the extract %i out of %i' % (i+1, count), osgeo.gdal.Translate, '', dsSource,
+                        format = 'MEM',
+                        GCPs = [ osgeo.gdal.GCP(b0[0],b0[1],0,a0[0]-xoff,a0[1]-yoff),
+                                 osgeo.gdal.GCP(b1[0],b1[1],0,a1[0]-xoff,a1[1]-yoff),
+                                 osgeo.gdal.GCP(b2[0],b2[1],0,a2[0]-xoff,a2[1]-yoff) ],
+                        srcWin = [xoff, yoff, xsize, ysize],
+                    )
+                if not sucess: return False
+                self.stats.count( 'bytesRead', sum( bandBytes(dsTranslated, b) for b in range(1, dsTranslated.RasterCount+1) ) )
 
-            args = [ 'gdalwarp',
-                '-cutline', tempWKT.fileName(),
-                '-cblend', '1', 
-                '-dstnodata', '-999',
-                '-r', self.samplingMethod,
-                tempTranslated.fileName(),
-                self.targetPath,
-            ]
 
-            sucess, result = self.runCommand(args, 'patch the triangle %i out of %i' % (i+1, count))
-            if not sucess: return
 
+                # Step 2 : we draw the transformed extract on the target by providing a cutline (corresponding to the destination triangle)
 
+                # We create a vector polygon to feed into GDAL's cutline argument
+                clip = QgsGeometry.fromPolygon([[QgsPoint(*b0),QgsPoint(*b1),QgsPoint(*b2),QgsPoint(*b0)]]).buffer(.5*abs(rezX)+.5*abs(rezY),2)
 
+                # Since it must be a GDAL datasource, we write it as a .csv file in memory
+                content = 'WKT\tID\n"%s"\t1' % (clip.exportToWkt())
+                osgeo.gdal.FileFromMemBuffer( cutlinePath, str(content) )
 
-        self.finished.emit()
-        return
+                with self.stats.stage('warp'):
+                    sucess, result = self.runGdal('patch the triangle %i out of %i' % (i+1, count), osgeo.gdal.Warp, dsTarget, dsTranslated,
+                        cutlineDSName = cutlinePath,
+                        cutlineBlend = 1,
+                        dstNodata = -999,
+                        resampleAlg = self.samplingMethod,
+                    )
+                dsTranslated = None
+                if not sucess: return False
 
+        finally:
+            osgeo.gdal.Unlink( cutlinePath )
+            dsTarget = None
+            dsSource = None
 
+        return True
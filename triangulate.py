@@ -2,71 +2,242 @@
 
 from qgis.core import *
 
+import numpy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
 import algorithm_constrained_delaunay as algDelaunay
+from algorithm_pointindex import PointIndex
+from rasterbenderstats import timeStage
+
+
+class TriangulationCache(object):
+    """
+    Keeps the last computed meshes in memory (least recently used ones are dropped first), and optionally
+    in a directory so that they survive QGIS restarts.
+
+    The meshes are identified by a hash of the pairs, the constraints, the selection state and the buffer.
+    The cached arrays are read-only, since they are shared by all the callers.
+    """
+
+    # Bump this when the triangulation changes, so that meshes stored on disk are computed again
+    # (2 : constraints inserted by cavity retriangulation, counterclockwise triangles)
+    VERSION = 2
+
+    def __init__(self, maxEntries=8, directory=None, maxFiles=64):
+        self.maxEntries = maxEntries
+        self.directory = directory # if None, the meshes are only kept in memory
+        self.maxFiles = maxFiles
+        self.entries = OrderedDict() # key : [triangles, pointsA, pointsB, hull, constraints, snapDistances]
+        self.lock = threading.Lock() # the preview and the worker thread share the cache
+
+    def key(self, pairsA, pairsB, constraintLines, pairsLimitToSelection, constraintsLimitToSelection, bufferValue):
+        """
+        Returns the hash identifying a mesh
+        """
+        digest = hashlib.sha1()
+        digest.update( repr( (self.VERSION, bool(pairsLimitToSelection), bool(constraintsLimitToSelection), float(bufferValue), len(pairsA), len(constraintLines)) ).encode('utf-8') )
+        digest.update( numpy.array( pairsA, dtype=numpy.float64 ).tobytes() )
+        digest.update( numpy.array( pairsB, dtype=numpy.float64 ).tobytes() )
+        for line in constraintLines:
+            digest.update( repr(len(line)).encode('utf-8') )
+            digest.update( numpy.array( line, dtype=numpy.float64 ).tobytes() )
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the mesh stored for a key, or None
+        """
+        with self.lock:
+            result = self.entries.pop(key, None)
+            if result is None:
+                result = self.read(key)
+            if result is None:
+                return None
+            self.entries[key] = result
+        return self.copy(result)
+
+    def put(self, key, result):
+        """
+        Stores a mesh (as returned by computeMesh)
+        """
+        for array in result[:3]:
+            array.setflags(write=False)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = result
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+            self.write(key, result)
+        return self.copy(result)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
+    def copy(self, result):
+        # The hull and the lists can be modified by the callers, the arrays can't
+        triangles, pointsA, pointsB, hull, constraints, snapDistances = result
+        return [triangles, pointsA, pointsB, QgsGeometry(hull), [list(c) for c in constraints], [list(d) for d in snapDistances]]
 
-def triangulate( pairsLayer, pairsLimitToSelection, constraintsLayer, constraintsLimitToSelection, bufferValue ):
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def read(self, key):
+        if self.directory is None or not os.path.exists(self.path(key)):
+            return None
+        try:
+            # The file is closed at once, so that it isn't kept open (and locked on Windows) by the cached arrays
+            with numpy.load(self.path(key)) as state:
+                result = [ state['triangles'], state['pointsA'], state['pointsB'],
+                           QgsGeometry.fromWkt( state['hull'].item() ),
+                           json.loads( state['constraints'].item() ), json.loads( state['snapDistances'].item() ) ]
+        except Exception as e:
+            QgsMessageLog.logMessage('Could not read the cached mesh {} ({})'.format(key, e), 'RasterBender')
+            return None
+        for array in result[:3]:
+            array.setflags(write=False)
+        os.utime(self.path(key), None) # so that the least recently used files are pruned first
+        return result
+
+    def write(self, key, result):
+        if self.directory is None:
+            return
+        triangles, pointsA, pointsB, hull, constraints, snapDistances = result
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # We write to a temporary file first, so that a concurrent reader never sees a partial file
+            temporaryPath = self.path(key) + '.tmp'
+            with open(temporaryPath, 'wb') as f:
+                numpy.savez( f,
+                    triangles=triangles,
+                    pointsA=pointsA,
+                    pointsB=pointsB,
+                    hull=numpy.array( hull.exportToWkt() ),
+                    constraints=numpy.array( json.dumps(constraints) ),
+                    snapDistances=numpy.array( json.dumps(snapDistances) ),
+                )
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+            os.rename(temporaryPath, self.path(key))
+
+            # We only keep the most recently used files
+            files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz')]
+            for path in sorted(files, key=os.path.getmtime)[:-self.maxFiles]:
+                os.remove(path)
+        except (IOError, OSError) as e:
+            QgsMessageLog.logMessage('Could not store the mesh {} ({})'.format(key, e), 'RasterBender')
+
+
+# The cache shared by the preview and the runs
+meshCache = TriangulationCache()
+
+
+def loadFeatures( pairsLayer, pairsLimitToSelection, constraintsLayer, constraintsLimitToSelection ):
+    """
+    Returns [pairsA, pairsB, constraintLines] where pairsA and pairsB are lists of the (x,y) coordinates of the
+    start and end points of the pairs, and constraintLines a list of lists of the (x,y) coordinates of the constraints vertices.
+    """
 
     # Get the features of the pair layer and store them in two arrays
-    pointsA = []
-    pointsB = []
-    constraints = [] # will hold a list of list of points to represent the linestrings constraints
+    pairsA = []
+    pairsB = []
+    constraintLines = []
 
     pairsFeatures = pairsLayer.getFeatures() if not pairsLimitToSelection else pairsLayer.selectedFeatures()
     for feature in pairsFeatures:
         geom = feature.geometry().asPolyline()
-        pointsA.append( QgsPoint(geom[0]) )
-        pointsB.append( QgsPoint(geom[-1]) )
-
-    def findNearestPointIndex(point):
-        nearestIndex = None
-        nearestDist = None
-        for i,otherPoint in enumerate(pointsA):
-            dist = point.sqrDist( otherPoint )
-            if nearestIndex is None or dist<nearestDist:
-                nearestIndex = i
-                nearestDist = dist
-        return nearestIndex
-
+        pairsA.append( (geom[0].x(), geom[0].y()) )
+        pairsB.append( (geom[-1].x(), geom[-1].y()) )
 
     if constraintsLayer is not None:
         constraintsFeatures = constraintsLayer.getFeatures() if not constraintsLimitToSelection else constraintsLayer.selectedFeatures()
         for feature in constraintsFeatures:
             geom = feature.geometry().asPolyline()
-            constraint = []
-            for point in geom:
-                constraint.append( findNearestPointIndex(point) )
-            constraints.append( constraint )
+            constraintLines.append( [(point.x(), point.y()) for point in geom] )
+
+    return [pairsA, pairsB, constraintLines]
+
+
+def triangulate( pairsLayer, pairsLimitToSelection, constraintsLayer, constraintsLimitToSelection, bufferValue, cache=meshCache, stats=None ):
+    """
+    Returns [triangles, pointsA, pointsB, hull, constraints, snapDistances] where triangles is a (M,3) int32 array of
+    the indices of the triangles that move, and pointsA and pointsB are (N,2) float64 arrays of coordinates.
+
+    The mesh is taken from the cache (if not None) when the pairs, constraints and settings didn't change.
+    If stats (a RunStats) is given, the 'features', 'triangulation' and 'constraints' stages are timed in it.
+    """
+
+    with timeStage( stats, 'features' ):
+        pairsA, pairsB, constraintLines = loadFeatures( pairsLayer, pairsLimitToSelection, constraintsLayer, constraintsLimitToSelection )
+
+    if cache is None:
+        return computeMesh( pairsA, pairsB, constraintLines, bufferValue, stats )
+
+    key = cache.key( pairsA, pairsB, constraintLines, pairsLimitToSelection, constraintsLimitToSelection, bufferValue )
+    result = cache.get( key )
+    if result is None:
+        result = cache.put( key, computeMesh( pairsA, pairsB, constraintLines, bufferValue, stats ) )
+    elif stats is not None:
+        stats.count( 'meshCacheHits' )
+    return result
+
+
+def computeMesh( pointsA, pointsB, constraintLines, bufferValue, stats=None ):
+    """
+    Computes the mesh from the coordinates returned by loadFeatures (see triangulate for the returned values)
+
+    Raises ValueError if there are less than 3 pairs
+    """
 
     # Make sure data is valid
-    assert len(pointsA)>=3
-    assert len(pointsA)==len(pointsB)
+    if len(pointsA) < 3:
+        raise ValueError( "At least 3 pairs are needed, {} were found.".format(len(pointsA)) )
+    if len(pointsA) != len(pointsB):
+        raise ValueError( "The pairs have {} source positions but {} target positions.".format(len(pointsA), len(pointsB)) )
+
+    constraints = [] # will hold a list of list of points to represent the linestrings constraints
+    snapDistances = [] # will hold for each constraint the distances between its vertices and the pairs they were snapped to
+
+    if len(constraintLines) > 0:
+        # The constraints vertices are snapped to the nearest pair
+        with timeStage( stats, 'constraints' ):
+            pointIndex = PointIndex( pointsA )
+
+            for line in constraintLines:
+                constraint = []
+                distances = []
+                for x, y in line:
+                    index, distance = pointIndex.nearest( x, y )
+                    constraint.append( index )
+                    distances.append( distance )
+                constraints.append( constraint )
+                snapDistances.append( distances )
+
+    pointsA = numpy.array( pointsA, dtype=numpy.float64 )
+    pointsB = numpy.array( pointsB, dtype=numpy.float64 )
 
     # Compute the hull
-    hull = QgsGeometry.fromMultiPoint( pointsA ).convexHull()
+    hull = QgsGeometry.fromMultiPoint( [QgsPoint(x, y) for x, y in pointsA] ).convexHull()
 
     # If there is a buffer, we add a ring outside the hull so that the transformation smoothly stops
     if bufferValue>0:
         expandedHull = hull.buffer(bufferValue, 2)
-        for p in expandedHull.asPolygon()[0][:-1]: #we don't take the last point since it's a duplicate
-            pointsA.append( p )
-            pointsB.append( p )
+        ring = numpy.array( [(p.x(), p.y()) for p in expandedHull.asPolygon()[0][:-1]], dtype=numpy.float64 ) #we don't take the last point since it's a duplicate
+        pointsA = numpy.vstack( (pointsA, ring) )
+        pointsB = numpy.vstack( (pointsB, ring) )
         hull = expandedHull
 
     # Create the delaunay triangulation
-    delaunay = algDelaunay.computeConstrainedDelaunayTriangulation( pointsA, constraints )
-
-    triangles = []
-    for tri in delaunay:
-        if ( pointsB[tri[0]][0] == pointsA[tri[0]][0] and
-             pointsB[tri[0]][1] == pointsA[tri[0]][1] and
-             pointsB[tri[1]][0] == pointsA[tri[1]][0] and
-             pointsB[tri[1]][1] == pointsA[tri[1]][1] and
-             pointsB[tri[2]][0] == pointsA[tri[2]][0] and
-             pointsB[tri[2]][1] == pointsA[tri[2]][1] ):
-            # If the triangle hasn't changed
-            continue
-        triangles.append(tri)
-
-    return [triangles, pointsA, pointsB, hull, constraints]
-    
\ No newline at end of file
+    delaunay = algDelaunay.computeConstrainedDelaunayTriangulation( pointsA, constraints, stats )
+    delaunay = numpy.array( delaunay, dtype=numpy.int32 ).reshape(-1,3)
+
+    # We only keep the triangles that have changed
+    moved = (pointsA != pointsB).any(axis=1)
+    triangles = delaunay[ moved[delaunay].any(axis=1) ]
+
+    return [triangles, pointsA, pointsB, hull, constraints, snapDistances]